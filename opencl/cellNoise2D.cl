@@ -1,25 +1,11 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "distMetrics.clh"
-#include "texCoordTransforms.clh"
-#include "gridCoordTransforms.clh"
-
-/*
- * Determines the range of indices in the cell point array at which to find the
- * cell points contained in the specified grid box. Returns the first index
- * and last index plus one as a uint2.
- */
-uint2 getPtIdxRange(uint numBoxesH, uint numPtsPerBox, int2 boxCoords)
-{
-  uint2 coords = normalizeBoxCoords2D(numBoxesH, boxCoords);
-  uint boxIdx = coords.y * numBoxesH + coords.x;
-  uint firstPtIdx = boxIdx * numPtsPerBox;
-  return (uint2) (firstPtIdx, firstPtIdx + numPtsPerBox);
-}
+#include "cellNoise2D.clh"
+#include "implicitGrid.clh"
 
 /*
  * Computes 2D cellular noise using a modified version of Worley's grid-based
- * cellular noise algorithm.
+ * cellular noise algorithm. See cellNoise2DAt.
  * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
  *   1.
  * numPtsPerBox - Number of cell points in each grid box. Must be at least 1.
@@ -32,45 +18,103 @@ uint2 getPtIdxRange(uint numBoxesH, uint numPtsPerBox, int2 boxCoords)
  *   by get_global_id[0] to determine where to store its result.
  */
 __kernel void cellNoise2D(const uint numBoxesH, const uint numPtsPerBox,
-  const distMetric metricID, __global const double2 *cellPts,
-  __global const double2 *evalPts, __global double *result)
+  const distMetric metricID, __global const real2 *cellPts,
+  __global const real2 *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise2DAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts,
+    evalPts[pixelIdx]);
+}
+
+/*
+ * Like cellNoise2D, but computes the evaluation points from an implicit grid
+ * instead of reading them from memory.
+ * grid - Description of the 2D grid of evaluation points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void cellNoise2DGrid(const uint numBoxesH, const uint numPtsPerBox,
+  const distMetric metricID, __global const real2 *cellPts,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise2DAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts,
+    implicitGridPt2D(grid, pixelIdx));
+}
+
+/*
+ * Like cellNoise2D, but generates the cell points inside the kernel instead
+ * of reading them from memory. See cellNoise2DProceduralAt.
+ * seedBase - Random seed of the cell points.
+ */
+__kernel void cellNoise2DProcedural(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID, const uint seedBase,
+  __global const real2 *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise2DProceduralAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, seedBase, evalPts[pixelIdx]);
+}
+
+/*
+ * Like cellNoise2DProcedural, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void cellNoise2DProceduralGrid(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID, const uint seedBase,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise2DProceduralAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, seedBase,
+    implicitGridPt2D(grid, pixelIdx));
+}
+
+/*
+ * Computes several features of 2D cellular noise in a single pass. See
+ * cellNoise2DFeaturesAt and storeCellFeatures.
+ * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
+ *   1.
+ * numPtsPerBox - Number of cell points in each grid box. Must be at least 1.
+ * distMetric - Indicates which distance metric to use.
+ * cellPts - Array containing the cell center points, grouped by grid box, or
+ *   null to generate the points from seedBase. See getCellPt2D.
+ * seedBase - Random seed of the cell points. Only used if cellPts is null.
+ * featureCodes - The packed features to store for each pixel.
+ * numFeatures - Number of features to store for each pixel.
+ * evalPts - Array containing the points at which to evaluate the noise.
+ * result - Array in which to store the results, with numFeatures channels per
+ *   pixel.
+ */
+__kernel void cellNoise2DFeatures(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID,
+  __global const real2 *cellPts, const uint seedBase,
+  const uint featureCodes, const uint numFeatures,
+  __global const real2 *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  cellFeatures features = cellNoise2DFeaturesAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts, seedBase,
+    evalPts[pixelIdx]);
+  storeCellFeatures(features, featureCodes, numFeatures,
+    numBoxesH * numBoxesH * numPtsPerBox, result, pixelIdx);
+}
+
+/*
+ * Like cellNoise2DFeatures, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void cellNoise2DFeaturesGrid(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID,
+  __global const real2 *cellPts, const uint seedBase,
+  const uint featureCodes, const uint numFeatures,
+  const implicitGrid grid, __global real *result)
 {
-  // Compute the evaluation point, normalized into the base square (unit square
-  // centered at (0.5, 0.5)).
   size_t pixelIdx = get_global_id(0);
-  double2 evalPt = evalPts[pixelIdx];
-  normalizeTexPt2D(&evalPt);
-  
-  double boxSize = 1.0 / numBoxesH;
-  
-  // Find the grid box containing the normalized evaluation point.
-  uint2 boxCoords = findBoxForPt2D(boxSize, evalPt);
-  
-  // Apply a modified Worley's algorithm to find the distance to the closest
-  // cell point.
-  double minDist = INFINITY;
-  for (int boxX = ((int) boxCoords.x) - 1; boxX <= (int) boxCoords.x + 1;
-    boxX++)
-  {
-    for (int boxY = ((int) boxCoords.y) - 1; boxY <= (int) boxCoords.y + 1;
-      boxY++)
-    {
-      uint2 ptIdxRange = getPtIdxRange(numBoxesH, numPtsPerBox,
-        (int2) (boxX, boxY));
-      for (uint ptIdx = ptIdxRange.x; ptIdx < ptIdxRange.y; ptIdx++) {
-        double2 cellPt = cellPts[ptIdx];
-        double2 delta = loopingDelta2D(evalPt, cellPt);
-        double newDist = computeDist2DDelta(metricID, delta);
-        if (newDist < minDist) {
-          // Uncommenting this line and commenting out other lines that modify
-          // result[pixelIdx] can be used to generate a voronoi diagram instead
-          // of cellular noise. Might be useful some time.
-          // result[pixelIdx] = ptIdx / (double) (numBoxesH * numBoxesH * numPtsPerBox);
-          minDist = newDist;
-        }
-      }
-    }
-  }
-  
-  result[pixelIdx] = minDist;
+  cellFeatures features = cellNoise2DFeaturesAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts, seedBase,
+    implicitGridPt2D(grid, pixelIdx));
+  storeCellFeatures(features, featureCodes, numFeatures,
+    numBoxesH * numBoxesH * numPtsPerBox, result, pixelIdx);
 }
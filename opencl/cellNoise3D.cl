@@ -1,25 +1,11 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "distMetrics.clh"
-#include "texCoordTransforms.clh"
-#include "gridCoordTransforms.clh"
-
-/*
- * Determines the range of indices in the cell point array at which to find the
- * cell points contained in the specified grid box. Returns the first index
- * and last index plus one as a uint2.
- */
-uint2 getPtIdxRange(uint numBoxesH, uint numPtsPerBox, int3 boxCoords)
-{
-  uint3 coords = normalizeBoxCoords3D(numBoxesH, boxCoords);
-  uint boxIdx = (coords.z * numBoxesH + coords.y) * numBoxesH + coords.x;
-  uint firstPtIdx = boxIdx * numPtsPerBox;
-  return (uint2) (firstPtIdx, firstPtIdx + numPtsPerBox);
-}
+#include "cellNoise3D.clh"
+#include "implicitGrid.clh"
 
 /*
  * Computes 3D cellular noise using a modified version of Worley's grid-based
- * cellular noise algorithm.
+ * cellular noise algorithm. See cellNoise3DAt.
  * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
  *   1.
  * numPtsPerBox - Number of cell points in each grid box. Must be at least 1.
@@ -32,49 +18,104 @@ uint2 getPtIdxRange(uint numBoxesH, uint numPtsPerBox, int3 boxCoords)
  *   by get_global_id[0] to determine where to store its result.
  */
 __kernel void cellNoise3D(const uint numBoxesH, const uint numPtsPerBox,
-  const distMetric metricID, __global const double *cellPts,
-  __global const double *evalPts, __global double *result)
+  const distMetric metricID, __global const real *cellPts,
+  __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise3DAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts,
+    vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like cellNoise3D, but computes the evaluation points from an implicit grid
+ * instead of reading them from memory.
+ * grid - Description of the 3D grid of evaluation points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void cellNoise3DGrid(const uint numBoxesH, const uint numPtsPerBox,
+  const distMetric metricID, __global const real *cellPts,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise3DAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts,
+    implicitGridPt3D(grid, pixelIdx));
+}
+
+/*
+ * Like cellNoise3D, but generates the cell points inside the kernel instead
+ * of reading them from memory. See cellNoise3DProceduralAt.
+ * seedBase - Random seed of the cell points.
+ */
+__kernel void cellNoise3DProcedural(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID, const uint seedBase,
+  __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise3DProceduralAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, seedBase,
+    vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like cellNoise3DProcedural, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void cellNoise3DProceduralGrid(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID, const uint seedBase,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellNoise3DProceduralAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, seedBase,
+    implicitGridPt3D(grid, pixelIdx));
+}
+
+/*
+ * Computes several features of 3D cellular noise in a single pass. See
+ * cellNoise3DFeaturesAt and storeCellFeatures.
+ * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
+ *   1.
+ * numPtsPerBox - Number of cell points in each grid box. Must be at least 1.
+ * distMetric - Indicates which distance metric to use.
+ * cellPts - Array containing the cell center points, grouped by grid box, or
+ *   null to generate the points from seedBase. See getCellPt3D.
+ * seedBase - Random seed of the cell points. Only used if cellPts is null.
+ * featureCodes - The packed features to store for each pixel.
+ * numFeatures - Number of features to store for each pixel.
+ * evalPts - Array containing the points at which to evaluate the noise.
+ * result - Array in which to store the results, with numFeatures channels per
+ *   pixel.
+ */
+__kernel void cellNoise3DFeatures(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID,
+  __global const real *cellPts, const uint seedBase,
+  const uint featureCodes, const uint numFeatures,
+  __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  cellFeatures features = cellNoise3DFeaturesAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts, seedBase,
+    vload3(pixelIdx, evalPts));
+  storeCellFeatures(features, featureCodes, numFeatures,
+    numBoxesH * numBoxesH * numBoxesH * numPtsPerBox, result, pixelIdx);
+}
+
+/*
+ * Like cellNoise3DFeatures, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void cellNoise3DFeaturesGrid(const uint numBoxesH,
+  const uint numPtsPerBox, const distMetric metricID,
+  __global const real *cellPts, const uint seedBase,
+  const uint featureCodes, const uint numFeatures,
+  const implicitGrid grid, __global real *result)
 {
-  // Compute the evaluation point, normalized into the base cube (unit cube
-  // centered at (0.5, 0.5, 0.5)).
   size_t pixelIdx = get_global_id(0);
-  double3 evalPt = vload3(pixelIdx, evalPts);
-  normalizeTexPt3D(&evalPt);
-  
-  double boxSize = 1.0 / numBoxesH;
-  
-  // Find the grid box containing the normalized evaluation point.
-  uint3 boxCoords = findBoxForPt3D(boxSize, evalPt);
-  
-  // Apply a modified Worley's algorithm to find the distance to the closest
-  // cell point.
-  double minDist = INFINITY;
-  for (int boxX = ((int) boxCoords.x) - 1; boxX <= (int) boxCoords.x + 1;
-    boxX++)
-  {
-    for (int boxY = ((int) boxCoords.y) - 1; boxY <= (int) boxCoords.y + 1;
-      boxY++)
-    {
-      for (int boxZ = ((int) boxCoords.z) - 1; boxZ <= (int) boxCoords.z + 1;
-        boxZ++)
-      {
-        uint2 ptIdxRange = getPtIdxRange(numBoxesH, numPtsPerBox,
-          (int3) (boxX, boxY, boxZ));
-        for (uint ptIdx = ptIdxRange.x; ptIdx < ptIdxRange.y; ptIdx++) {
-          double3 cellPt = vload3(ptIdx, cellPts);
-          double3 delta = loopingDelta3D(evalPt, cellPt);
-          double newDist = computeDist3DDelta(metricID, delta);
-          if (newDist < minDist) {
-            // Uncommenting this line and commenting out other lines that modify
-            // result[pixelIdx] can be used to generate a voronoi diagram instead
-            // of cellular noise. Might be useful some time.
-            // result[pixelIdx] = ptIdx / (double) (numBoxesH * numBoxesH * numBoxesH * numPtsPerBox);
-            minDist = newDist;
-          }
-        }
-      }
-    }
-  }
-  
-  result[pixelIdx] = minDist;
+  cellFeatures features = cellNoise3DFeaturesAt(numBoxesH,
+    specializedPtsPerBox(numPtsPerBox), metricID, cellPts, seedBase,
+    implicitGridPt3D(grid, pixelIdx));
+  storeCellFeatures(features, featureCodes, numFeatures,
+    numBoxesH * numBoxesH * numBoxesH * numPtsPerBox, result, pixelIdx);
 }
@@ -0,0 +1,67 @@
+#include "real.clh"
+
+#include "fractalNoise3D.clh"
+#include "implicitGrid.clh"
+
+/*
+ * Computes several octaves of 3D cellular noise in a single pass. See
+ * cellFractalNoise3DAt.
+ * evalPts - Array containing the 3D points at which to evaluate the noise. Each
+ *   worker indexes this array by get_global_id[0] to determine its evaluation
+ *   point.
+ * result - Array in which to store the result. Each worker indexes this array
+ *   by get_global_id[0] to determine where to store its result.
+ */
+__kernel void cellFractalNoise3D(const uint numOctaves,
+  __global const uint *octaves, __global const real *octaveScales,
+  const distMetric metricID, __global const real *cellPts,
+  __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellFractalNoise3DAt(numOctaves, octaves, octaveScales,
+    metricID, cellPts, vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like cellFractalNoise3D, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ * grid - Description of the 3D grid of evaluation points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void cellFractalNoise3DGrid(const uint numOctaves,
+  __global const uint *octaves, __global const real *octaveScales,
+  const distMetric metricID, __global const real *cellPts,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = cellFractalNoise3DAt(numOctaves, octaves, octaveScales,
+    metricID, cellPts, implicitGridPt3D(grid, pixelIdx));
+}
+
+/*
+ * Computes several octaves of 3D Perlin noise in a single pass. See
+ * perlinFractalNoise3DAt and cellFractalNoise3D.
+ */
+__kernel void perlinFractalNoise3D(const uint numOctaves,
+  __global const uint *octaves, __global const real *octaveScales,
+  __global const real *gradients, __global const real *evalPts,
+  __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = perlinFractalNoise3DAt(numOctaves, octaves,
+    octaveScales, gradients, vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like perlinFractalNoise3D, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void perlinFractalNoise3DGrid(const uint numOctaves,
+  __global const uint *octaves, __global const real *octaveScales,
+  __global const real *gradients, const implicitGrid grid,
+  __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = perlinFractalNoise3DAt(numOctaves, octaves,
+    octaveScales, gradients, implicitGridPt3D(grid, pixelIdx));
+}
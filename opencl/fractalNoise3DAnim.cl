@@ -0,0 +1,63 @@
+#include "real.clh"
+
+#include "cellNoise3DAnim.clh"
+
+/*
+ * Finds the octave containing a cell point of cellFractalNoise3DAt. Octaves
+ * are ordered by the index of their first cell point.
+ */
+uint findCellOctave(const uint numOctaves, __global const uint *octaves,
+  uint ptIdx)
+{
+  uint octaveIdx = 0;
+  while (octaveIdx + 1 < numOctaves
+    && ptIdx >= vload3(octaveIdx + 1, octaves).z)
+  {
+    octaveIdx++;
+  }
+  return octaveIdx;
+}
+
+/*
+ * Randomly initializes positions and velocities of the cell points of all the
+ * octaves of cellFractalNoise3DAt, like cellNoise3DAnimInit. The random
+ * generator of each point is seeded by its index in the whole array.
+ * seedBase - Random seed. This will be combined with the worker ID to generate
+ *   a separate seed for each worker.
+ * numOctaves - Number of octaves.
+ * octaves - Array describing the octaves. See cellFractalNoise3DAt.
+ * maxSpeed - Maximum allowed speed for cell points, in space units per frame.
+ * cellPts - Array containing the cell points of all the octaves. Initial
+ *   positions will be stored here.
+ * cellPtVels - Array containing the cell point velocities. Initial velocities
+ *   will be stored here. Units are space units per frame.
+ */
+__kernel void cellFractalNoise3DAnimInit(uint seedBase, uint numOctaves,
+  __global const uint *octaves, real maxSpeed, __global real *cellPts,
+  __global real *cellPtVels)
+{
+  size_t ptIdx = get_global_id(0);
+  uint3 octave = vload3(findCellOctave(numOctaves, octaves, ptIdx), octaves);
+  cellNoise3DAnimInitPt(seedBase, octave.x, octave.y, maxSpeed,
+    ptIdx - octave.z, ptIdx, cellPts + 3 * octave.z,
+    cellPtVels + 3 * octave.z);
+}
+
+/*
+ * Updates positions of the cell points of all the octaves of
+ * cellFractalNoise3DAt, like cellNoise3DAnimUpdate. See
+ * cellFractalNoise3DAnimInit.
+ * frameIdx - Index of the frame being generated.
+ * maxAccel - Maximum allowed acceleration for cell points, in space units per
+ *   frame squared.
+ */
+__kernel void cellFractalNoise3DAnimUpdate(uint seedBase, uint frameIdx,
+  uint numOctaves, __global const uint *octaves, real maxSpeed,
+  real maxAccel, __global real *cellPts, __global real *cellPtVels)
+{
+  size_t ptIdx = get_global_id(0);
+  uint3 octave = vload3(findCellOctave(numOctaves, octaves, ptIdx), octaves);
+  cellNoise3DAnimUpdatePt(seedBase, frameIdx, octave.x, octave.y, maxSpeed,
+    maxAccel, ptIdx - octave.z, ptIdx, cellPts + 3 * octave.z,
+    cellPtVels + 3 * octave.z);
+}
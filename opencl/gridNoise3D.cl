@@ -1,13 +1,13 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "random.clh"
-#include "texCoordTransforms.clh"
-#include "gridCoordTransforms.clh"
+#include "gridNoise3D.clh"
+#include "implicitGrid.clh"
 
 /*
- * Computes simple 3D grid noise.
- * seedBase - Random seed. Will be combined with the grid box coordinates to get
- *   a consistent value for each grid box.
+ * Computes simple 3D grid noise. See gridNoise3DAt.
+ * seedBase - Random seed. Will be combined with the grid box coordinates and
+ *   frame index to get a consistent value for each grid box in each frame.
+ * frameIdx - Index of the animation frame.
  * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
  *   1.
  * evalPts - Array containing the 3D points at which to evaluate the noise. Each
@@ -16,24 +16,24 @@
  * result - Array in which to store the result. Each worker indexes this array
  *   by get_global_id(0) to determine where to store its result.
  */
-__kernel void gridNoise3D(uint seedBase, uint numBoxesH,
-  __global const double *evalPts, __global double *result)
+__kernel void gridNoise3D(uint seedBase, uint frameIdx, uint numBoxesH,
+  __global const real *evalPts, __global real *result)
 {
-  // Compute the evaluation point, normalized into the base cube (unit cube
-  // centered at (0.5, 0.5, 0.5)).
   size_t pixelIdx = get_global_id(0);
-  double3 evalPt = vload3(pixelIdx, evalPts);
-  normalizeTexPt3D(&evalPt);
-  
-  double boxSize = 1.0 / numBoxesH;
-  
-  // Find the grid box containing the normalized evaluation point.
-  uint3 boxCoords = findBoxForPt3D(boxSize, evalPt);
-  
-  // Seed by the box coordinates instead of the worker ID so that the same value
-  // will be generated for pixels in the same grid box.
-  uint seed = initWorkerSeed(seedBase,
-    (boxCoords.z * numBoxesH + boxCoords.y) * numBoxesH + boxCoords.x);
-  
-  result[pixelIdx] = randDouble(&seed);
+  result[pixelIdx] = gridNoise3DAt(seedBase, frameIdx, numBoxesH,
+    vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like gridNoise3D, but computes the evaluation points from an implicit grid
+ * instead of reading them from memory.
+ * grid - Description of the 3D grid of evaluation points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void gridNoise3DGrid(uint seedBase, uint frameIdx, uint numBoxesH,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = gridNoise3DAt(seedBase, frameIdx, numBoxesH,
+    implicitGridPt3D(grid, pixelIdx));
 }
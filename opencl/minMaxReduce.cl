@@ -0,0 +1,71 @@
+#include "real.clh"
+
+#include "minMax.clh"
+
+/*
+ * Reduces the (min, max) pairs in local memory to a single pair, stored in
+ * scratch[0]. The local work size must be a power of two.
+ */
+void reduceLocalMinMax(__local real2 *scratch)
+{
+  size_t localIdx = get_local_id(0);
+  for (size_t stride = get_local_size(0) / 2; stride > 0; stride /= 2) {
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (localIdx < stride) {
+      scratch[localIdx] = combineMinMax(scratch[localIdx],
+        scratch[localIdx + stride]);
+    }
+  }
+  barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+/*
+ * First pass of a parallel min/max reduction. Each work group reduces a strided
+ * subset of the values to a single (min, max) pair.
+ * numVals - Number of values to reduce.
+ * vals - Array containing the values to reduce.
+ * partials - Array in which to store the (min, max) pair for each work group.
+ * scratch - Local memory with room for one (min, max) pair per work item.
+ */
+__kernel void minMaxReducePartial(ulong numVals, __global const real *vals,
+  __global real2 *partials, __local real2 *scratch)
+{
+  real2 range = (real2) (INFINITY, -INFINITY);
+  for (size_t idx = get_global_id(0); idx < numVals;
+    idx += get_global_size(0))
+  {
+    range = combineMinMax(range, (real2) (vals[idx], vals[idx]));
+  }
+  scratch[get_local_id(0)] = range;
+  reduceLocalMinMax(scratch);
+  
+  if (get_local_id(0) == 0) {
+    partials[get_group_id(0)] = scratch[0];
+  }
+}
+
+/*
+ * Second pass of a parallel min/max reduction. Must be run as a single work
+ * group. Combines the results of minMaxReducePartial.
+ * numPartials - Number of (min, max) pairs produced by the first pass.
+ * partials - Array containing the (min, max) pairs from the first pass.
+ * result - Array in which to store the final (min, max) pair.
+ * scratch - Local memory with room for one (min, max) pair per work item.
+ */
+__kernel void minMaxReduceFinal(uint numPartials,
+  __global const real2 *partials, __global real2 *result,
+  __local real2 *scratch)
+{
+  real2 range = (real2) (INFINITY, -INFINITY);
+  for (uint idx = get_local_id(0); idx < numPartials;
+    idx += get_local_size(0))
+  {
+    range = combineMinMax(range, partials[idx]);
+  }
+  scratch[get_local_id(0)] = range;
+  reduceLocalMinMax(scratch);
+  
+  if (get_local_id(0) == 0) {
+    result[0] = scratch[0];
+  }
+}
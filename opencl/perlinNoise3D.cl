@@ -1,35 +1,10 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "distMetrics.clh"
-#include "texCoordTransforms.clh"
-#include "gridCoordTransforms.clh"
-
-double gradDotProd(uint numBoxesH, double boxSize, uint3 boxCoords,
-  double3 evalPt, __global const double *gradients)
-{
-  uint boxIdx = ((boxCoords.z * numBoxesH) + boxCoords.y) * numBoxesH
-    + boxCoords.x;
-  
-  double3 gradPos = convert_double3(boxCoords) * boxSize;
-  double3 gradient = vload3(boxIdx, gradients);
-  
-  // Find smallest displacement, taking spatial looping into account.
-  double3 displacement = evalPt - gradPos;
-  if (displacement.x > 0.5) {
-    displacement.x = displacement.x - 1;
-  }
-  if (displacement.y > 0.5) {
-    displacement.y = displacement.y - 1;
-  }
-  if (displacement.z > 0.5) {
-    displacement.z = displacement.z - 1;
-  }
-  
-  return dot(displacement, gradient);
-}
+#include "perlinNoise3D.clh"
+#include "implicitGrid.clh"
 
 /*
- * Computes 3D Perlin-like noise.
+ * Computes 3D Perlin-like noise. See perlinNoise3DAt.
  * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
  *   1.
  * gradients - Array containing the gradient vectors, grouped by grid box.
@@ -39,46 +14,54 @@ double gradDotProd(uint numBoxesH, double boxSize, uint3 boxCoords,
  * result - Array in which to store the result. Each worker indexes this array
  *   by get_global_id[0] to determine where to store its result.
  */
-__kernel void perlinNoise3D(uint numBoxesH, __global const double *gradients,
-  __global const double *evalPts, __global double *result)
+__kernel void perlinNoise3D(uint numBoxesH, __global const real *gradients,
+  __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = perlinNoise3DAt(numBoxesH, gradients,
+    vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like perlinNoise3D, but computes the evaluation points from an implicit grid
+ * instead of reading them from memory.
+ * grid - Description of the 3D grid of evaluation points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void perlinNoise3DGrid(uint numBoxesH,
+  __global const real *gradients, const implicitGrid grid,
+  __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = perlinNoise3DAt(numBoxesH, gradients,
+    implicitGridPt3D(grid, pixelIdx));
+}
+
+/*
+ * Computes 3D Perlin-like noise with hashed gradients. See
+ * perlinNoise3DHashedAt.
+ * numBoxesH - Number of grid box spaces lying along each axis. Must be at least
+ *   1.
+ * seedBase, keyIdx, keyFrac - See hashedGradient3D.
+ * evalPts - Array containing the 3D points at which to evaluate the noise.
+ * result - Array in which to store the result.
+ */
+__kernel void perlinNoise3DHashed(uint numBoxesH, uint seedBase, uint keyIdx,
+  real keyFrac, __global const real *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  result[pixelIdx] = perlinNoise3DHashedAt(numBoxesH, seedBase, keyIdx,
+    keyFrac, vload3(pixelIdx, evalPts));
+}
+
+/*
+ * Like perlinNoise3DHashed, but computes the evaluation points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void perlinNoise3DHashedGrid(uint numBoxesH, uint seedBase,
+  uint keyIdx, real keyFrac, const implicitGrid grid, __global real *result)
 {
-  // Compute the evaluation point, normalized into the base cube (unit cube
-  // centered at (0.5, 0.5, 0.5)).
   size_t pixelIdx = get_global_id(0);
-  double3 evalPt = vload3(pixelIdx, evalPts);
-  normalizeTexPt3D(&evalPt);
-  
-  double boxSize = 1.0 / numBoxesH;
-  
-  // Find the grid box containing the normalized evaluation point.
-  uint3 boxCoords = findBoxForPt3D(boxSize, evalPt);
-  
-  // Compute interpolation factors.
-  double3 relEvalPt = evalPt / boxSize - floor(evalPt / boxSize);
-  double lerpFacX = 1 - smoothstep(0, 1, relEvalPt.x);
-  double lerpFacY = 1 - smoothstep(0, 1, relEvalPt.y);
-  double lerpFacZ = 1 - smoothstep(0, 1, relEvalPt.z);
-  
-  // Compute interpolated value for Perlin noise.
-  double resultVal = 0;
-  uint boxX, boxY, boxZ;
-  double currLerpFacX, currLerpFacY, currLerpFacZ;
-  for (boxX = boxCoords.x, currLerpFacX = lerpFacX;
-    boxX <= boxCoords.x + 1; boxX++, currLerpFacX = 1 - currLerpFacX)
-  {
-    for (boxY = boxCoords.y, currLerpFacY = lerpFacY;
-      boxY <= boxCoords.y + 1; boxY++, currLerpFacY = 1 - currLerpFacY)
-    {
-      for (boxZ = boxCoords.z, currLerpFacZ = lerpFacZ;
-        boxZ <= boxCoords.z + 1; boxZ++, currLerpFacZ = 1 - currLerpFacZ)
-      {
-        resultVal += currLerpFacX * currLerpFacY * currLerpFacZ
-          * gradDotProd(numBoxesH, boxSize,
-              normalizeBoxCoords3D(numBoxesH, (int3) (boxX, boxY, boxZ)),
-              evalPt, gradients);
-      }
-    }
-  }
-  
-  result[pixelIdx] = resultVal;
+  result[pixelIdx] = perlinNoise3DHashedAt(numBoxesH, seedBase, keyIdx,
+    keyFrac, implicitGridPt3D(grid, pixelIdx));
 }
@@ -1,36 +1,23 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "random.clh"
+#include "perlinNoise3D.clh"
 
 /*
- * Randomly initializes gradients for 3D Perlin noise.
- * seedBase - Random seed. This will be combined with the worker ID to generate
- *   a separate seed for each worker.
- * gradients - Initial gradients will be stored here.
+ * Generates the gradients for 3D Perlin noise at a frame with
+ * hashedGradient3D. The gradients of each frame depend only on the seed and
+ * the animation key, so frames can be generated in any order.
+ * seedBase - Random seed. This will be combined with the worker ID and key
+ *   index to generate a separate seed for each worker.
+ * keyIdx - Index of the animation key at or before the frame. Equal to the
+ *   frame index if every frame is a key.
+ * keyFrac - Position of the frame between key keyIdx and the next key, in
+ *   [0, 1).
+ * gradients - The generated gradients will be stored here.
  */
-__kernel void perlinNoise3DAnimInit(uint seedBase, __global double *gradients) {
-  size_t gradientIdx = get_global_id(0);
-  uint seed = initWorkerSeed(seedBase, gradientIdx);
-  
-  // Generate random initial gradient.
-  double3 gradient = randVecWithMagnitude3D(&seed, 1);
-  vstore3(gradient, gradientIdx, gradients);
-}
-
-/*
- * Updates gradients for 3D Perlin noise.
- * seedBase - Random seed. This will be combined with the worker ID to generate
- *   a separate seed for each worker.
- * gradients - Array of gradients. Will be updated with the new gradients.
- */
-__kernel void perlinNoise3DAnimUpdate(uint seedBase, __global double *gradients)
+__kernel void perlinNoise3DAnimUpdate(uint seedBase, uint keyIdx,
+  real keyFrac, __global real *gradients)
 {
-  // TODO: The new gradients should be partly based on the old gradients.
-  
   size_t gradientIdx = get_global_id(0);
-  uint seed = initWorkerSeed(seedBase, gradientIdx);
-  
-  // Compute the new gradient.
-  double3 gradient = randVecWithMagnitude3D(&seed, 1);
-  vstore3(gradient, gradientIdx, gradients);
+  vstore3(hashedGradient3D(seedBase, gradientIdx, keyIdx, keyFrac),
+    gradientIdx, gradients);
 }
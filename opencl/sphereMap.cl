@@ -1,10 +1,11 @@
-#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#include "real.clh"
 
-#include "texCoordTransforms.clh"
+#include "sphereMap.clh"
+#include "implicitGrid.clh"
 
 /*
  * Converts texture coordinates for a 2D sphere-mapped texture to the
- * corresponding coordinates for a 3D texture.
+ * corresponding coordinates for a 3D texture. See sphereMapTo3DAt.
  * radius - Radius of the sphere.
  * center - Center of the sphere.
  * evalPts - Array containing the sphere-mapped points to convert. Each worker
@@ -12,17 +13,72 @@
  * result - Array in which to store the result. Each worker indexes this array
  *   by get_global_id(0) to determine where to store its result.
  */
-__kernel void sphereMapTo3D(double radius, double3 center,
-  __global const double2 *evalPts, __global double *result)
+__kernel void sphereMapTo3D(real radius, real3 center,
+  __global const real2 *evalPts, __global real *result)
 {
-  // Compute the evaluation point, normalized into the base square (unit square
-  // centered at (0.5, 0.5)).
   size_t pixelIdx = get_global_id(0);
-  double2 evalPt = evalPts[pixelIdx];
-  normalizeTexPt2D(&evalPt);
-  
-  // Compute the Cartesian position corresponding to the evaluation point.
-  double3 evalPtCart = texSphericalToCartesian(evalPt, 0.5) + center;
-  
-  vstore3(evalPtCart, pixelIdx, result);
+  vstore3(sphereMapTo3DAt(radius, center, evalPts[pixelIdx]), pixelIdx, result);
+}
+
+/*
+ * Like sphereMapTo3D, but computes the sphere-mapped points from an implicit
+ * grid instead of reading them from memory.
+ * grid - Description of the 2D grid of sphere-mapped points. Each worker uses
+ *   the point with index get_global_id(0).
+ */
+__kernel void sphereMapTo3DGrid(real radius, real3 center,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  vstore3(sphereMapTo3DAt(radius, center, implicitGridPt2D(grid, pixelIdx)),
+    pixelIdx, result);
+}
+
+/*
+ * Converts texture coordinates for a 2D cube-mapped texture to the
+ * corresponding coordinates for a 3D texture. See cubeMapTo3DAt and
+ * sphereMapTo3D.
+ */
+__kernel void cubeMapTo3D(const int equiAngular, real3 center,
+  __global const real2 *evalPts, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  vstore3(cubeMapTo3DAt(center, equiAngular, evalPts[pixelIdx]), pixelIdx,
+    result);
+}
+
+/*
+ * Like cubeMapTo3D, but computes the cube-mapped points from an implicit grid
+ * instead of reading them from memory.
+ */
+__kernel void cubeMapTo3DGrid(const int equiAngular, real3 center,
+  const implicitGrid grid, __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  vstore3(cubeMapTo3DAt(center, equiAngular,
+    implicitGridPt2D(grid, pixelIdx)), pixelIdx, result);
+}
+
+/*
+ * Converts texture coordinates for a 2D octahedral-mapped texture to the
+ * corresponding coordinates for a 3D texture. See octahedralMapTo3DAt and
+ * sphereMapTo3D.
+ */
+__kernel void octahedralMapTo3D(real3 center, __global const real2 *evalPts,
+  __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  vstore3(octahedralMapTo3DAt(center, evalPts[pixelIdx]), pixelIdx, result);
+}
+
+/*
+ * Like octahedralMapTo3D, but computes the octahedral-mapped points from an
+ * implicit grid instead of reading them from memory.
+ */
+__kernel void octahedralMapTo3DGrid(real3 center, const implicitGrid grid,
+  __global real *result)
+{
+  size_t pixelIdx = get_global_id(0);
+  vstore3(octahedralMapTo3DAt(center, implicitGridPt2D(grid, pixelIdx)),
+    pixelIdx, result);
 }
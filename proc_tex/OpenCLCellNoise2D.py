@@ -6,21 +6,35 @@ import numpy
 import pyopencl
 
 from proc_tex.texture_base import Texture
+import proc_tex.cell_features
 import proc_tex.dist_metrics
+import proc_tex.numpy_noise
 
-_NUM_CHANNELS = 1
-_DTYPE = numpy.float64
 _NUM_SPACE_DIMS = 2
+# Number of grid boxes searched for the closest cell point.
+_NUM_NEIGHBOR_BOXES = 3 ** _NUM_SPACE_DIMS
+# Largest number of points per grid box for which the noise programs are
+# specialized, so that the loops over the points of a box can be unrolled.
+# Larger numbers gain little from unrolling.
+_MAX_SPECIALIZED_PTS_PER_BOX = 16
 
 class OpenCLCellNoise2D(Texture):
   """Computes 2D cellular noise.
   Uses a modified version of Worley's grid-based cellular noise algorithm.
-  Animation causes the cell points to move randomly."""
-  def __init__(self, cl_context, num_boxes_h, pts_per_box,
+  Animation causes the cell points to move randomly.
+  By default, the noise is the distance to the closest cell point. Other
+  features, such as the distance to the second closest point or the ID of the
+  closest point's cell, can be selected instead, or as additional channels
+  that are computed in the same pass."""
+  def __init__(self, cl_runtime, num_boxes_h, pts_per_box,
     metric = proc_tex.dist_metrics.METRIC_DEFAULT, point_max_speed=0.01,
-    point_max_accel=0.005, allow_anim=True):
+    point_max_accel=0.005, allow_anim=True, dtype=None,
+    backend=proc_tex.numpy_noise.BACKEND_AUTO,
+    features=proc_tex.cell_features.FEATURES_DEFAULT, procedural_pts=False,
+    minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
     """Initializer.
-    cl_context - The PyOpenCL context to use for computation.
+    cl_runtime - The OpenCLRuntime to use for computation, or None to compute
+      with Numpy only.
     num_boxes_h - The width and height (both the same) of the grid, in number of
       grid boxes. Should be at least 1.
     pts_per_box - The number of cell points per grid box. Should be at least 1.
@@ -29,104 +43,285 @@ class OpenCLCellNoise2D(Texture):
     point_max_speed - Maximum point speed, in space units per frame.
     point_max_accel - Maximum point acceleration, in space units per frame
       squared.
-    allow_anim - If false, the noise will not be animated."""
-    super(OpenCLCellNoise2D, self).__init__(_NUM_CHANNELS, _NUM_SPACE_DIMS)
-    
+    allow_anim - If false, the noise will not be animated.
+    dtype - Floating point dtype for computation and results, numpy.float32 or
+      numpy.float64. If None, cl_runtime.dtype is used, or numpy.float64
+      without a runtime.
+    backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+      selects whether to evaluate with the OpenCL kernels or with Numpy. The
+      animation state stays in OpenCL buffers if there is a runtime.
+    features - Sequence of FEATURE_* constants from proc_tex.cell_features
+      selecting the feature computed for each output channel.
+    procedural_pts - If true, the cell points are not stored, but are
+      generated from a hash of the seed inside the noise kernels whenever they
+      are needed. This needs no memory for the cell points, which matters for
+      fine grids, but costs more arithmetic per evaluation. The noise is the
+      same as with allow_anim false. Procedural cell points cannot be
+      animated.
+    minkowski_p - Exponent of the distance metric if metric is
+      METRIC_MINKOWSKI. Should be at least 1."""
     if pts_per_box <= 0:
       raise ValueError("Must have at least one point per grid box.")
+    proc_tex.dist_metrics.check_metric(metric, minkowski_p)
+    if procedural_pts and allow_anim:
+      raise ValueError("Procedural cell points cannot be animated.")
+    num_grid_boxes = num_boxes_h ** _NUM_SPACE_DIMS
+    features = proc_tex.cell_features.check_features(features,
+      num_grid_boxes * pts_per_box)
+    
+    super(OpenCLCellNoise2D, self).__init__(len(features), _NUM_SPACE_DIMS)
     
-    self.cl_context = cl_context
+    proc_tex.numpy_noise.check_backend(backend, cl_runtime)
+    self.cl_runtime = cl_runtime
+    self.cl_context = None if cl_runtime is None else cl_runtime.cl_context
+    self.dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+    self.backend = backend
     self.num_boxes_h = num_boxes_h
     self.box_width = 1 / num_boxes_h
     self.pts_per_box = pts_per_box
     self.metric = metric
+    self.minkowski_p = minkowski_p
+    # Fused programs are not specialized for a metric, so they use the default
+    # Minkowski exponent (see distMetrics.clh).
+    self.cl_fusible = metric != proc_tex.dist_metrics.METRIC_MINKOWSKI \
+      or minkowski_p == proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT
     self.point_max_speed = point_max_speed
     self.point_max_accel = point_max_accel
     self.allow_anim = allow_anim
+    self.features = features
+    self.procedural_pts = procedural_pts
     
-    # Precompile the OpenCL programs.
-    with open('opencl/cellNoise2D.cl', 'r', encoding='utf-8') as program_file:
-      self.cl_program_noise = pyopencl.Program(self.cl_context, program_file.read()) \
-        .build(options=['-I', 'opencl/include/'])
-    with open('opencl/cellNoise2DAnim.cl', 'r', encoding='utf-8') as program_file:
-      self.cl_program_anim = pyopencl.Program(self.cl_context, program_file.read()) \
-        .build(options=['-I', 'opencl/include/'])
-    
-    # Generate the Numpy array of cell points.
-    seed = random.randrange(0, 2 ** 32)
-    num_grid_boxes = num_boxes_h * num_boxes_h
-    self.cell_pts = numpy.empty((num_grid_boxes * pts_per_box, 2),
-      dtype=numpy.float64)
-    self.cell_vels = numpy.empty_like(self.cell_pts)
-    cell_pts_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=self.cell_pts)
-    cell_vels_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=self.cell_vels)
-    with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-      self.cl_program_anim.cellNoise2DAnimInit(cl_queue,
-        (self.cell_pts.shape[0],), None, numpy.uint32(seed),
-        numpy.uint32(self.num_boxes_h), numpy.uint32(self.pts_per_box),
-        numpy.float64(self.point_max_speed), cell_pts_buffer, cell_vels_buffer)
+    self.seed = random.randrange(0, 2 ** 32)
+    self.num_cell_pts = num_grid_boxes * pts_per_box
+    # Host copies of the cell points and velocities. Without a runtime, these
+    # are the animation state. Otherwise the state lives in OpenCL buffers for
+    # the lifetime of the texture (see get_cell_pts and get_cell_vels), and the
+    # cell points are only copied to host memory when Numpy evaluation first
+    # needs them in a frame. Procedural cell points are never stored; Numpy
+    # evaluation generates those of the grid boxes around each chunk of
+    # evaluation points.
+    self._host_cell_pts = None
+    self._host_cell_vels = None
+    self.cell_pts_buffer = None
+    self.cell_vels_buffer = None
+    if cl_runtime is not None:
+      # Get the OpenCL programs. These are only compiled the first time they
+      # are used with a given runtime and device; see
+      # OpenCLRuntime.get_program. The noise program is specialized for the
+      # distance metric and the number of points per grid box, and a separate
+      # program is built for each combination.
+      noise_options = proc_tex.dist_metrics.build_options(metric,
+        minkowski_p)
+      if pts_per_box <= _MAX_SPECIALIZED_PTS_PER_BOX:
+        noise_options += ['-D', 'CELL_PTS_PER_BOX={}'.format(pts_per_box)]
+      self.cl_program_noise = self.cl_runtime.get_program(
+        'opencl/cellNoise2D.cl', noise_options, dtype=self.dtype)
+    if procedural_pts:
+      # The noise kernels generate the cell points; see getCellPt2D.
+      pass
+    elif cl_runtime is None:
+      self._host_cell_pts, self._host_cell_vels = \
+        proc_tex.numpy_noise.cell_noise_anim_init(self.seed, num_boxes_h,
+        pts_per_box, _NUM_SPACE_DIMS, point_max_speed, self.dtype)
+    else:
+      self.cl_program_anim = self.cl_runtime.get_program(
+        'opencl/cellNoise2DAnim.cl', dtype=self.dtype)
       
-      pyopencl.enqueue_copy(cl_queue, self.cell_pts, cell_pts_buffer)
-      pyopencl.enqueue_copy(cl_queue, self.cell_vels, cell_vels_buffer)
+      # Generate the cell points and velocities.
+      cell_pts_size_bytes = self.num_cell_pts * 2 * self.dtype.itemsize
+      self.cell_pts_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_WRITE, cell_pts_size_bytes)
+      self.cell_vels_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_WRITE, cell_pts_size_bytes)
+      self.cl_runtime.run_kernel(self.cl_runtime.get_kernel(
+        self.cl_program_anim, 'cellNoise2DAnimInit'), (self.num_cell_pts,),
+        None, numpy.uint32(self.seed), numpy.uint32(self.num_boxes_h),
+        numpy.uint32(self.pts_per_box),
+        self.dtype.type(self.point_max_speed), self.cell_pts_buffer,
+        self.cell_vels_buffer)
   
   def evaluate(self, eval_pts):
-    # TODO: Figure out how to make this work with multiple devices
-    # simultaneously. Might require splitting up the tasks.
+    only_f1 = self.features == proc_tex.cell_features.FEATURES_DEFAULT
+    num_pts = int(numpy.prod(eval_pts.shape[:-1]))
+    if proc_tex.numpy_noise.use_numpy(self.backend, self.cl_runtime,
+      num_pts * _NUM_NEIGHBOR_BOXES * self.pts_per_box):
+      return self._evaluate_numpy(eval_pts, only_f1)
     
     # Create Numpy array for the results.
-    result_shape = eval_pts.shape[:-1] + (_NUM_CHANNELS,)
-    result_array = numpy.empty(result_shape, dtype=_DTYPE)
-    result_size_bytes = result_array.nbytes
-    
-    # Make sure eval_pts has the required memory layout.
-    eval_pts = numpy.ascontiguousarray(eval_pts)
-    
-    # Create buffers for the OpenCL kernels.
-    eval_pts_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=eval_pts)
-    cell_pts_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=self.cell_pts)
-    result_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY, result_size_bytes)
+    result_shape = eval_pts.shape[:-1] + (self.num_channels,)
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
     
-    with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-      self.cl_program_noise.cellNoise2D(cl_queue, (result_array.size,), None,
+    # Borrow buffers for the OpenCL kernels from the runtime's pool.
+    # Implicit grids of evaluation points are computed on the device instead
+    # of being uploaded.
+    with self.cl_runtime.eval_pts_arg(eval_pts, self.dtype) \
+      as (is_grid, eval_pts_arg), \
+      self.cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      if only_f1 and self.procedural_pts:
+        kernel_name = 'cellNoise2DProcedural'
+        pts_args = (numpy.uint32(self.seed),)
+        feature_args = ()
+      elif only_f1:
+        kernel_name = 'cellNoise2D'
+        pts_args = (self.cell_pts_buffer,)
+        feature_args = ()
+      else:
+        # All the features are found in a single search of the cell points.
+        kernel_name = 'cellNoise2DFeatures'
+        # A null cell points buffer makes the kernel generate the points.
+        pts_args = (self.cell_pts_buffer, numpy.uint32(self.seed))
+        feature_args = (numpy.uint32(
+          proc_tex.cell_features.pack_features(self.features)),
+          numpy.uint32(self.num_channels))
+      kernel = self.cl_runtime.get_kernel(self.cl_program_noise,
+        kernel_name + 'Grid' if is_grid else kernel_name)
+      self.cl_runtime.run_kernel(kernel, (num_pts,), None,
         numpy.uint32(self.num_boxes_h), numpy.uint32(self.pts_per_box),
-        numpy.uint32(self.metric), cell_pts_buffer, eval_pts_buffer,
+        numpy.uint32(self.metric), *(pts_args + feature_args), eval_pts_arg,
         result_buffer)
       
-      pyopencl.enqueue_copy(cl_queue, result_array, result_buffer)
+      self.cl_runtime.download(result_array, result_buffer)
     
     return result_array
-    
+  
   
   def step_frame(self):
-    if self.allow_anim:
-      seed = random.randrange(0, 2 ** 32)
-      
-      # Create buffers for the OpenCL kernels.
-      cell_pts_buffer = pyopencl.Buffer(self.cl_context,
-        pyopencl.mem_flags.READ_WRITE | pyopencl.mem_flags.COPY_HOST_PTR,
-        hostbuf=self.cell_pts)
-      cell_vels_buffer = pyopencl.Buffer(self.cl_context,
-        pyopencl.mem_flags.READ_WRITE | pyopencl.mem_flags.COPY_HOST_PTR,
-        hostbuf=self.cell_vels)
-      
-      with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-        self.cl_program_anim.cellNoise2DAnimUpdate(cl_queue,
-          (self.cell_pts.shape[0],), None, numpy.uint32(seed),
-          numpy.uint32(self.num_boxes_h), numpy.uint32(self.pts_per_box),
-          numpy.float64(self.point_max_speed),
-          numpy.float64(self.point_max_accel), cell_pts_buffer, cell_vels_buffer)
-        
-        pyopencl.enqueue_copy(cl_queue, self.cell_pts, cell_pts_buffer)
-        pyopencl.enqueue_copy(cl_queue, self.cell_vels, cell_vels_buffer)
+    if self.allow_anim and self.cl_runtime is None:
+      proc_tex.numpy_noise.cell_noise_anim_update(self.seed,
+        self.curr_frame + 1, self.num_boxes_h, self.pts_per_box,
+        self.point_max_speed, self.point_max_accel, self._host_cell_pts,
+        self._host_cell_vels)
+    elif self.allow_anim:
+      # The cell points are updated in place on the OpenCL device. The random
+      # accelerations are a function of the seed and frame index.
+      self.cl_runtime.run_kernel(
+        self.cl_runtime.get_kernel(self.cl_program_anim,
+        'cellNoise2DAnimUpdate'), (self.num_cell_pts,), None,
+        numpy.uint32(self.seed),
+        numpy.uint32(self.curr_frame + 1), numpy.uint32(self.num_boxes_h),
+        numpy.uint32(self.pts_per_box),
+        self.dtype.type(self.point_max_speed),
+        self.dtype.type(self.point_max_accel), self.cell_pts_buffer,
+        self.cell_vels_buffer)
+      self._host_cell_pts = None
+  
+  def get_anim_state(self):
+    if self.procedural_pts:
+      # Procedural cell points are a function of the seed alone.
+      return None
+    return (self.get_cell_pts(), self.get_cell_vels())
+  
+  def set_anim_state(self, state):
+    if self.procedural_pts:
+      return
+    cell_pts, cell_vels = state
+    if self.cl_runtime is None:
+      self._host_cell_pts = numpy.array(cell_pts, dtype=self.dtype)
+      self._host_cell_vels = numpy.array(cell_vels, dtype=self.dtype)
+      return
+    self._host_cell_pts = None
+    self.cl_runtime.upload_to(self.cell_pts_buffer,
+      numpy.asarray(cell_pts, dtype=self.dtype))
+    self.cl_runtime.upload_to(self.cell_vels_buffer,
+      numpy.asarray(cell_vels, dtype=self.dtype))
+  
+  def analytic_value_range(self):
+    return proc_tex.cell_features.features_value_range(self.features,
+      self.metric, self.box_width, _NUM_SPACE_DIMS, self.pts_per_box,
+      self.minkowski_p)
+  
+  def cl_fusion_headers(self):
+    """Gets the OpenCL headers needed by cl_fusion_expr. See
+    proc_tex.texture_fusion."""
+    return ['cellNoise2D.clh']
+  
+  def cl_fusion_args(self):
+    """Gets the declarations and current values of the kernel arguments used by
+    cl_fusion_expr. See proc_tex.texture_fusion."""
+    args = [('const uint', numpy.uint32(self.num_boxes_h)),
+      ('const uint', numpy.uint32(self.pts_per_box)),
+      ('const distMetric', numpy.uint32(self.metric))]
+    if self.procedural_pts:
+      return args + [('const uint', numpy.uint32(self.seed))]
+    return args + [('__global const real2 *', self.cell_pts_buffer)]
+  
+  def cl_fusion_expr(self, pt_expr, arg_names):
+    """Gets an OpenCL expression that evaluates this texture at pt_expr. See
+    proc_tex.texture_fusion."""
+    if self.features == proc_tex.cell_features.FEATURES_DEFAULT:
+      func_name = 'cellNoise2DProceduralAt' if self.procedural_pts \
+        else 'cellNoise2DAt'
+      return '{}({}, {}, {}, {}, {})'.format(func_name, *arg_names, pt_expr)
+    # Fused kernels only use single channel leaf textures.
+    num_boxes_h, num_pts_per_box = arg_names[:2]
+    pts_args = '0, {}'.format(arg_names[3]) if self.procedural_pts \
+      else '{}, 0'.format(arg_names[3])
+    return ('cellFeatureValue(cellNoise2DFeaturesAt({}, {}, {}, {}, {}), {}, '
+      '{})').format(*arg_names[:3], pts_args, pt_expr, self.features[0],
+      '{} * {}'.format(' * '.join([num_boxes_h] * _NUM_SPACE_DIMS),
+      num_pts_per_box))
+  
+  def get_cell_pts(self):
+    """Copies the current cell points from the OpenCL device, or from host
+    memory if there is no runtime. Procedural cell points are generated for the
+    whole grid in host memory, so they should only be read for small grids.
+    returns: A Numpy array of shape (number of cell points, 2), grouped by grid
+      box."""
+    if self.procedural_pts:
+      return proc_tex.numpy_noise.procedural_cell_pts(self.seed,
+        self.num_boxes_h, self.pts_per_box, _NUM_SPACE_DIMS, self.dtype,
+        numpy.arange(self.num_boxes_h ** _NUM_SPACE_DIMS)).reshape(-1,
+        _NUM_SPACE_DIMS)
+    if self.cl_runtime is None:
+      return self._get_host_cell_pts().copy()
+    return self._read_pts_buffer(self.cell_pts_buffer)
+  
+  def get_cell_vels(self):
+    """Copies the current cell point velocities, like get_cell_pts.
+    Procedural cell points do not move, so their velocities are zero, but the
+    result still has an entry for every cell point of the grid.
+    returns: A Numpy array with the same shape as get_cell_pts returns."""
+    if self.procedural_pts:
+      return numpy.zeros((self.num_cell_pts, _NUM_SPACE_DIMS),
+        dtype=self.dtype)
+    if self.cl_runtime is None:
+      return self._host_cell_vels.copy()
+    return self._read_pts_buffer(self.cell_vels_buffer)
+  
+  def _get_host_cell_pts(self):
+    """Gets the current cell points in host memory for Numpy evaluation,
+    without copying them more than once per frame."""
+    host_cell_pts = self._host_cell_pts
+    if host_cell_pts is None:
+      host_cell_pts = self._read_pts_buffer(self.cell_pts_buffer)
+      self._host_cell_pts = host_cell_pts
+    return host_cell_pts
+  
+  def _evaluate_numpy(self, eval_pts, only_f1):
+    """Evaluates the noise with Numpy. Procedural cell points are generated
+    like the kernels do, but only for the grid boxes around each chunk of
+    evaluation points, so that the points of the whole grid are never in
+    memory."""
+    if self.procedural_pts and only_f1:
+      return proc_tex.numpy_noise.cell_noise_procedural(self.num_boxes_h,
+        self.pts_per_box, self.metric, self.seed, _NUM_SPACE_DIMS, eval_pts,
+        self.dtype, minkowski_p=self.minkowski_p)
+    if self.procedural_pts:
+      return proc_tex.numpy_noise.cell_noise_features_procedural(
+        self.num_boxes_h, self.pts_per_box, self.metric, self.seed,
+        _NUM_SPACE_DIMS, self.features, eval_pts, self.dtype,
+        minkowski_p=self.minkowski_p)
+    if only_f1:
+      return proc_tex.numpy_noise.cell_noise(self.num_boxes_h,
+        self.pts_per_box, self.metric, self._get_host_cell_pts(), eval_pts,
+        minkowski_p=self.minkowski_p)
+    return proc_tex.numpy_noise.cell_noise_features(self.num_boxes_h,
+      self.pts_per_box, self.metric, self._get_host_cell_pts(), self.features,
+      eval_pts, minkowski_p=self.minkowski_p)
+  
+  def _read_pts_buffer(self, buffer):
+    result_array = numpy.empty((self.num_cell_pts, 2), dtype=self.dtype)
+    return self.cl_runtime.download(result_array, buffer)
   
   def _grid_coords_to_bounds(self, coords):
     # Assumes the grid coordinates are inside the base cube.
@@ -0,0 +1,283 @@
+import random
+
+import numpy
+import pyopencl
+
+from proc_tex.texture_base import Texture
+import proc_tex.dist_metrics
+import proc_tex.fractal_noise
+import proc_tex.numpy_noise
+
+_NUM_CHANNELS = 1
+_NUM_SPACE_DIMS = 3
+# Number of grid boxes searched for the closest cell point of each octave.
+_NUM_NEIGHBOR_BOXES = 3 ** _NUM_SPACE_DIMS
+
+class OpenCLFractalCellNoise3D(Texture):
+  """Computes a weighted sum of several octaves of 3D cellular noise, such as
+  fractal Brownian motion.
+  Each octave is computed like OpenCLCellNoise3D, with its own grid and cell
+  points. The cell points of all the octaves are kept in one buffer, and a
+  single kernel launch evaluates every octave and sums them in registers, so
+  the texture costs one launch and one result array per frame instead of one
+  per octave. Animation moves the cell points of all the octaves with a
+  single kernel launch."""
+  def __init__(self, cl_runtime, octaves,
+    metric=proc_tex.dist_metrics.METRIC_DEFAULT, normalize=True,
+    point_max_speed=0.01, point_max_accel=0.005, allow_anim=True, dtype=None,
+    backend=proc_tex.numpy_noise.BACKEND_AUTO,
+    minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+    """Initializer.
+    cl_runtime - The OpenCLRuntime to use for computation, or None to compute
+      with Numpy only.
+    octaves - Sequence of (num_boxes_h, pts_per_box, weight) tuples, one per
+      octave. num_boxes_h is the octave's frequency: the width, height, and
+      depth of its grid, in number of grid boxes. pts_per_box is the number
+      of cell points per grid box, and weight scales the octave in the sum.
+    metric - One of the constants from DistanceMetrics that specifies the
+      distance metric to use.
+    normalize - If true, each octave is mapped from its analytic value range
+      to [-0.5, 0.5] before it is weighted, like
+      tex_scale_to_region(octave, -0.5, 0.5, RANGE_MODE_KNOWN).
+    point_max_speed - Maximum point speed, in space units per frame.
+    point_max_accel - Maximum point acceleration, in space units per frame
+      squared.
+    allow_anim - If false, the noise will not be animated.
+    dtype - Floating point dtype for computation and results, numpy.float32 or
+      numpy.float64. If None, cl_runtime.dtype is used, or numpy.float64
+      without a runtime.
+    backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+      selects whether to evaluate with the OpenCL kernels or with Numpy. The
+      animation state stays in OpenCL buffers if there is a runtime.
+    minkowski_p - Exponent of the distance metric if metric is
+      METRIC_MINKOWSKI. Should be at least 1."""
+    super(OpenCLFractalCellNoise3D, self).__init__(_NUM_CHANNELS,
+      _NUM_SPACE_DIMS)
+    
+    self.octaves = [(int(num_boxes_h), int(pts_per_box), weight)
+      for num_boxes_h, pts_per_box, weight in octaves]
+    if not self.octaves:
+      raise ValueError("Must have at least one octave.")
+    if any(pts_per_box <= 0 for _, pts_per_box, _ in self.octaves):
+      raise ValueError("Must have at least one point per grid box.")
+    
+    proc_tex.numpy_noise.check_backend(backend, cl_runtime)
+    self.cl_runtime = cl_runtime
+    self.cl_context = None if cl_runtime is None else cl_runtime.cl_context
+    self.dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+    self.backend = backend
+    proc_tex.dist_metrics.check_metric(metric, minkowski_p)
+    self.metric = metric
+    self.minkowski_p = minkowski_p
+    # Fused programs are not specialized for a metric, as in
+    # OpenCLCellNoise3D.
+    self.cl_fusible = metric != proc_tex.dist_metrics.METRIC_MINKOWSKI \
+      or minkowski_p == proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT
+    self.normalize = normalize
+    self.point_max_speed = point_max_speed
+    self.point_max_accel = point_max_accel
+    self.allow_anim = allow_anim
+    
+    # The cell points of the octaves are stored one octave after another.
+    self.octave_first_pts, self.num_cell_pts = \
+      proc_tex.fractal_noise.octave_starts(
+      [num_boxes_h ** _NUM_SPACE_DIMS * pts_per_box
+      for num_boxes_h, pts_per_box, _ in self.octaves])
+    self._octave_ranges = [(0, proc_tex.dist_metrics.compute_dist_delta(
+      metric, [1 / num_boxes_h] * _NUM_SPACE_DIMS, minkowski_p))
+      for num_boxes_h, _, _ in self.octaves]
+    self.octave_scales = proc_tex.fractal_noise.octave_scales(
+      self._octave_ranges, [weight for _, _, weight in self.octaves],
+      normalize).astype(self.dtype)
+    self._octave_table = numpy.array([(num_boxes_h, pts_per_box, first_pt)
+      for (num_boxes_h, pts_per_box, _), first_pt
+      in zip(self.octaves, self.octave_first_pts)], dtype=numpy.uint32)
+    
+    self.seed = random.randrange(0, 2 ** 32)
+    # Host copies of the cell points and velocities, as in OpenCLCellNoise3D.
+    self._host_cell_pts = None
+    self._host_cell_vels = None
+    if cl_runtime is None:
+      self.cell_pts_buffer = None
+      self.cell_vels_buffer = None
+      self.octaves_buffer = None
+      self.octave_scales_buffer = None
+      self._host_cell_pts = numpy.empty((self.num_cell_pts, _NUM_SPACE_DIMS),
+        dtype=self.dtype)
+      self._host_cell_vels = numpy.empty_like(self._host_cell_pts)
+      for (num_boxes_h, pts_per_box, _), octave_slice \
+        in zip(self.octaves, self._octave_slices()):
+        cell_pts, cell_vels = proc_tex.numpy_noise.cell_noise_anim_init(
+          self.seed, num_boxes_h, pts_per_box, _NUM_SPACE_DIMS,
+          point_max_speed, self.dtype, octave_slice.start)
+        self._host_cell_pts[octave_slice] = cell_pts
+        self._host_cell_vels[octave_slice] = cell_vels
+    else:
+      # Get the OpenCL programs. These are only compiled the first time they
+      # are used with a given runtime and device; see
+      # OpenCLRuntime.get_program.
+      # The noise program is specialized for the distance metric. The number
+      # of points per grid box differs between octaves.
+      self.cl_program_noise = self.cl_runtime.get_program(
+        'opencl/fractalNoise3D.cl',
+        proc_tex.dist_metrics.build_options(metric, minkowski_p),
+        dtype=self.dtype)
+      self.cl_program_anim = self.cl_runtime.get_program(
+        'opencl/fractalNoise3DAnim.cl', dtype=self.dtype)
+      
+      # Upload the octave tables.
+      self.octaves_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_ONLY, self._octave_table.nbytes)
+      self.cl_runtime.upload_to(self.octaves_buffer, self._octave_table)
+      self.octave_scales_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_ONLY, self.octave_scales.nbytes)
+      self.cl_runtime.upload_to(self.octave_scales_buffer, self.octave_scales)
+      
+      # Generate the cell points and velocities of all the octaves.
+      cell_pts_size_bytes = self.num_cell_pts * 3 * self.dtype.itemsize
+      self.cell_pts_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_WRITE, cell_pts_size_bytes)
+      self.cell_vels_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_WRITE, cell_pts_size_bytes)
+      self.cl_runtime.run_kernel(self.cl_runtime.get_kernel(
+        self.cl_program_anim, 'cellFractalNoise3DAnimInit'),
+        (self.num_cell_pts,), None, numpy.uint32(self.seed),
+        numpy.uint32(len(self.octaves)), self.octaves_buffer,
+        self.dtype.type(self.point_max_speed), self.cell_pts_buffer,
+        self.cell_vels_buffer)
+  
+  def evaluate(self, eval_pts):
+    num_pts = int(numpy.prod(eval_pts.shape[:-1]))
+    total_pts_per_box = sum(pts_per_box for _, pts_per_box, _ in self.octaves)
+    if proc_tex.numpy_noise.use_numpy(self.backend, self.cl_runtime,
+      num_pts * _NUM_NEIGHBOR_BOXES * total_pts_per_box):
+      return self._evaluate_numpy(eval_pts)
+    
+    # Create Numpy array for the results.
+    result_shape = eval_pts.shape[:-1] + (_NUM_CHANNELS,)
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
+    
+    # Borrow buffers for the OpenCL kernels from the runtime's pool.
+    # Implicit grids of evaluation points are computed on the device instead
+    # of being uploaded.
+    with self.cl_runtime.eval_pts_arg(eval_pts, self.dtype) \
+      as (is_grid, eval_pts_arg), \
+      self.cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      kernel = self.cl_runtime.get_kernel(self.cl_program_noise,
+        'cellFractalNoise3DGrid' if is_grid else 'cellFractalNoise3D')
+      self.cl_runtime.run_kernel(kernel, (result_array.size,), None,
+        numpy.uint32(len(self.octaves)), self.octaves_buffer,
+        self.octave_scales_buffer, numpy.uint32(self.metric),
+        self.cell_pts_buffer, eval_pts_arg, result_buffer)
+      
+      self.cl_runtime.download(result_array, result_buffer)
+    
+    return result_array
+  
+  def step_frame(self):
+    if self.allow_anim and self.cl_runtime is None:
+      for (num_boxes_h, pts_per_box, _), octave_slice \
+        in zip(self.octaves, self._octave_slices()):
+        proc_tex.numpy_noise.cell_noise_anim_update(self.seed,
+          self.curr_frame + 1, num_boxes_h, pts_per_box,
+          self.point_max_speed, self.point_max_accel,
+          self._host_cell_pts[octave_slice],
+          self._host_cell_vels[octave_slice], octave_slice.start)
+    elif self.allow_anim:
+      # The cell points of every octave are updated in place on the OpenCL
+      # device by one kernel launch.
+      self.cl_runtime.run_kernel(self.cl_runtime.get_kernel(
+        self.cl_program_anim, 'cellFractalNoise3DAnimUpdate'),
+        (self.num_cell_pts,), None, numpy.uint32(self.seed),
+        numpy.uint32(self.curr_frame + 1), numpy.uint32(len(self.octaves)),
+        self.octaves_buffer, self.dtype.type(self.point_max_speed),
+        self.dtype.type(self.point_max_accel), self.cell_pts_buffer,
+        self.cell_vels_buffer)
+      self._host_cell_pts = None
+  
+  def get_anim_state(self):
+    return (self.get_cell_pts(), self.get_cell_vels())
+  
+  def set_anim_state(self, state):
+    cell_pts, cell_vels = state
+    if self.cl_runtime is None:
+      self._host_cell_pts = numpy.array(cell_pts, dtype=self.dtype)
+      self._host_cell_vels = numpy.array(cell_vels, dtype=self.dtype)
+      return
+    self._host_cell_pts = None
+    self.cl_runtime.upload_to(self.cell_pts_buffer,
+      numpy.asarray(cell_pts, dtype=self.dtype))
+    self.cl_runtime.upload_to(self.cell_vels_buffer,
+      numpy.asarray(cell_vels, dtype=self.dtype))
+  
+  def analytic_value_range(self):
+    return proc_tex.fractal_noise.fractal_value_range(self._octave_ranges,
+      self.octave_scales)
+  
+  def cl_fusion_headers(self):
+    """Gets the OpenCL headers needed by cl_fusion_expr. See
+    proc_tex.texture_fusion."""
+    return ['fractalNoise3D.clh']
+  
+  def cl_fusion_args(self):
+    """Gets the declarations and current values of the kernel arguments used by
+    cl_fusion_expr. See proc_tex.texture_fusion."""
+    return [('const uint', numpy.uint32(len(self.octaves))),
+      ('__global const uint *', self.octaves_buffer),
+      ('__global const real *', self.octave_scales_buffer),
+      ('const distMetric', numpy.uint32(self.metric)),
+      ('__global const real *', self.cell_pts_buffer)]
+  
+  def cl_fusion_expr(self, pt_expr, arg_names):
+    """Gets an OpenCL expression that evaluates this texture at pt_expr. See
+    proc_tex.texture_fusion."""
+    return 'cellFractalNoise3DAt({}, {}, {}, {}, {}, {})'.format(*arg_names,
+      pt_expr)
+  
+  def get_cell_pts(self):
+    """Copies the current cell points of all the octaves from the OpenCL
+    device, or from host memory if there is no runtime.
+    returns: A Numpy array of shape (number of cell points, 3), holding the
+      points of each octave in turn, grouped by grid box."""
+    if self.cl_runtime is None:
+      return self._host_cell_pts.copy()
+    return self._read_pts_buffer(self.cell_pts_buffer)
+  
+  def get_cell_vels(self):
+    """Copies the current cell point velocities, like get_cell_pts.
+    returns: A Numpy array with the same shape as get_cell_pts returns."""
+    if self.cl_runtime is None:
+      return self._host_cell_vels.copy()
+    return self._read_pts_buffer(self.cell_vels_buffer)
+  
+  def _octave_slices(self):
+    """Gets the slice of the cell point array holding each octave's points."""
+    return [slice(first_pt, first_pt + num_boxes_h ** _NUM_SPACE_DIMS
+      * pts_per_box) for (num_boxes_h, pts_per_box, _), first_pt
+      in zip(self.octaves, self.octave_first_pts)]
+  
+  def _evaluate_numpy(self, eval_pts):
+    """Evaluates the octaves one at a time with Numpy and sums them."""
+    host_cell_pts = self._get_host_cell_pts()
+    result = None
+    for (num_boxes_h, pts_per_box, _), octave_slice, (scale, offset) \
+      in zip(self.octaves, self._octave_slices(), self.octave_scales):
+      octave = proc_tex.numpy_noise.cell_noise(num_boxes_h, pts_per_box,
+        self.metric, host_cell_pts[octave_slice], eval_pts,
+        minkowski_p=self.minkowski_p)
+      octave = scale * octave + offset
+      result = octave if result is None else result + octave
+    return result
+  
+  def _get_host_cell_pts(self):
+    """Gets the current cell points in host memory for Numpy evaluation,
+    without copying them more than once per frame."""
+    host_cell_pts = self._host_cell_pts
+    if host_cell_pts is None:
+      host_cell_pts = self._read_pts_buffer(self.cell_pts_buffer)
+      self._host_cell_pts = host_cell_pts
+    return host_cell_pts
+  
+  def _read_pts_buffer(self, buffer):
+    result_array = numpy.empty((self.num_cell_pts, 3), dtype=self.dtype)
+    return self.cl_runtime.download(result_array, buffer)
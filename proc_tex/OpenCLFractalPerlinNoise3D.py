@@ -0,0 +1,217 @@
+import math
+import random
+import threading
+
+import numpy
+import pyopencl
+
+from proc_tex.texture_base import Texture
+import proc_tex.fractal_noise
+import proc_tex.numpy_noise
+
+_NUM_CHANNELS = 1
+_NUM_SPACE_DIMS = 3
+# Number of grid box corners interpolated between in each octave.
+_NUM_CORNERS = 2 ** _NUM_SPACE_DIMS
+
+class OpenCLFractalPerlinNoise3D(Texture):
+  """Computes a weighted sum of several octaves of 3D Perlin noise, such as
+  fractal Brownian motion.
+  Each octave is computed like OpenCLPerlinNoise3D, with its own grid and
+  gradients. The gradients of all the octaves are kept in one buffer and are
+  generated for a frame by a single kernel launch, and a single kernel launch
+  evaluates every octave and sums them in registers."""
+  def __init__(self, cl_runtime, octaves, normalize=True, allow_anim=True,
+    frames_per_key=1, dtype=None, backend=proc_tex.numpy_noise.BACKEND_AUTO):
+    """Initializer.
+    cl_runtime - The OpenCLRuntime to use for computation, or None to compute
+      with Numpy only.
+    octaves - Sequence of (num_boxes_h, weight) tuples, one per octave.
+      num_boxes_h is the octave's frequency: the width, height, and depth of
+      its grid, in number of grid boxes. weight scales the octave in the sum.
+    normalize - If true, each octave is mapped from its analytic value range
+      to [-0.5, 0.5] before it is weighted, like
+      tex_scale_to_region(octave, -0.5, 0.5, RANGE_MODE_KNOWN).
+    allow_anim - If false, the noise will not be animated.
+    frames_per_key - Number of frames between independent sets of random
+      gradients. The gradients of the frames in between are interpolated, so
+      larger values make the animation smoother and slower. See
+      OpenCLPerlinNoise3D.
+    dtype - Floating point dtype for computation and results, numpy.float32 or
+      numpy.float64. If None, cl_runtime.dtype is used, or numpy.float64
+      without a runtime.
+    backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+      selects whether to evaluate with the OpenCL kernels or with Numpy."""
+    super(OpenCLFractalPerlinNoise3D, self).__init__(_NUM_CHANNELS,
+      _NUM_SPACE_DIMS)
+    
+    self.octaves = [(int(num_boxes_h), weight)
+      for num_boxes_h, weight in octaves]
+    if not self.octaves:
+      raise ValueError("Must have at least one octave.")
+    
+    proc_tex.numpy_noise.check_backend(backend, cl_runtime)
+    self.cl_runtime = cl_runtime
+    self.cl_context = None if cl_runtime is None else cl_runtime.cl_context
+    self.dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+    self.backend = backend
+    self.normalize = normalize
+    self.allow_anim = allow_anim
+    self.frames_per_key = frames_per_key
+    
+    # The gradients of the octaves are stored one octave after another.
+    self.octave_first_gradients, self.num_gradients = \
+      proc_tex.fractal_noise.octave_starts(
+      [num_boxes_h ** _NUM_SPACE_DIMS for num_boxes_h, _ in self.octaves])
+    # With unit gradients, N-dimensional Perlin noise is bounded by
+    # sqrt(N / 4) grid boxes.
+    self._octave_ranges = [(-math.sqrt(_NUM_SPACE_DIMS / 4) / num_boxes_h,
+      math.sqrt(_NUM_SPACE_DIMS / 4) / num_boxes_h)
+      for num_boxes_h, _ in self.octaves]
+    self.octave_scales = proc_tex.fractal_noise.octave_scales(
+      self._octave_ranges, [weight for _, weight in self.octaves],
+      normalize).astype(self.dtype)
+    self._octave_table = numpy.array([(num_boxes_h, first_gradient)
+      for (num_boxes_h, _), first_gradient
+      in zip(self.octaves, self.octave_first_gradients)], dtype=numpy.uint32)
+    
+    # The gradients of each frame are a function of the seed and frame index
+    # alone, as in OpenCLPerlinNoise3D.
+    self.seed = random.randrange(0, 2 ** 32)
+    self._host_gradients = None
+    self._host_gradients_frame = None
+    if cl_runtime is None:
+      self.gradients_buffer = None
+      self.octaves_buffer = None
+      self.octave_scales_buffer = None
+    else:
+      # Get the OpenCL programs. These are only compiled the first time they
+      # are used with a given runtime and device; see
+      # OpenCLRuntime.get_program.
+      self.cl_program_noise = self.cl_runtime.get_program(
+        'opencl/fractalNoise3D.cl', dtype=self.dtype)
+      self.cl_program_anim = self.cl_runtime.get_program(
+        'opencl/perlinNoise3DAnim.cl', dtype=self.dtype)
+      
+      # Upload the octave tables.
+      self.octaves_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_ONLY, self._octave_table.nbytes)
+      self.cl_runtime.upload_to(self.octaves_buffer, self._octave_table)
+      self.octave_scales_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_ONLY, self.octave_scales.nbytes)
+      self.cl_runtime.upload_to(self.octave_scales_buffer, self.octave_scales)
+      
+      self.gradients_buffer = pyopencl.Buffer(self.cl_context,
+        pyopencl.mem_flags.READ_WRITE,
+        self.num_gradients * 3 * self.dtype.itemsize)
+    self._gradients_frame = None
+    # Threads evaluating parts of a frame on several devices must not
+    # generate the gradients at the same time (see proc_tex.multi_device).
+    self._gradients_lock = threading.Lock()
+  
+  def evaluate(self, eval_pts):
+    num_pts = int(numpy.prod(eval_pts.shape[:-1]))
+    if proc_tex.numpy_noise.use_numpy(self.backend, self.cl_runtime,
+      num_pts * _NUM_CORNERS * len(self.octaves)):
+      return self._evaluate_numpy(eval_pts)
+    
+    # Create Numpy array for the results.
+    result_shape = eval_pts.shape[:-1] + (_NUM_CHANNELS,)
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
+    
+    self._update_gradients()
+    
+    # Borrow buffers for the OpenCL kernels from the runtime's pool.
+    # Implicit grids of evaluation points are computed on the device instead
+    # of being uploaded.
+    with self.cl_runtime.eval_pts_arg(eval_pts, self.dtype) \
+      as (is_grid, eval_pts_arg), \
+      self.cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      kernel = self.cl_runtime.get_kernel(self.cl_program_noise,
+        'perlinFractalNoise3DGrid' if is_grid else 'perlinFractalNoise3D')
+      self.cl_runtime.run_kernel(kernel, (result_array.size,), None,
+        numpy.uint32(len(self.octaves)), self.octaves_buffer,
+        self.octave_scales_buffer, self.gradients_buffer, eval_pts_arg,
+        result_buffer)
+      
+      self.cl_runtime.download(result_array, result_buffer)
+    
+    return result_array
+  
+  def analytic_value_range(self):
+    return proc_tex.fractal_noise.fractal_value_range(self._octave_ranges,
+      self.octave_scales)
+  
+  def cl_fusion_headers(self):
+    """Gets the OpenCL headers needed by cl_fusion_expr. See
+    proc_tex.texture_fusion."""
+    return ['fractalNoise3D.clh']
+  
+  def cl_fusion_args(self):
+    """Gets the declarations and current values of the kernel arguments used by
+    cl_fusion_expr. See proc_tex.texture_fusion."""
+    self._update_gradients()
+    return [('const uint', numpy.uint32(len(self.octaves))),
+      ('__global const uint *', self.octaves_buffer),
+      ('__global const real *', self.octave_scales_buffer),
+      ('__global const real *', self.gradients_buffer)]
+  
+  def cl_fusion_expr(self, pt_expr, arg_names):
+    """Gets an OpenCL expression that evaluates this texture at pt_expr. See
+    proc_tex.texture_fusion."""
+    return 'perlinFractalNoise3DAt({}, {}, {}, {}, {})'.format(*arg_names,
+      pt_expr)
+  
+  def get_gradients(self):
+    """Copies the current gradients of all the octaves from the OpenCL device,
+    or from host memory if there is no runtime.
+    returns: A Numpy array of shape (number of gradients, 3), holding the
+      gradients of each octave in turn."""
+    if self.cl_runtime is None:
+      return self._get_host_gradients().copy()
+    self._update_gradients()
+    result_array = numpy.empty((self.num_gradients, 3), dtype=self.dtype)
+    return self.cl_runtime.download(result_array, self.gradients_buffer)
+  
+  def _update_gradients(self):
+    """Generates the gradients of all the octaves for the current frame with a
+    single kernel launch, if they are not already in the gradients buffer."""
+    frame_idx = self.curr_frame if self.allow_anim else 0
+    with self._gradients_lock:
+      if self._gradients_frame != frame_idx:
+        key_idx, key_frac = proc_tex.numpy_noise.anim_key(frame_idx,
+          self.frames_per_key)
+        self.cl_runtime.run_kernel(
+          self.cl_runtime.get_kernel(self.cl_program_anim,
+          'perlinNoise3DAnimUpdate'), (self.num_gradients,),
+          None, numpy.uint32(self.seed), numpy.uint32(key_idx),
+          self.dtype.type(key_frac), self.gradients_buffer)
+        # Wait for the gradients, so that other devices' queues can use them.
+        self.cl_runtime.cl_queue.finish()
+        self._gradients_frame = frame_idx
+  
+  def _get_host_gradients(self):
+    """Generates the gradients for the current frame in host memory, if they
+    have not already been generated."""
+    frame_idx = self.curr_frame if self.allow_anim else 0
+    with self._gradients_lock:
+      if self._host_gradients_frame != frame_idx:
+        key_idx, key_frac = proc_tex.numpy_noise.anim_key(frame_idx,
+          self.frames_per_key)
+        self._host_gradients = proc_tex.numpy_noise.perlin_noise_gradients(
+          self.seed, key_idx, self.num_gradients, self.dtype, key_frac)
+        self._host_gradients_frame = frame_idx
+      return self._host_gradients
+  
+  def _evaluate_numpy(self, eval_pts):
+    """Evaluates the octaves one at a time with Numpy and sums them."""
+    gradients = self._get_host_gradients()
+    result = None
+    for (num_boxes_h, _), first_gradient, (scale, offset) \
+      in zip(self.octaves, self.octave_first_gradients, self.octave_scales):
+      octave = proc_tex.numpy_noise.perlin_noise(num_boxes_h,
+        gradients[first_gradient:first_gradient
+        + num_boxes_h ** _NUM_SPACE_DIMS], eval_pts)
+      octave = scale * octave + offset
+      result = octave if result is None else result + octave
+    return result
@@ -3,65 +3,95 @@ import random
 import time
 
 import numpy
-import pyopencl
 
 from proc_tex.texture_base import Texture
 import proc_tex.dist_metrics
+import proc_tex.numpy_noise
 
 _NUM_CHANNELS = 1
-_DTYPE = numpy.float64
 _NUM_SPACE_DIMS = 3
 
 class OpenCLGridNoise3D(Texture):
   """Computes sphere-mapped 3D simple grid noise."""
-  def __init__(self, cl_context, num_boxes_h, allow_anim=True):
+  def __init__(self, cl_runtime, num_boxes_h, allow_anim=True, dtype=None,
+    backend=proc_tex.numpy_noise.BACKEND_AUTO):
     """Initializer.
-    cl_context - The PyOpenCL context to use for computation.
+    cl_runtime - The OpenCLRuntime to use for computation, or None to compute
+      with Numpy only.
     num_boxes_h - The width, height, and depth (all the same) of the grid, in
       number of grid boxes. Should be at least 1.
-    allow_anim - If false, the noise will not be animated."""
+    allow_anim - If false, the noise will not be animated.
+    dtype - Floating point dtype for computation and results, numpy.float32 or
+      numpy.float64. If None, cl_runtime.dtype is used, or numpy.float64
+      without a runtime.
+    backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+      selects whether to evaluate with the OpenCL kernels or with Numpy."""
     super(OpenCLGridNoise3D, self).__init__(_NUM_CHANNELS, _NUM_SPACE_DIMS)
     
-    self.cl_context = cl_context
+    proc_tex.numpy_noise.check_backend(backend, cl_runtime)
+    self.cl_runtime = cl_runtime
+    self.cl_context = None if cl_runtime is None else cl_runtime.cl_context
+    self.dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+    self.backend = backend
     self.num_boxes_h = num_boxes_h
     self.box_width = 1 / num_boxes_h
     self.allow_anim = allow_anim
     
-    # Precompile the OpenCL programs.
-    with open('opencl/gridNoise3D.cl', 'r', encoding='utf-8') as program_file:
-      self.cl_program_noise = pyopencl.Program(self.cl_context, program_file.read()) \
-        .build(options=['-I', 'opencl/include/'])
+    # Get the OpenCL program. It is only compiled the first time it is used with
+    # a given runtime and device; see OpenCLRuntime.get_program.
+    if cl_runtime is not None:
+      self.cl_program_noise = self.cl_runtime.get_program(
+        'opencl/gridNoise3D.cl', dtype=self.dtype)
     
     self.seed = random.randrange(0, 2 ** 32)
   
   def evaluate(self, eval_pts):
-    # TODO: Figure out how to make this work with multiple devices
-    # simultaneously. Might require splitting up the tasks.
+    if proc_tex.numpy_noise.use_numpy(self.backend, self.cl_runtime,
+      numpy.prod(eval_pts.shape[:-1])):
+      return proc_tex.numpy_noise.grid_noise(self.seed, self._anim_frame(),
+        self.num_boxes_h, eval_pts, self.dtype)
     
     # Create Numpy array for the results.
     result_shape = eval_pts.shape[:-1] + (_NUM_CHANNELS,)
-    result_array = numpy.empty(result_shape, dtype=_DTYPE)
-    result_size_bytes = result_array.nbytes
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
     
-    # Make sure eval_pts has the required memory layout.
-    eval_pts = numpy.ascontiguousarray(eval_pts)
-    
-    # Create buffers for the OpenCL kernels.
-    eval_pts_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=eval_pts)
-    result_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY, result_size_bytes)
-    
-    with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-      self.cl_program_noise.gridNoise3D(cl_queue, (result_array.size,), None,
-        numpy.uint32(self.seed), numpy.uint32(self.num_boxes_h),
-        eval_pts_buffer, result_buffer)
+    # Borrow buffers for the OpenCL kernels from the runtime's pool.
+    # Implicit grids of evaluation points are computed on the device instead
+    # of being uploaded.
+    with self.cl_runtime.eval_pts_arg(eval_pts, self.dtype) \
+      as (is_grid, eval_pts_arg), \
+      self.cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      kernel = self.cl_runtime.get_kernel(self.cl_program_noise,
+        'gridNoise3DGrid' if is_grid else 'gridNoise3D')
+      self.cl_runtime.run_kernel(kernel, (result_array.size,), None,
+        numpy.uint32(self.seed), numpy.uint32(self._anim_frame()),
+        numpy.uint32(self.num_boxes_h), eval_pts_arg, result_buffer)
       
-      pyopencl.enqueue_copy(cl_queue, result_array, result_buffer)
+      self.cl_runtime.download(result_array, result_buffer)
     
     return result_array
   
-  def step_frame(self):
-    if self.allow_anim:
-      self.seed = random.randrange(0, 2 ** 32)
+  def analytic_value_range(self):
+    return (0, 1)
+  
+  def cl_fusion_headers(self):
+    """Gets the OpenCL headers needed by cl_fusion_expr. See
+    proc_tex.texture_fusion."""
+    return ['gridNoise3D.clh']
+  
+  def cl_fusion_args(self):
+    """Gets the declarations and current values of the kernel arguments used by
+    cl_fusion_expr. See proc_tex.texture_fusion."""
+    return [('const uint', numpy.uint32(self.seed)),
+      ('const uint', numpy.uint32(self._anim_frame())),
+      ('const uint', numpy.uint32(self.num_boxes_h))]
+  
+  def cl_fusion_expr(self, pt_expr, arg_names):
+    """Gets an OpenCL expression that evaluates this texture at pt_expr. See
+    proc_tex.texture_fusion."""
+    return 'gridNoise3DAt({}, {}, {}, {})'.format(*arg_names, pt_expr)
+  
+  def _anim_frame(self):
+    # The value in each grid box is a function of the seed and frame index
+    # alone, so frames need no stepping and can be generated in any order.
+    return self.curr_frame if self.allow_anim else 0
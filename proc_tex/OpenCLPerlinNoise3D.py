@@ -1,5 +1,6 @@
 import math
 import random
+import threading
 import time
 
 import numpy
@@ -7,86 +8,200 @@ import pyopencl
 
 from proc_tex.texture_base import Texture
 import proc_tex.dist_metrics
+import proc_tex.numpy_noise
 
 _NUM_CHANNELS = 1
-_DTYPE = numpy.float64
 _NUM_SPACE_DIMS = 3
+# Number of grid box corners interpolated between.
+_NUM_CORNERS = 2 ** _NUM_SPACE_DIMS
 
 class OpenCLPerlinNoise3D(Texture):
-  """Computes 3D Perlin noise."""
-  def __init__(self, cl_context, num_boxes_h, allow_anim=True):
+  """Computes 3D Perlin noise.
+  By default, the gradients of the grid boxes are generated into a buffer
+  once per frame, which takes memory proportional to the number of grid
+  boxes. With hashed gradients, the kernels instead generate each gradient
+  from a hash of the seed and grid box when they need it, so that no memory
+  is needed for the gradients however fine the grid is, at the cost of more
+  computation per evaluation point. Both modes produce the same noise."""
+  def __init__(self, cl_runtime, num_boxes_h, allow_anim=True, dtype=None,
+    backend=proc_tex.numpy_noise.BACKEND_AUTO, hashed_gradients=False,
+    frames_per_key=1):
     """Initializer.
-    cl_context - The PyOpenCL context to use for computation.
+    cl_runtime - The OpenCLRuntime to use for computation, or None to compute
+      with Numpy only.
     num_boxes_h - The width, height, and depth (all the same) of the grid, in
       number of grid boxes. Should be at least 1.
-    allow_anim - If false, the noise will not be animated."""
+    allow_anim - If false, the noise will not be animated.
+    dtype - Floating point dtype for computation and results, numpy.float32 or
+      numpy.float64. If None, cl_runtime.dtype is used, or numpy.float64
+      without a runtime.
+    backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+      selects whether to evaluate with the OpenCL kernels or with Numpy.
+    hashed_gradients - If true, gradients are generated when needed instead
+      of being stored.
+    frames_per_key - Number of frames between independent sets of random
+      gradients. The gradients of the frames in between are interpolated
+      between the surrounding sets and normalized, so larger values make the
+      animation smoother and slower. With 1, every frame has independent
+      gradients."""
     super(OpenCLPerlinNoise3D, self).__init__(_NUM_CHANNELS, _NUM_SPACE_DIMS)
     
-    self.cl_context = cl_context
+    proc_tex.numpy_noise.check_backend(backend, cl_runtime)
+    self.cl_runtime = cl_runtime
+    self.cl_context = None if cl_runtime is None else cl_runtime.cl_context
+    self.dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+    self.backend = backend
     self.num_boxes_h = num_boxes_h
     self.box_width = 1 / num_boxes_h
     self.allow_anim = allow_anim
+    self.hashed_gradients = hashed_gradients
+    self.frames_per_key = frames_per_key
     
-    # Precompile the OpenCL programs.
-    with open('opencl/perlinNoise3D.cl', 'r', encoding='utf-8') as program_file:
-      self.cl_program_noise = pyopencl.Program(self.cl_context, program_file.read()) \
-        .build(options=['-I', 'opencl/include/'])
-    with open('opencl/perlinNoise3DAnim.cl', 'r', encoding='utf-8') as program_file:
-      self.cl_program_anim = pyopencl.Program(self.cl_context, program_file.read()) \
-        .build(options=['-I', 'opencl/include/'])
-    
-    # Generate the Numpy array of gradients.
-    seed = random.randrange(0, 2 ** 32)
-    num_grid_boxes = num_boxes_h * num_boxes_h * num_boxes_h
-    self.gradients = numpy.empty((num_grid_boxes, 3), dtype=numpy.float64)
-    gradients_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=self.gradients)
-    with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-      self.cl_program_anim.perlinNoise3DAnimInit(cl_queue,
-        (self.gradients.shape[0],), None, numpy.uint32(seed), gradients_buffer)
-      
-      pyopencl.enqueue_copy(cl_queue, self.gradients, gradients_buffer)
+    # The gradients of each frame are a function of the seed and frame index
+    # alone, so they are only generated for the frames that are actually
+    # evaluated. OpenCL evaluation keeps them in an OpenCL buffer for the
+    # lifetime of the texture, unless they are hashed, and Numpy evaluation
+    # generates them in host memory.
+    self.seed = random.randrange(0, 2 ** 32)
+    self.num_gradients = num_boxes_h * num_boxes_h * num_boxes_h
+    self._host_gradients = None
+    self._host_gradients_frame = None
+    self.gradients_buffer = None
+    if cl_runtime is not None:
+      # Get the OpenCL programs. These are only compiled the first time they
+      # are used with a given runtime and device; see
+      # OpenCLRuntime.get_program.
+      self.cl_program_noise = self.cl_runtime.get_program(
+        'opencl/perlinNoise3D.cl', dtype=self.dtype)
+      if not hashed_gradients:
+        self.cl_program_anim = self.cl_runtime.get_program(
+          'opencl/perlinNoise3DAnim.cl', dtype=self.dtype)
+        self.gradients_buffer = pyopencl.Buffer(self.cl_context,
+          pyopencl.mem_flags.READ_WRITE,
+          self.num_gradients * 3 * self.dtype.itemsize)
+    self._gradients_frame = None
+    # Threads evaluating parts of a frame on several devices must not
+    # generate the gradients at the same time (see proc_tex.multi_device).
+    self._gradients_lock = threading.Lock()
   
   def evaluate(self, eval_pts):
-    # TODO: Figure out how to make this work with multiple devices
-    # simultaneously. Might require splitting up the tasks.
+    num_pts = int(numpy.prod(eval_pts.shape[:-1]))
+    if proc_tex.numpy_noise.use_numpy(self.backend, self.cl_runtime,
+      num_pts * _NUM_CORNERS):
+      if self.hashed_gradients:
+        key_idx, key_frac = self._anim_key()
+        return proc_tex.numpy_noise.perlin_noise_hashed(self.num_boxes_h,
+          self.seed, key_idx, key_frac, eval_pts, self.dtype)
+      return proc_tex.numpy_noise.perlin_noise(self.num_boxes_h,
+        self._get_host_gradients(), eval_pts)
     
     # Create Numpy array for the results.
     result_shape = eval_pts.shape[:-1] + (_NUM_CHANNELS,)
-    result_array = numpy.empty(result_shape, dtype=_DTYPE)
-    result_size_bytes = result_array.nbytes
-    
-    # Make sure eval_pts has the required memory layout.
-    eval_pts = numpy.ascontiguousarray(eval_pts)
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
     
-    # Create buffers for the OpenCL kernels.
-    eval_pts_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=eval_pts)
-    gradients_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=self.gradients)
-    result_buffer = pyopencl.Buffer(self.cl_context,
-      pyopencl.mem_flags.WRITE_ONLY, result_size_bytes)
+    if self.hashed_gradients:
+      key_idx, key_frac = self._anim_key()
+      kernel_name = 'perlinNoise3DHashed'
+      gradient_args = (numpy.uint32(self.seed), numpy.uint32(key_idx),
+        self.dtype.type(key_frac))
+    else:
+      self._update_gradients()
+      kernel_name = 'perlinNoise3D'
+      gradient_args = (self.gradients_buffer,)
     
-    with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-      self.cl_program_noise.perlinNoise3D(cl_queue, (result_array.size,), None,
-        numpy.uint32(self.num_boxes_h), gradients_buffer, eval_pts_buffer,
+    # Borrow buffers for the OpenCL kernels from the runtime's pool.
+    # Implicit grids of evaluation points are computed on the device instead
+    # of being uploaded.
+    with self.cl_runtime.eval_pts_arg(eval_pts, self.dtype) \
+      as (is_grid, eval_pts_arg), \
+      self.cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      kernel = self.cl_runtime.get_kernel(self.cl_program_noise,
+        kernel_name + 'Grid' if is_grid else kernel_name)
+      self.cl_runtime.run_kernel(kernel, (result_array.size,), None,
+        numpy.uint32(self.num_boxes_h), *gradient_args, eval_pts_arg,
         result_buffer)
       
-      pyopencl.enqueue_copy(cl_queue, result_array, result_buffer)
+      self.cl_runtime.download(result_array, result_buffer)
     
     return result_array
   
-  def step_frame(self):
-    if self.allow_anim:
-      seed = random.randrange(0, 2 ** 32)
-      gradients_buffer = pyopencl.Buffer(self.cl_context,
-        pyopencl.mem_flags.READ_WRITE | pyopencl.mem_flags.COPY_HOST_PTR,
-        hostbuf=self.gradients)
-      with pyopencl.CommandQueue(self.cl_context) as cl_queue:
-        self.cl_program_anim.perlinNoise3DAnimUpdate(cl_queue,
-          (self.gradients.shape[0],), None, numpy.uint32(seed), gradients_buffer)
-        
-        pyopencl.enqueue_copy(cl_queue, self.gradients, gradients_buffer)
+  def analytic_value_range(self):
+    # With unit gradients, N-dimensional Perlin noise is bounded by sqrt(N / 4)
+    # grid boxes.
+    bound = math.sqrt(_NUM_SPACE_DIMS / 4) * self.box_width
+    return (-bound, bound)
+  
+  def cl_fusion_headers(self):
+    """Gets the OpenCL headers needed by cl_fusion_expr. See
+    proc_tex.texture_fusion."""
+    return ['perlinNoise3D.clh']
+  
+  def cl_fusion_args(self):
+    """Gets the declarations and current values of the kernel arguments used by
+    cl_fusion_expr. See proc_tex.texture_fusion."""
+    if self.hashed_gradients:
+      key_idx, key_frac = self._anim_key()
+      return [('const uint', numpy.uint32(self.num_boxes_h)),
+        ('const uint', numpy.uint32(self.seed)),
+        ('const uint', numpy.uint32(key_idx)),
+        ('const real', self.dtype.type(key_frac))]
+    self._update_gradients()
+    return [('const uint', numpy.uint32(self.num_boxes_h)),
+      ('__global const real *', self.gradients_buffer)]
+  
+  def cl_fusion_expr(self, pt_expr, arg_names):
+    """Gets an OpenCL expression that evaluates this texture at pt_expr. See
+    proc_tex.texture_fusion."""
+    if self.hashed_gradients:
+      return 'perlinNoise3DHashedAt({}, {}, {}, {}, {})'.format(*arg_names,
+        pt_expr)
+    return 'perlinNoise3DAt({}, {}, {})'.format(*arg_names, pt_expr)
+  
+  def get_gradients(self):
+    """Copies the current gradients from the OpenCL device, or from host
+    memory if there is no runtime.
+    With hashed gradients, the gradients are generated in host memory for
+    this call only.
+    returns: A Numpy array of shape (number of grid boxes, 3)."""
+    if self.hashed_gradients:
+      key_idx, key_frac = self._anim_key()
+      return proc_tex.numpy_noise.perlin_noise_gradients(self.seed, key_idx,
+        self.num_gradients, self.dtype, key_frac)
+    if self.cl_runtime is None:
+      return self._get_host_gradients().copy()
+    self._update_gradients()
+    result_array = numpy.empty((self.num_gradients, 3), dtype=self.dtype)
+    return self.cl_runtime.download(result_array, self.gradients_buffer)
+  
+  def _update_gradients(self):
+    """Generates the gradients for the current frame, if they are not already
+    in the gradients buffer."""
+    frame_idx = self.curr_frame if self.allow_anim else 0
+    with self._gradients_lock:
+      if self._gradients_frame != frame_idx:
+        key_idx, key_frac = self._anim_key()
+        self.cl_runtime.run_kernel(
+          self.cl_runtime.get_kernel(self.cl_program_anim,
+          'perlinNoise3DAnimUpdate'), (self.num_gradients,),
+          None, numpy.uint32(self.seed), numpy.uint32(key_idx),
+          self.dtype.type(key_frac), self.gradients_buffer)
+        # Wait for the gradients, so that other devices' queues can use them.
+        self.cl_runtime.cl_queue.finish()
+        self._gradients_frame = frame_idx
+  
+  def _get_host_gradients(self):
+    """Generates the gradients for the current frame in host memory, if they
+    have not already been generated."""
+    frame_idx = self.curr_frame if self.allow_anim else 0
+    with self._gradients_lock:
+      if self._host_gradients_frame != frame_idx:
+        key_idx, key_frac = self._anim_key()
+        self._host_gradients = proc_tex.numpy_noise.perlin_noise_gradients(
+          self.seed, key_idx, self.num_gradients, self.dtype, key_frac)
+        self._host_gradients_frame = frame_idx
+      return self._host_gradients
+  
+  def _anim_key(self):
+    """Gets the animation key index and fraction of the current frame."""
+    frame_idx = self.curr_frame if self.allow_anim else 0
+    return proc_tex.numpy_noise.anim_key(frame_idx, self.frames_per_key)
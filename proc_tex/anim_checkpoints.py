@@ -0,0 +1,137 @@
+import os
+import pickle
+import tempfile
+
+def _anim_graph(texture):
+  """Lists a texture and all textures animated along with it (see
+  Texture.anim_synch_textures), in a deterministic order without
+  duplicates."""
+  textures = []
+  visited = set()
+  
+  def visit(curr_texture):
+    if id(curr_texture) not in visited:
+      visited.add(id(curr_texture))
+      textures.append(curr_texture)
+      for child in curr_texture.anim_synch_textures:
+        visit(child)
+  
+  visit(texture)
+  return textures
+
+def snapshot_anim_state(texture):
+  """Captures the animation state of a texture and all textures animated along
+  with it. See Texture.get_anim_state.
+  texture - Root of the texture graph.
+  returns: A picklable snapshot that can be passed to restore_anim_state."""
+  return [(curr_texture.curr_frame, curr_texture.get_anim_state())
+    for curr_texture in _anim_graph(texture)]
+
+def restore_anim_state(texture, snapshot):
+  """Restores the animation state of a texture graph from a snapshot. This can
+  move the graph to an earlier frame, unlike Texture.set_frame.
+  texture - Root of the texture graph. Must have the same structure as the
+    graph the snapshot was taken from, e.g. because it was built by the same
+    code with the same random seed.
+  snapshot - A snapshot returned by snapshot_anim_state."""
+  textures = _anim_graph(texture)
+  if len(textures) != len(snapshot):
+    raise ValueError('Snapshot does not match the texture graph.')
+  
+  for curr_texture, (frame_idx, state) in zip(textures, snapshot):
+    curr_texture.set_anim_state(state)
+    curr_texture.curr_frame = frame_idx
+
+class AnimCheckpoints:
+  """Keeps periodic snapshots of the animation state of a texture graph, so
+  that the graph can be moved to any frame, including earlier ones, by
+  restoring the nearest earlier checkpoint and stepping forward from there.
+  Seeking therefore steps through at most one checkpoint interval of frames
+  once the checkpoints have been recorded.
+  A checkpoint is recorded for the frame the texture is at when the
+  AnimCheckpoints is created, and for every frame that is a multiple of the
+  interval as seek steps through it. Checkpoints can be kept in memory, or in a
+  directory so that they can be reused by other processes (see
+  proc_tex.parallel_render) or later runs. A directory must only be shared by
+  textures built by the same code with the same random seed."""
+  def __init__(self, texture, interval=32, directory=None):
+    """Initializer.
+    texture - Root of the texture graph.
+    interval - Number of frames between checkpoints.
+    directory - Directory in which to store the checkpoints. If None, they
+      are kept in memory."""
+    if interval <= 0:
+      raise ValueError('Checkpoint interval must be positive.')
+    
+    self.texture = texture
+    self.interval = interval
+    self.directory = directory
+    # Maps frame index to snapshot, when not using a directory.
+    self._snapshots = {}
+    
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+    if texture.curr_frame not in self.frames():
+      self.checkpoint()
+  
+  def frames(self):
+    """Gets the frame indices that have checkpoints.
+    returns: A sorted list of frame indices."""
+    if self.directory is None:
+      return sorted(self._snapshots)
+    return sorted(int(name[len('frame_'):-len('.pkl')])
+      for name in os.listdir(self.directory)
+      if name.startswith('frame_') and name.endswith('.pkl'))
+  
+  def checkpoint(self):
+    """Records a checkpoint for the texture's current frame."""
+    snapshot = snapshot_anim_state(self.texture)
+    frame_idx = self.texture.curr_frame
+    if self.directory is None:
+      self._snapshots[frame_idx] = snapshot
+      return
+    
+    # Write to a temporary file first, so that other processes never see a
+    # partially written checkpoint.
+    fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as temp_file:
+        pickle.dump(snapshot, temp_file, pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, self._path(frame_idx))
+    except BaseException:
+      os.remove(temp_path)
+      raise
+  
+  def seek(self, frame_idx):
+    """Moves the texture graph to a frame, restoring a checkpoint if the frame
+    is before the current frame or a checkpoint is closer than the current
+    frame.
+    frame_idx - Index of the frame to go to. Must not be before the earliest
+      checkpoint."""
+    earlier_frames = [checkpoint_frame for checkpoint_frame in self.frames()
+      if checkpoint_frame <= frame_idx]
+    if not earlier_frames:
+      raise ValueError('No checkpoint at or before frame {}.'.format(
+        frame_idx))
+    
+    checkpoint_frame = earlier_frames[-1]
+    curr_frame = self.texture.curr_frame
+    if frame_idx < curr_frame or checkpoint_frame > curr_frame:
+      restore_anim_state(self.texture, self._load(checkpoint_frame))
+    
+    # Step one frame at a time, recording checkpoints along the way.
+    recorded_frames = set(earlier_frames)
+    while self.texture.curr_frame < frame_idx:
+      self.texture.set_frame(self.texture.curr_frame + 1)
+      if self.texture.curr_frame % self.interval == 0 \
+        and self.texture.curr_frame not in recorded_frames:
+        self.checkpoint()
+  
+  def _path(self, frame_idx):
+    return os.path.join(self.directory, 'frame_{:08d}.pkl'.format(frame_idx))
+  
+  def _load(self, frame_idx):
+    if self.directory is None:
+      return self._snapshots[frame_idx]
+    with open(self._path(frame_idx), 'rb') as snapshot_file:
+      return pickle.load(snapshot_file)
@@ -0,0 +1,72 @@
+import proc_tex.dist_metrics
+
+# Features of cellular noise, matching the cellFeature enum in
+# cellFeatures.clh. All the selected features of a texture are computed in a
+# single search of the cell points.
+# Distance to the closest cell point.
+FEATURE_F1 = 0
+# Distance to the second closest cell point.
+FEATURE_F2 = 1
+# F2 minus F1. Zero along the borders between cells.
+FEATURE_F2_MINUS_F1 = 2
+# Index of the closest cell point divided by the number of cell points, which
+# is constant over each cell.
+FEATURE_CELL_ID = 3
+FEATURES_DEFAULT = (FEATURE_F1,)
+
+# Number of bits per feature in packed feature lists, matching
+# CELL_FEATURE_BITS in cellFeatures.clh.
+_FEATURE_BITS = 4
+MAX_FEATURES = 32 // _FEATURE_BITS
+
+_ALL_FEATURES = (FEATURE_F1, FEATURE_F2, FEATURE_F2_MINUS_F1, FEATURE_CELL_ID)
+
+def check_features(features, num_cell_pts):
+  """Checks a sequence of features for a cellular noise texture.
+  features - Sequence of FEATURE_* constants, one per output channel.
+  num_cell_pts - Total number of cell points of the texture.
+  returns: The features as a tuple."""
+  features = tuple(features)
+  if not 1 <= len(features) <= MAX_FEATURES:
+    raise ValueError('Must have between 1 and {} features.'.format(
+      MAX_FEATURES))
+  for feature in features:
+    if feature not in _ALL_FEATURES:
+      raise ValueError('Unknown cell noise feature: {!r}'.format(feature))
+  if num_cell_pts < 2 and (FEATURE_F2 in features
+    or FEATURE_F2_MINUS_F1 in features):
+    raise ValueError('F2 needs at least two cell points.')
+  return features
+
+def pack_features(features):
+  """Packs features into the featureCodes argument of the cellNoise2DFeatures
+  and cellNoise3DFeatures kernels."""
+  codes = 0
+  for channel, feature in enumerate(features):
+    codes |= feature << (channel * _FEATURE_BITS)
+  return codes
+
+def features_value_range(features, metric, box_width, num_dims, pts_per_box,
+  minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+  """Computes bounds on the values of cell noise features.
+  features - Sequence of FEATURE_* constants.
+  metric - One of the METRIC_* constants from proc_tex.dist_metrics.
+  box_width - Width of a grid box.
+  num_dims - Number of space dimensions.
+  pts_per_box - Number of cell points per grid box.
+  minkowski_p - Exponent of METRIC_MINKOWSKI.
+  returns: A (min, max) tuple that bounds all the features."""
+  # Cell points never leave their grid boxes, so every point is within one
+  # box diagonal of a cell point. With several points per box the same holds
+  # for the second closest point. Otherwise the point in a neighboring box
+  # is at most two box widths away along one axis.
+  f1_max = proc_tex.dist_metrics.compute_dist_delta(metric,
+    [box_width] * num_dims, minkowski_p)
+  if pts_per_box > 1:
+    f2_max = f1_max
+  else:
+    f2_max = proc_tex.dist_metrics.compute_dist_delta(metric,
+      [2 * box_width] + [box_width] * (num_dims - 1), minkowski_p)
+  maxima = {FEATURE_F1: f1_max, FEATURE_F2: f2_max,
+    FEATURE_F2_MINUS_F1: f2_max, FEATURE_CELL_ID: 1}
+  return (0, max(maxima[feature] for feature in features))
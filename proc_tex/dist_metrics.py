@@ -1,3 +1,54 @@
+import math
+
 METRIC_L2_NORM = 0
 METRIC_L2_NORM_SQUARED = 1
+METRIC_L1_NORM = 2
+METRIC_LINF_NORM = 3
+METRIC_MINKOWSKI = 4
 METRIC_DEFAULT = METRIC_L2_NORM
+
+_METRICS = {METRIC_L2_NORM, METRIC_L2_NORM_SQUARED, METRIC_L1_NORM,
+  METRIC_LINF_NORM, METRIC_MINKOWSKI}
+
+# Exponent of METRIC_MINKOWSKI if none is given.
+MINKOWSKI_P_DEFAULT = 3
+
+def check_metric(metric, minkowski_p=MINKOWSKI_P_DEFAULT):
+  """Raises ValueError if a distance metric is not supported.
+  metric - One of the METRIC_* constants.
+  minkowski_p - Exponent of METRIC_MINKOWSKI. Must be at least 1 for the
+    result to be a metric."""
+  if metric not in _METRICS:
+    raise ValueError('Unsupported distance metric: {}'.format(metric))
+  if metric == METRIC_MINKOWSKI and not 1 <= minkowski_p < math.inf:
+    raise ValueError('Minkowski exponent must be at least 1 and finite.')
+
+def compute_dist_delta(metric, delta, minkowski_p=MINKOWSKI_P_DEFAULT):
+  """Computes a distance metric on the host, matching the computeDist*Delta
+  functions in distMetrics.clh.
+  metric - One of the METRIC_* constants.
+  delta - Iterable of the absolute coordinate deltas between two points.
+  minkowski_p - Exponent of METRIC_MINKOWSKI."""
+  delta = list(delta)
+  if metric == METRIC_L1_NORM:
+    return sum(delta)
+  if metric == METRIC_LINF_NORM:
+    return max(delta)
+  if metric == METRIC_MINKOWSKI:
+    return sum(coord ** minkowski_p for coord in delta) ** (1 / minkowski_p)
+  squared = sum(coord * coord for coord in delta)
+  if metric == METRIC_L2_NORM_SQUARED:
+    return squared
+  return math.sqrt(squared)
+
+def build_options(metric, minkowski_p=MINKOWSKI_P_DEFAULT):
+  """Gets the OpenCL build options that specialize a program for a single
+  distance metric, so that the metric is not chosen at run time inside the
+  noise loops (see distMetrics.clh). OpenCLRuntime.get_program caches the
+  program built for each metric separately.
+  metric - One of the METRIC_* constants.
+  minkowski_p - Exponent of METRIC_MINKOWSKI."""
+  options = ['-D', 'DIST_METRIC={}'.format(int(metric))]
+  if metric == METRIC_MINKOWSKI:
+    options += ['-D', 'DIST_MINKOWSKI_P={!r}'.format(float(minkowski_p))]
+  return options
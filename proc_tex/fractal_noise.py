@@ -0,0 +1,49 @@
+import numpy
+
+def octave_scales(octave_ranges, weights, normalize):
+  """Computes the scale and offset applied to each octave of a fractal noise
+  texture before the octaves are summed.
+  octave_ranges - The analytic (min, max) value range of each octave.
+  weights - The weight of each octave.
+  normalize - If true, each octave is first mapped from its analytic range to
+    [-0.5, 0.5], like tex_scale_to_region(octave, -0.5, 0.5,
+    RANGE_MODE_KNOWN). Otherwise the octaves are only weighted.
+  returns: A Numpy array of shape (number of octaves, 2) holding the scale
+    and offset of each octave."""
+  scales = []
+  for (min_value, max_value), weight in zip(octave_ranges, weights):
+    if not normalize:
+      scales.append((weight, 0))
+    elif max_value > min_value:
+      scale = weight / (max_value - min_value)
+      scales.append((scale, -weight * 0.5 - min_value * scale))
+    else:
+      # An octave with an empty range is constant, and is left out.
+      scales.append((0, 0))
+  return numpy.array(scales, dtype=numpy.float64).reshape(-1, 2)
+
+def fractal_value_range(octave_ranges, scales):
+  """Computes bounds on the sum of the scaled and offset octaves.
+  octave_ranges - The analytic (min, max) value range of each octave.
+  scales - The array returned by octave_scales.
+  returns: A (min, max) tuple."""
+  min_sum = 0
+  max_sum = 0
+  for (min_value, max_value), (scale, offset) in zip(octave_ranges, scales):
+    bounds = (scale * min_value + offset, scale * max_value + offset)
+    min_sum += min(bounds)
+    max_sum += max(bounds)
+  return (float(min_sum), float(max_sum))
+
+def octave_starts(octave_sizes):
+  """Computes the index of each octave's first element in an array holding
+  the elements of all the octaves one after another.
+  octave_sizes - The number of elements, such as cell points or gradients, of
+    each octave.
+  returns: A (list of start indices, total number of elements) tuple."""
+  starts = []
+  total = 0
+  for size in octave_sizes:
+    starts.append(total)
+    total += size
+  return starts, total
@@ -0,0 +1,412 @@
+"""Measures the throughput of the noise textures, the sphere map transform, the
+rock texture graphs and video rendering, and writes the results to a JSON file
+that can be compared with the results of another commit.
+Run from the repository root, e.g.:
+  python -m proc_tex.main.benchmark --device-type cpu --quick
+  python -m proc_tex.main.benchmark --compare old_results.json
+Works with CPU-only OpenCL implementations such as PoCL (use --device-type cpu
+or PYOPENCL_CTX to select one)."""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import pyopencl
+
+from proc_tex.opencl_runtime import OpenCLRuntime, event_seconds
+from proc_tex.texture_base import ScalarConstantTexture
+from proc_tex.OpenCLCellNoise2D import OpenCLCellNoise2D
+from proc_tex.OpenCLCellNoise3D import OpenCLCellNoise3D
+from proc_tex.OpenCLFractalCellNoise3D import OpenCLFractalCellNoise3D
+from proc_tex.OpenCLGridNoise3D import OpenCLGridNoise3D
+from proc_tex.OpenCLPerlinNoise3D import OpenCLPerlinNoise3D
+from proc_tex.texture_transforms import RANGE_MODE_KNOWN, \
+  tex_scale_to_region
+from proc_tex.texture_transforms_opencl import tex_3d_to_cube_map, \
+  tex_3d_to_octahedral_map, tex_3d_to_sphere_map
+import proc_tex.cell_features
+import proc_tex.dist_metrics
+import proc_tex.numpy_noise
+import proc_tex.main.rock_test_0
+import proc_tex.main.rock_test_1
+
+_RESULTS_VERSION = 1
+
+_METRIC_NAMES = {
+  proc_tex.dist_metrics.METRIC_L2_NORM: 'l2',
+  proc_tex.dist_metrics.METRIC_L2_NORM_SQUARED: 'l2_squared',
+  proc_tex.dist_metrics.METRIC_L1_NORM: 'l1',
+  proc_tex.dist_metrics.METRIC_LINF_NORM: 'linf',
+  proc_tex.dist_metrics.METRIC_MINKOWSKI: 'minkowski',
+}
+_PRECISIONS = {'float32': numpy.float32, 'float64': numpy.float64}
+
+# Sweeps of texture parameters, as (full sweep, quick sweep) tuples.
+_CELL_NUM_BOXES = ([4, 16, 64], [4, 16])
+_CELL_PTS_PER_BOX = ([1, 4], [1])
+# Points per grid box of the cell_noise_3d_density cases, which show how the
+# cost of the cellular noise search grows with the density of the points.
+# Compare with the results of an older commit to find where skipping distant
+# grid boxes starts to pay off.
+_CELL_DENSITY_PTS_PER_BOX = ([1, 2, 4, 8, 16, 32], [1, 8, 32])
+_CELL_DENSITY_NUM_BOXES = 8
+_PERLIN_NUM_BOXES = ([10, 100, 200], [10, 100])
+# Frequency of the Perlin noise of the planet_* cases.
+_PLANET_NUM_BOXES = 100
+_GRID_NUM_BOXES = ([100, 2000], [2000])
+_RESOLUTIONS = ([256, 1024, 2048], [256, 1024])
+# Features computed by the cell_noise_3d_features cases.
+_CELL_FEATURES = (proc_tex.cell_features.FEATURE_F1,
+  proc_tex.cell_features.FEATURE_F2_MINUS_F1,
+  proc_tex.cell_features.FEATURE_CELL_ID)
+# (num_boxes_h, pts_per_box, weight) of the cellular noise octaves of the first
+# rock graph, for comparing separate octave textures with a fractal texture.
+_CELL_OCTAVES = [(5, 1, 1), (5, 1, -1), (8, 1, 0.5), (8, 1, -0.5),
+  (10, 1, 0.25), (10, 1, -0.25), (12, 1, 0.125), (12, 1, -0.125)]
+
+def _make_context(device_type):
+  """Creates the OpenCL context to benchmark.
+  device_type - 'cpu', 'gpu', or None to let PyOpenCL choose (see
+    PYOPENCL_CTX)."""
+  if device_type is None:
+    return pyopencl.create_some_context(interactive=False)
+  cl_device_type = {'cpu': pyopencl.device_type.CPU,
+    'gpu': pyopencl.device_type.GPU}[device_type]
+  for cl_platform in pyopencl.get_platforms():
+    try:
+      devices = cl_platform.get_devices(device_type=cl_device_type)
+    except pyopencl.Error:
+      continue
+    if devices:
+      return pyopencl.Context(devices[:1])
+  raise RuntimeError('No OpenCL {} device found.'.format(device_type))
+
+def _grid_3d(texture, resolution):
+  """Generates a one pixel deep 3D grid of evaluation points."""
+  return texture.gen_eval_pts((resolution, resolution, 1),
+    numpy.array([[0, 1], [0, 1], [0, 1]]), implicit=True)
+
+def _grid_2d(texture, resolution):
+  return texture.gen_eval_pts((resolution, resolution),
+    numpy.array([[0, 1], [0, 1]]), implicit=True)
+
+def _grid_cube_map(texture, resolution):
+  """Generates the points of a cube map with the same sample spacing as a
+  sphere map of resolution by resolution pixels has at the equator. See
+  tex_3d_to_cube_map."""
+  face_size = max(1, resolution // 4)
+  return texture.gen_eval_pts((6 * face_size, face_size),
+    numpy.array([[0, 1], [0, 1]]), implicit=True)
+
+def _measure(cl_runtime, run, num_pixels, repeats):
+  """Measures a workload.
+  run - Function performing the workload once.
+  num_pixels - Number of pixels computed by run.
+  repeats - Number of timed runs to average over.
+  returns: Dictionary of measurements. Device times come from OpenCL event
+    profiling, and host time is the rest of the wall time. Peak memory is
+    measured in an extra run, since tracing host allocations slows down the
+    host code."""
+  # The first run builds the OpenCL programs and fills the buffer pool.
+  run()
+  cl_runtime.finish()
+  
+  wall_seconds = 0
+  device_seconds = {'kernel': 0, 'upload': 0, 'download': 0}
+  for _ in range(repeats):
+    with cl_runtime.record_events() as events:
+      start_time = time.perf_counter()
+      run()
+      cl_runtime.finish()
+      wall_seconds += time.perf_counter() - start_time
+    for kind, seconds in event_seconds(events).items():
+      device_seconds[kind] += seconds
+  
+  cl_runtime.reset_pool_peaks()
+  tracemalloc.start()
+  try:
+    run()
+    cl_runtime.finish()
+    _, peak_host_bytes = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  
+  wall_seconds /= repeats
+  kernel_seconds = device_seconds['kernel'] / repeats
+  transfer_seconds = (device_seconds['upload']
+    + device_seconds['download']) / repeats
+  return {
+    'wall_s': wall_seconds,
+    'mpix_per_s': num_pixels / wall_seconds * 1e-6,
+    'kernel_s': kernel_seconds,
+    'upload_s': device_seconds['upload'] / repeats,
+    'download_s': device_seconds['download'] / repeats,
+    'host_s': max(0.0, wall_seconds - kernel_seconds - transfer_seconds),
+    'peak_host_bytes': peak_host_bytes,
+    'peak_device_scratch_bytes': cl_runtime.pool_peak_bytes(),
+  }
+
+def _separate_cell_octaves(cl_runtime, dtype, backend):
+  """Sums the _CELL_OCTAVES as separate textures, like the rock graphs do."""
+  texture = ScalarConstantTexture(1, 3, 0)
+  for num_boxes_h, pts_per_box, weight in _CELL_OCTAVES:
+    octave = OpenCLCellNoise3D(cl_runtime, num_boxes_h, pts_per_box,
+      dtype=dtype, backend=backend)
+    texture += weight * tex_scale_to_region(octave, -0.5, 0.5,
+      RANGE_MODE_KNOWN)
+  return texture
+
+def _noise_cases(cl_runtime, precision, args):
+  """Generates the noise texture benchmark cases.
+  returns: An iterator over (name, params, make_texture, make_eval_pts)
+    tuples."""
+  sweep_idx = 1 if args.quick else 0
+  dtype = _PRECISIONS[precision]
+  for resolution in _RESOLUTIONS[sweep_idx]:
+    backends = [proc_tex.numpy_noise.BACKEND_OPENCL]
+    if resolution <= args.max_numpy_resolution:
+      backends.append(proc_tex.numpy_noise.BACKEND_NUMPY)
+    for backend in backends:
+      common = {'resolution': resolution, 'precision': precision,
+        'backend': backend}
+      for num_boxes_h in _CELL_NUM_BOXES[sweep_idx]:
+        for pts_per_box in _CELL_PTS_PER_BOX[sweep_idx]:
+          for metric, metric_name in sorted(_METRIC_NAMES.items()):
+            params = dict(common, num_boxes_h=num_boxes_h,
+              pts_per_box=pts_per_box, metric=metric_name)
+            yield 'cell_noise_3d', params, \
+              lambda n=num_boxes_h, p=pts_per_box, m=metric, b=backend: \
+              OpenCLCellNoise3D(cl_runtime, n, p, metric=m, dtype=dtype,
+                backend=b), _grid_3d
+            yield 'cell_noise_2d', params, \
+              lambda n=num_boxes_h, p=pts_per_box, m=metric, b=backend: \
+              OpenCLCellNoise2D(cl_runtime, n, p, metric=m, dtype=dtype,
+                backend=b), _grid_2d
+          # Cell points generated in the kernel instead of read from memory.
+          params = dict(common, num_boxes_h=num_boxes_h,
+            pts_per_box=pts_per_box)
+          yield 'cell_noise_3d_procedural', params, \
+            lambda n=num_boxes_h, p=pts_per_box, b=backend: \
+            OpenCLCellNoise3D(cl_runtime, n, p, allow_anim=False, dtype=dtype,
+              backend=b, procedural_pts=True), _grid_3d
+          # Several features from a single search of the cell points.
+          params = dict(common, num_boxes_h=num_boxes_h,
+            pts_per_box=pts_per_box, features='f1,f2-f1,id')
+          yield 'cell_noise_3d_features', params, \
+            lambda n=num_boxes_h, p=pts_per_box, b=backend: \
+            OpenCLCellNoise3D(cl_runtime, n, p, dtype=dtype, backend=b,
+              features=_CELL_FEATURES), _grid_3d
+      for pts_per_box in _CELL_DENSITY_PTS_PER_BOX[sweep_idx]:
+        params = dict(common, num_boxes_h=_CELL_DENSITY_NUM_BOXES,
+          pts_per_box=pts_per_box)
+        yield 'cell_noise_3d_density', params, \
+          lambda p=pts_per_box, b=backend: OpenCLCellNoise3D(cl_runtime,
+            _CELL_DENSITY_NUM_BOXES, p, dtype=dtype, backend=b), _grid_3d
+        yield 'cell_noise_3d_density_features', params, \
+          lambda p=pts_per_box, b=backend: OpenCLCellNoise3D(cl_runtime,
+            _CELL_DENSITY_NUM_BOXES, p, dtype=dtype, backend=b,
+            features=_CELL_FEATURES), _grid_3d
+      for num_boxes_h in _PERLIN_NUM_BOXES[sweep_idx]:
+        yield 'perlin_noise_3d', dict(common, num_boxes_h=num_boxes_h), \
+          lambda n=num_boxes_h, b=backend: OpenCLPerlinNoise3D(cl_runtime, n,
+            dtype=dtype, backend=b), _grid_3d
+        yield 'perlin_noise_3d_hashed', dict(common, num_boxes_h=num_boxes_h), \
+          lambda n=num_boxes_h, b=backend: OpenCLPerlinNoise3D(cl_runtime, n,
+            dtype=dtype, backend=b, hashed_gradients=True), _grid_3d
+      for num_boxes_h in _GRID_NUM_BOXES[sweep_idx]:
+        yield 'grid_noise_3d', dict(common, num_boxes_h=num_boxes_h), \
+          lambda n=num_boxes_h, b=backend: OpenCLGridNoise3D(cl_runtime, n,
+            dtype=dtype, backend=b), _grid_3d
+      # The same octaves as separate textures and as one fractal texture.
+      yield 'cell_octaves_separate', dict(common), \
+        lambda b=backend: _separate_cell_octaves(cl_runtime, dtype, b), \
+        _grid_3d
+      yield 'cell_octaves_fractal', dict(common), \
+        lambda b=backend: OpenCLFractalCellNoise3D(cl_runtime, _CELL_OCTAVES,
+          dtype=dtype, backend=b), _grid_3d
+      # The constant source makes the cost of the mapping itself visible.
+      yield 'sphere_map', dict(common), \
+        lambda b=backend: tex_3d_to_sphere_map(ScalarConstantTexture(1, 3, 0),
+          cl_runtime, dtype=dtype, backend=b), _grid_2d
+      yield 'cube_map', dict(common), \
+        lambda b=backend: tex_3d_to_cube_map(ScalarConstantTexture(1, 3, 0),
+          cl_runtime, dtype=dtype, backend=b), _grid_2d
+      yield 'octahedral_map', dict(common), \
+        lambda b=backend: tex_3d_to_octahedral_map(
+          ScalarConstantTexture(1, 3, 0), cl_runtime, dtype=dtype,
+          backend=b), _grid_2d
+      # A whole planet of noise at the same resolution at the equator, as a
+      # sphere map and as a cube map. Compare wall_s; the cube map computes
+      # fewer pixels.
+      yield 'planet_sphere_map', dict(common), \
+        lambda b=backend: tex_3d_to_sphere_map(OpenCLPerlinNoise3D(cl_runtime,
+          _PLANET_NUM_BOXES, dtype=dtype, backend=b), cl_runtime,
+          dtype=dtype, backend=b), _grid_2d
+      yield 'planet_cube_map', dict(common), \
+        lambda b=backend: tex_3d_to_cube_map(OpenCLPerlinNoise3D(cl_runtime,
+          _PLANET_NUM_BOXES, dtype=dtype, backend=b), cl_runtime,
+          dtype=dtype, backend=b), _grid_cube_map
+
+def _run_texture_case(cl_runtime, make_texture, make_eval_pts, resolution,
+  args):
+  random.seed(args.seed)
+  numpy.random.seed(args.seed)
+  texture = make_texture()
+  eval_pts = make_eval_pts(texture, resolution)
+  return _measure(cl_runtime,
+    lambda: texture.to_image(None, None, eval_pts=eval_pts),
+    int(numpy.prod(eval_pts.shape[:-1])), args.repeats)
+
+def _run_video_case(cl_runtime, resolution, args):
+  """Measures the frame rate of to_video on the first rock graph."""
+  if shutil.which('ffmpeg') is None:
+    return {'skipped': 'ffmpeg not found'}
+  random.seed(args.seed)
+  numpy.random.seed(args.seed)
+  texture = proc_tex.main.rock_test_0.make_texture(cl_runtime)
+  eval_pts = _grid_2d(texture, resolution)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    filename = os.path.join(temp_dir, 'benchmark.webm')
+    result = _measure(cl_runtime,
+      lambda: texture.to_video(None, None, args.video_frames, 30, filename,
+        pix_fmt='gray16le', codec_params=['-lossless', '1', '-speed', '8'],
+        eval_pts=eval_pts),
+      resolution * resolution * args.video_frames, args.repeats)
+  result['frames_per_s'] = args.video_frames / result['wall_s']
+  return result
+
+def _cases(args):
+  """Generates all benchmark cases.
+  returns: An iterator over (name, params, run) tuples, where run performs the
+    measurements of the case."""
+  sweep_idx = 1 if args.quick else 0
+  for precision in args.precisions:
+    cl_runtime = OpenCLRuntime(_make_context(args.device_type),
+      dtype=_PRECISIONS[precision], profiling=True)
+    
+    for name, params, make_texture, make_eval_pts in _noise_cases(cl_runtime,
+      precision, args):
+      yield name, params, lambda cl_runtime=cl_runtime, \
+        make_texture=make_texture, make_eval_pts=make_eval_pts, \
+        resolution=params['resolution']: _run_texture_case(cl_runtime,
+          make_texture, make_eval_pts, resolution, args)
+    
+    for resolution in _RESOLUTIONS[sweep_idx]:
+      params = {'resolution': resolution, 'precision': precision}
+      for name, module in [('rock_0', proc_tex.main.rock_test_0),
+        ('rock_1', proc_tex.main.rock_test_1)]:
+        yield name, params, lambda cl_runtime=cl_runtime, module=module, \
+          resolution=resolution: _run_texture_case(cl_runtime,
+            lambda: module.make_texture(cl_runtime), _grid_2d, resolution,
+            args)
+    
+    params = {'resolution': args.video_resolution, 'precision': precision,
+      'frames': args.video_frames}
+    yield 'rock_0_video', params, lambda cl_runtime=cl_runtime: \
+      _run_video_case(cl_runtime, args.video_resolution, args)
+
+def _case_key(name, params):
+  return name + ' ' + json.dumps(params, sort_keys=True)
+
+def _git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+      text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _metadata(args):
+  context = _make_context(args.device_type)
+  return {
+    'version': _RESULTS_VERSION,
+    'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'git_commit': _git_commit(),
+    'python': sys.version,
+    'platform': platform.platform(),
+    'numpy': numpy.__version__,
+    'pyopencl': pyopencl.VERSION_TEXT,
+    'devices': [{'name': device.name, 'platform': device.platform.name,
+      'version': device.version} for device in context.devices],
+    'quick': args.quick,
+    'repeats': args.repeats,
+  }
+
+def _compare(results, baseline_filename, tolerance):
+  """Prints the change in throughput relative to earlier results.
+  returns: Whether any case got slower by more than tolerance."""
+  with open(baseline_filename) as baseline_file:
+    baseline = json.load(baseline_file)
+  baseline_results = {_case_key(result['name'], result['params']): result
+    for result in baseline['results']}
+  regressed = False
+  for result in results:
+    old_result = baseline_results.get(_case_key(result['name'],
+      result['params']))
+    if old_result is None or 'mpix_per_s' not in old_result \
+      or 'mpix_per_s' not in result:
+      continue
+    ratio = result['mpix_per_s'] / old_result['mpix_per_s']
+    marker = ''
+    if ratio < 1 - tolerance:
+      marker = '  REGRESSION'
+      regressed = True
+    print('{:>7.2f}x  {}{}'.format(ratio,
+      _case_key(result['name'], result['params']), marker))
+  return regressed
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--output', default='benchmark_results.json',
+    help='JSON file in which to store the results.')
+  parser.add_argument('--compare', metavar='BASELINE',
+    help='JSON results of an earlier run to compare against.')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+    help='Relative slowdown reported as a regression by --compare.')
+  parser.add_argument('--device-type', choices=['cpu', 'gpu'],
+    help='Type of OpenCL device to use. By default, PyOpenCL chooses.')
+  parser.add_argument('--precisions', nargs='+', choices=sorted(_PRECISIONS),
+    default=sorted(_PRECISIONS))
+  parser.add_argument('--quick', action='store_true',
+    help='Run a smaller sweep.')
+  parser.add_argument('--repeats', type=int, default=3,
+    help='Number of timed runs per case.')
+  parser.add_argument('--filter', default='',
+    help='Only run cases whose name contains this string.')
+  parser.add_argument('--max-numpy-resolution', type=int, default=256,
+    help='Largest resolution at which to benchmark the Numpy backend.')
+  parser.add_argument('--video-resolution', type=int, default=512)
+  parser.add_argument('--video-frames', type=int, default=8)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  
+  results = []
+  for name, params, run in _cases(args):
+    if args.filter not in name:
+      continue
+    result = dict(name=name, params=params, **run())
+    results.append(result)
+    print('{:<60} {}'.format(_case_key(name, params),
+      'skipped ({})'.format(result['skipped']) if 'skipped' in result
+      else '{:10.2f} Mpix/s'.format(result['mpix_per_s'])), flush=True)
+  
+  with open(args.output, 'w') as output_file:
+    json.dump({'metadata': _metadata(args), 'results': results}, output_file,
+      indent=2)
+  
+  if args.compare is not None and _compare(results, args.compare,
+    args.tolerance):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
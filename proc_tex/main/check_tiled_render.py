@@ -0,0 +1,70 @@
+"""Checks that rendering the rock texture of rock_test_1 in tiles, or in bands
+on all the devices of the OpenCL context, gives the same image as rendering the
+whole frame at once. The texture's tex_scale_to_region textures measure the
+range of each frame, and the cellular noise ones are evaluated at points
+shifted by scaled Perlin noise, so this exercises the measuring passes of
+proc_tex.tiled_render.pin_frame_ranges. The multi-device render is only checked
+if the context has several devices.
+Exits with a nonzero status if the images differ by more than the tolerance.
+Run from the repository root, e.g.:
+  python -m proc_tex.main.check_tiled_render
+  PYOPENCL_CTX=0 python -m proc_tex.main.check_tiled_render --resolution 256"""
+
+import argparse
+import random
+import sys
+
+import numpy
+import pyopencl
+
+from proc_tex.multi_device import MultiDeviceTexture
+from proc_tex.opencl_runtime import OpenCLRuntime
+from proc_tex.tiled_render import TiledRenderer
+import proc_tex.main.rock_test_1
+
+def _max_diff(image, other_image):
+  return int(numpy.abs(image.astype(numpy.int64)
+    - other_image.astype(numpy.int64)).max())
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--resolution', type=int, default=512,
+    help='Width and height of the image, in pixels.')
+  parser.add_argument('--tile-size', type=int, default=128,
+    help='Width and height of the tiles, in pixels.')
+  # The pinned ranges and the ranges reduced on the device can round the scale
+  # and offset of tex_scale_to_region differently.
+  parser.add_argument('--tolerance', type=int, default=1,
+    help='Largest allowed difference between the images, in 16 bit steps.')
+  args = parser.parse_args()
+  
+  random.seed(345)
+  numpy.random.seed(345)
+  cl_runtime = OpenCLRuntime(pyopencl.create_some_context(interactive=False),
+    dtype=numpy.float32)
+  texture = proc_tex.main.rock_test_1.make_texture(cl_runtime)
+  pixel_dims = (args.resolution, args.resolution)
+  space_bounds = numpy.array([[0, 1], [0, 1]])
+  
+  full_image = texture.to_image(pixel_dims, space_bounds)
+  renderer = TiledRenderer(texture, pixel_dims, space_bounds,
+    (args.tile_size, args.tile_size))
+  tiled_image = renderer.render_into(numpy.empty_like(full_image))
+  
+  max_diffs = [_max_diff(full_image, tiled_image)]
+  print('Tiled render: maximum difference {}'.format(max_diffs[-1]))
+  
+  if len(cl_runtime.devices) > 1:
+    multi_device_image = MultiDeviceTexture(texture, cl_runtime).to_image(
+      pixel_dims, space_bounds)
+    max_diffs.append(_max_diff(full_image, multi_device_image))
+    print('Multi-device render: maximum difference {}'.format(max_diffs[-1]))
+  else:
+    print('Multi-device render: skipped, the context has one device')
+  
+  if max(max_diffs) > args.tolerance:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -2,17 +2,19 @@ import cv2
 import numpy
 import pyopencl
 
+from proc_tex.opencl_runtime import OpenCLRuntime
 from proc_tex.OpenCLGridNoise3D import OpenCLGridNoise3D
 from proc_tex.texture_transforms import tex_scale_to_region, tex_to_dtype
 from proc_tex.texture_transforms_opencl import tex_3d_to_sphere_map
 
 if __name__ == '__main__':
-  cl_context = pyopencl.create_some_context()
-  texture = tex_3d_to_sphere_map(OpenCLGridNoise3D(cl_context, 1000),
-    cl_context)
+  cl_runtime = OpenCLRuntime(pyopencl.create_some_context())
+  texture = tex_3d_to_sphere_map(OpenCLGridNoise3D(cl_runtime, 1000),
+    cl_runtime)
   texture = tex_to_dtype(tex_scale_to_region(texture), numpy.uint16,
     scale=65535)
-  eval_pts = texture.gen_eval_pts((1024, 1024), numpy.array([[0,1], [0,1]]))
+  eval_pts = texture.gen_eval_pts((1024, 1024), numpy.array([[0,1], [0,1]]),
+    implicit=True)
   image = texture.to_image(None, None, eval_pts=eval_pts)
   # cv2.imshow('image', image)
   # cv2.waitKey(0)
@@ -4,42 +4,59 @@ import cv2
 import numpy
 import pyopencl
 
+from proc_tex.opencl_runtime import OpenCLRuntime
 from proc_tex.texture_base import ScalarConstantTexture
 from proc_tex.OpenCLCellNoise3D import OpenCLCellNoise3D
 from proc_tex.OpenCLGridNoise3D import OpenCLGridNoise3D
 from proc_tex.OpenCLPerlinNoise3D import OpenCLPerlinNoise3D
 from proc_tex.texture_transforms import tex_scale_to_region, tex_to_dtype
+from proc_tex.texture_fusion import fuse_texture
+from proc_tex.texture_optimize import optimize_texture
 from proc_tex.texture_transforms_opencl import tex_3d_to_sphere_map
 
-if __name__ == '__main__':
-  random.seed(234)
-  numpy.random.seed(234)
-  
-  cl_context = pyopencl.create_some_context()
-  
+def make_texture(cl_runtime):
+  """Builds the rock texture graph, fused for cl_runtime. The graph depends on
+  the state of the random module."""
   # Combine cellular noise textures.
   texture = ScalarConstantTexture(1, 3, 0)
   cell_noise_params = [(5, 1, 1), (5, 1, -1), (8, 1, 0.5), (8, 1, -0.5), (10, 1, 0.25), (10, 1, -0.25), (12, 1, 0.125), (12, 1, -0.125)]
   for params in cell_noise_params:
-    cell_noise = OpenCLCellNoise3D(cl_context, params[0], params[1])
+    cell_noise = OpenCLCellNoise3D(cl_runtime, params[0], params[1])
     texture += params[2] * tex_scale_to_region(cell_noise, -0.5, 0.5)
   
-  # Combine Perlin noise textures.
+  # Combine Perlin noise textures. The grids are fine enough that generating
+  # the gradients when needed beats storing millions of them.
   perlin_noise_params = [(200, 0.05), (100, 0.02)]
   for params in perlin_noise_params:
-    perlin_noise = OpenCLPerlinNoise3D(cl_context, params[0])
+    perlin_noise = OpenCLPerlinNoise3D(cl_runtime, params[0],
+      hashed_gradients=True)
     texture += params[1] * tex_scale_to_region(perlin_noise, -0.5, 0.5)
   
   # Combine grid noise textures.
   grid_noise_params = [(2000, 0.01)]
   for params in grid_noise_params:
-    grid_noise = OpenCLGridNoise3D(cl_context, params[0])
+    grid_noise = OpenCLGridNoise3D(cl_runtime, params[0])
     texture += params[1] * tex_scale_to_region(grid_noise, -0.5, 0.5)
   
   texture = tex_to_dtype(
-    tex_scale_to_region(tex_3d_to_sphere_map(texture, cl_context)),
+    tex_scale_to_region(tex_3d_to_sphere_map(texture, cl_runtime)),
     numpy.uint16, scale=65535)
-  eval_pts = texture.gen_eval_pts((2048, 2048), numpy.array([[0,1], [0,1]]))
+  
+  # Simplify the arithmetic, then compile the texture graph into fused OpenCL
+  # kernels.
+  return fuse_texture(optimize_texture(texture), cl_runtime)
+
+if __name__ == '__main__':
+  random.seed(234)
+  numpy.random.seed(234)
+  
+  # Single precision is plenty for a 16 bit image.
+  cl_runtime = OpenCLRuntime(pyopencl.create_some_context(),
+    dtype=numpy.float32)
+  
+  texture = make_texture(cl_runtime)
+  eval_pts = texture.gen_eval_pts((2048, 2048), numpy.array([[0,1], [0,1]]),
+    implicit=True)
   image = texture.to_image(None, None, eval_pts=eval_pts)
   # cv2.imshow('image', image)
   # cv2.waitKey(0)
@@ -0,0 +1,155 @@
+import concurrent.futures
+import time
+
+import numpy
+
+from proc_tex.texture_base import EvalCache, ImplicitGridPts, Texture
+from proc_tex.tiled_render import pin_frame_ranges
+
+# Weight of the newest measurement in the running device throughput estimates.
+_THROUGHPUT_SMOOTHING = 0.5
+
+def _eval_pts_rows(eval_pts, start, stop):
+  """Gets a range of rows (along the first dimension) of evaluation points."""
+  if isinstance(eval_pts, ImplicitGridPts):
+    return eval_pts.row_slice(start, stop)
+  return eval_pts[start:stop]
+
+class MultiDeviceTexture(Texture):
+  """Evaluates a texture graph on all devices of an OpenCLRuntime's context at
+  once.
+  The evaluation points are split into bands of rows, one per device, with
+  band sizes weighted by the measured throughput of each device. Each band is
+  evaluated from its own thread using the device's queue (see
+  OpenCLRuntime.use_device), and the results are gathered into one array.
+  Animation state such as cell points and gradients lives in buffers of the
+  shared context, which OpenCL makes available to every device.
+  tex_scale_to_region textures in RANGE_MODE_FRAME still normalize by the
+  range over all the evaluation points, at the cost of one extra pass per
+  level of nesting, counting textures that shift the evaluation points of
+  others (see proc_tex.tiled_render.pin_frame_ranges).
+  To use several devices, create the OpenCLRuntime from a context containing
+  them, e.g. pyopencl.Context(devices)."""
+  def __init__(self, src, cl_runtime):
+    """Initializer.
+    src - Root of the texture graph to evaluate. All OpenCL textures in it
+      must use cl_runtime.
+    cl_runtime - The OpenCLRuntime whose devices to use."""
+    super(MultiDeviceTexture, self).__init__(src.num_channels,
+      src.num_space_dims, [src])
+    self.src = src
+    self.cl_runtime = cl_runtime
+    # Nominal compute capacity of each device, in arbitrary units. Only used
+    # to estimate the throughput of devices that have not been measured yet.
+    self.nominal_capacities = [float(device.max_compute_units
+      * max(1, device.max_clock_frequency))
+      for device in cl_runtime.devices]
+    # Measured rows per second for each device, or None until the device has
+    # evaluated some rows.
+    self.throughputs = [None] * len(self.nominal_capacities)
+    self._executor = None
+  
+  def evaluate(self, eval_pts):
+    if len(self.cl_runtime.devices) == 1 or len(eval_pts) < 2:
+      return self.src.evaluate(eval_pts)
+    
+    # Commands enqueued on one device's queue, such as animation updates,
+    # must finish before other devices use their results.
+    self.cl_runtime.finish()
+    
+    with pin_frame_ranges(self.src, lambda: self._split_evaluate(eval_pts)):
+      return self._split_evaluate(eval_pts)
+  
+  def analytic_value_range(self):
+    return self.src.value_range()
+  
+  def estimated_throughputs(self):
+    """Estimates the rows per second of each device. Devices that have not
+    been measured yet are estimated from their nominal compute capacity,
+    converted to rows per second with the ratio of throughput to capacity of
+    the measured devices.
+    returns: A list with the estimate for each device."""
+    measured = [device_idx
+      for device_idx, throughput in enumerate(self.throughputs)
+      if throughput is not None]
+    if measured:
+      rows_per_capacity = sum(self.throughputs[device_idx]
+        for device_idx in measured) \
+        / sum(self.nominal_capacities[device_idx] for device_idx in measured)
+    else:
+      rows_per_capacity = 1.0
+    return [rows_per_capacity * capacity if throughput is None else throughput
+      for throughput, capacity
+      in zip(self.throughputs, self.nominal_capacities)]
+  
+  def row_bounds(self, num_rows):
+    """Splits rows between the devices in proportion to their estimated
+    throughputs (see estimated_throughputs).
+    num_rows - Number of rows to split.
+    returns: A (start, stop) tuple for each device. Every device that has not
+      been measured yet gets at least one row, if there are enough rows, so
+      that its estimate is replaced by a measurement. Slow measured devices
+      may get no rows."""
+    throughputs = self.estimated_throughputs()
+    min_rows = [0] * len(throughputs)
+    unmeasured = [device_idx
+      for device_idx, throughput in enumerate(self.throughputs)
+      if throughput is None]
+    for device_idx in unmeasured[:num_rows]:
+      min_rows[device_idx] = 1
+    
+    # The remaining rows are split in proportion to the throughputs.
+    free_rows = num_rows - sum(min_rows)
+    total = sum(throughputs)
+    bounds = []
+    start = 0
+    cumulative = 0
+    prev_share = 0
+    for throughput, device_min_rows in zip(throughputs, min_rows):
+      cumulative += throughput
+      share = int(round(free_rows * cumulative / total))
+      stop = start + device_min_rows + share - prev_share
+      bounds.append((start, stop))
+      start = stop
+      prev_share = share
+    return bounds
+  
+  def _split_evaluate(self, eval_pts):
+    if self._executor is None:
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+        len(self.cl_runtime.devices))
+    
+    row_bounds = self.row_bounds(len(eval_pts))
+    futures = {device_idx: self._executor.submit(self._evaluate_rows,
+      device_idx, _eval_pts_rows(eval_pts, start, stop))
+      for device_idx, (start, stop) in enumerate(row_bounds) if stop > start}
+    results = {device_idx: future.result()
+      for device_idx, future in futures.items()}
+    
+    # Update the throughput estimates from the time each device took.
+    for device_idx, (_, elapsed) in results.items():
+      start, stop = row_bounds[device_idx]
+      if elapsed <= 0:
+        continue
+      throughput = (stop - start) / elapsed
+      if self.throughputs[device_idx] is not None:
+        throughput = (1 - _THROUGHPUT_SMOOTHING) \
+          * self.throughputs[device_idx] + _THROUGHPUT_SMOOTHING * throughput
+      self.throughputs[device_idx] = throughput
+    
+    # Gather the bands into one array.
+    dtype = numpy.result_type(*[values for values, _ in results.values()])
+    result = numpy.empty(tuple(eval_pts.shape[:-1]) + (self.num_channels,),
+      dtype=dtype)
+    for device_idx, (values, _) in results.items():
+      start, stop = row_bounds[device_idx]
+      result[start:stop] = values
+    return result
+  
+  def _evaluate_rows(self, device_idx, eval_pts):
+    """Evaluates some rows on a device, from a worker thread.
+    returns: A (values, elapsed seconds) tuple."""
+    start_time = time.perf_counter()
+    with self.cl_runtime.use_device(device_idx), EvalCache(self.src):
+      values = self.src.evaluate(eval_pts)
+    return values, time.perf_counter() - start_time
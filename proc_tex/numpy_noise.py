@@ -0,0 +1,679 @@
+import itertools
+
+import numpy
+
+from proc_tex.texture_base import ImplicitGridPts
+import proc_tex.cell_features
+import proc_tex.dist_metrics
+
+# Backends for evaluating the noise textures.
+BACKEND_OPENCL = 'opencl'
+BACKEND_NUMPY = 'numpy'
+# Chooses Numpy for small amounts of work, where OpenCL kernel launch and
+# transfer overhead would dominate, and OpenCL otherwise.
+BACKEND_AUTO = 'auto'
+
+# With BACKEND_AUTO, evaluations costing at most this many work units (roughly
+# one distance or gradient computation per unit) are done with Numpy.
+AUTO_MAX_NUMPY_WORK = 2 ** 16
+
+# Default limit on the number of elements in the largest temporary array used
+# by a single chunk of an evaluation. Evaluation points are processed in chunks
+# small enough to stay below it, which bounds the temporary memory used
+# regardless of the number of points.
+DEFAULT_CHUNK_ELEMS = 2 ** 20
+
+# Constants of the PCG generator in random.clh.
+_PCG_MULTIPLIER = numpy.uint32(747796405)
+_PCG_INCREMENT = numpy.uint32(2891336453)
+_RXS_M_XS_MULTIPLIER = numpy.uint32(277803737)
+_MAX_UINT = 4294967295
+
+def use_numpy(backend, cl_runtime, work):
+  """Decides whether to evaluate with Numpy instead of OpenCL.
+  backend - One of the BACKEND_* constants.
+  cl_runtime - The OpenCLRuntime of the texture, or None if it has none.
+  work - Estimated cost of the evaluation, in work units (see
+    AUTO_MAX_NUMPY_WORK)."""
+  if cl_runtime is None or backend == BACKEND_NUMPY:
+    return True
+  if backend == BACKEND_OPENCL:
+    return False
+  return work <= AUTO_MAX_NUMPY_WORK
+
+def check_backend(backend, cl_runtime):
+  """Validates the backend and runtime given to a texture initializer."""
+  if backend not in (BACKEND_OPENCL, BACKEND_NUMPY, BACKEND_AUTO):
+    raise ValueError('Unknown backend: {}'.format(backend))
+  if backend == BACKEND_OPENCL and cl_runtime is None:
+    raise ValueError('The OpenCL backend needs an OpenCLRuntime.')
+
+def backend_dtype(cl_runtime, dtype):
+  """Determines the computation dtype of a texture that may have no
+  OpenCLRuntime. Defaults to cl_runtime.dtype, or numpy.float64 without a
+  runtime."""
+  if dtype is None:
+    dtype = numpy.float64 if cl_runtime is None else cl_runtime.dtype
+  return numpy.dtype(dtype)
+
+def hash_uint(values):
+  """Hashes 32-bit values like hashUint in random.clh.
+  values - Array of numpy.uint32 values."""
+  with numpy.errstate(over='ignore'):
+    state = values * _PCG_MULTIPLIER + _PCG_INCREMENT
+    word = ((state >> ((state >> numpy.uint32(28)) + numpy.uint32(4)))
+      ^ state) * _RXS_M_XS_MULTIPLIER
+    return (word >> numpy.uint32(22)) ^ word
+
+def init_rand_state(seed_base, indices, frame_idx):
+  """Computes initial random generator states like initRandState in
+  random.clh.
+  seed_base - Random seed shared by all the states.
+  indices - Array of indices, one per state.
+  frame_idx - Index of the animation frame."""
+  frame_hash = hash_uint(numpy.array([frame_idx], dtype=numpy.uint32))
+  return hash_uint(numpy.uint32(seed_base)
+    ^ hash_uint(numpy.asarray(indices, dtype=numpy.uint32) ^ frame_hash))
+
+class RandStates:
+  """Array of independent random generators, generating the same values as
+  the functions in random.clh would for the same states."""
+  def __init__(self, states, dtype):
+    """Initializer.
+    states - Array of numpy.uint32 initial states, e.g. from
+      init_rand_state.
+    dtype - Floating point dtype for generated real numbers."""
+    self.states = numpy.array(states, dtype=numpy.uint32)
+    self.dtype = numpy.dtype(dtype)
+  
+  def rand_uint(self, mask=None):
+    """Generates a value like randUint, for each generator or the generators
+    selected by a boolean mask."""
+    states = self.states if mask is None else self.states[mask]
+    result = hash_uint(states)
+    with numpy.errstate(over='ignore'):
+      states = states * _PCG_MULTIPLIER + _PCG_INCREMENT
+    if mask is None:
+      self.states = states
+    else:
+      self.states[mask] = states
+    return result
+  
+  def rand_double(self, mask=None):
+    """Generates a value like randDouble."""
+    return self.rand_uint(mask).astype(self.dtype) \
+      / self.dtype.type(_MAX_UINT)
+  
+  def rand_double_in_range(self, min_val, max_val, mask=None):
+    """Generates a value like randDoubleInRange. The bounds may be arrays."""
+    min_val = numpy.asarray(min_val, dtype=self.dtype)
+    max_val = numpy.asarray(max_val, dtype=self.dtype)
+    return self.rand_double(mask) * (max_val - min_val) + min_val
+  
+  def rand_vec_with_magnitude(self, magnitude, num_dims):
+    """Generates a vector like randVecWithMagnitude2D or
+    randVecWithMagnitude3D.
+    magnitude - Magnitude for each generator.
+    num_dims - 2 or 3.
+    returns: Array of shape (number of generators, num_dims)."""
+    num_states = len(self.states)
+    vecs = numpy.zeros((num_states, num_dims), dtype=self.dtype)
+    lengths = numpy.zeros(num_states, dtype=self.dtype)
+    # Redraw the vectors of zero length, like the kernels' loops do.
+    mask = lengths == 0
+    while mask.any():
+      one = self.dtype.type(1)
+      vecs[mask] = numpy.stack([self.rand_double_in_range(-one, one, mask)
+        for _ in range(num_dims)], axis=-1)
+      lengths[mask] = numpy.sqrt(numpy.sum(vecs[mask] * vecs[mask], axis=-1))
+      mask = lengths == 0
+    return vecs * numpy.asarray(magnitude, dtype=self.dtype)[..., None] \
+      / lengths[..., None]
+
+def _box_bounds(num_boxes_h, pts_per_box, num_dims, dtype, pt_indices=None):
+  """Computes the grid box bounds of cell points, like computeBoxBounds2D
+  and computeBoxBounds3D in cellPoints.clh.
+  pt_indices - Array of the indices of the cell points, or None for every
+    cell point.
+  returns: A (low bounds, high bounds) tuple of arrays of shape
+    (number of cell points, num_dims)."""
+  box_width = dtype.type(1) / dtype.type(num_boxes_h)
+  if pt_indices is None:
+    pt_indices = numpy.arange(num_boxes_h ** num_dims * pts_per_box)
+  box_idx = pt_indices // pts_per_box
+  coords = numpy.stack([(box_idx // num_boxes_h ** dim) % num_boxes_h
+    for dim in range(num_dims)], axis=-1).astype(dtype)
+  low_bounds = coords * box_width
+  return low_bounds, low_bounds + box_width
+
+def cell_noise_anim_init(seed, num_boxes_h, pts_per_box, num_dims, max_speed,
+  dtype, first_idx=0):
+  """Randomly initializes cell points like cellNoise2DAnimInit and
+  cellNoise3DAnimInit.
+  seed - Random seed of the texture.
+  num_dims - 2 or 3.
+  max_speed - Maximum cell point speed, in space units per frame.
+  dtype - Floating point dtype for the results.
+  first_idx - Index of the first cell point in a larger array of points
+    sharing the seed, like the seedIdx of cellNoise3DAnimInitPt.
+  returns: A (cell points, velocities) tuple of arrays of shape
+    (number of cell points, num_dims), grouped by grid box."""
+  dtype = numpy.dtype(dtype)
+  low_bounds, high_bounds = _box_bounds(num_boxes_h, pts_per_box, num_dims,
+    dtype)
+  rand = RandStates(init_rand_state(seed,
+    first_idx + numpy.arange(len(low_bounds)), 0), dtype)
+  cell_pts = numpy.stack([rand.rand_double_in_range(low_bounds[:,dim],
+    high_bounds[:,dim]) for dim in range(num_dims)], axis=-1)
+  speeds = rand.rand_double_in_range(0, max_speed)
+  cell_vels = rand.rand_vec_with_magnitude(speeds, num_dims)
+  return cell_pts, cell_vels
+
+def procedural_cell_pts(seed, num_boxes_h, pts_per_box, num_dims, dtype,
+  box_indices):
+  """Generates the cell points of some grid boxes from a hash of the seed,
+  like getCellPt2D and getCellPt3D with a null cell points array. These are
+  the initial points of cell_noise_anim_init.
+  box_indices - Array of the indices of the grid boxes.
+  See cell_noise_anim_init for the other arguments.
+  returns: Array of shape box_indices.shape + (pts_per_box, num_dims)."""
+  dtype = numpy.dtype(dtype)
+  box_indices = numpy.asarray(box_indices)
+  pt_indices = (box_indices[..., None] * pts_per_box
+    + numpy.arange(pts_per_box)).reshape(-1)
+  low_bounds, high_bounds = _box_bounds(num_boxes_h, pts_per_box, num_dims,
+    dtype, pt_indices)
+  rand = RandStates(init_rand_state(seed, pt_indices, 0), dtype)
+  cell_pts = numpy.stack([rand.rand_double_in_range(low_bounds[:,dim],
+    high_bounds[:,dim]) for dim in range(num_dims)], axis=-1)
+  return cell_pts.reshape(box_indices.shape + (pts_per_box, num_dims))
+
+def cell_noise_anim_update(seed, frame_idx, num_boxes_h, pts_per_box,
+  max_speed, max_accel, cell_pts, cell_vels, first_idx=0):
+  """Moves cell points to a frame like cellNoise2DAnimUpdate and
+  cellNoise3DAnimUpdate.
+  frame_idx - Index of the frame being generated.
+  max_accel - Maximum cell point acceleration, in space units per frame
+    squared.
+  cell_pts - Array of cell points, as returned by cell_noise_anim_init.
+    Updated in place.
+  cell_vels - Array of cell point velocities. Updated in place.
+  See cell_noise_anim_init for the other arguments."""
+  dtype = cell_pts.dtype
+  num_dims = cell_pts.shape[-1]
+  max_speed = dtype.type(max_speed)
+  rand = RandStates(init_rand_state(seed,
+    first_idx + numpy.arange(len(cell_pts)), frame_idx), dtype)
+  
+  # Generate random accelerations, and limit the speed.
+  accel_mags = rand.rand_double_in_range(0, max_accel)
+  new_vels = cell_vels + rand.rand_vec_with_magnitude(accel_mags, num_dims)
+  speeds_squared = numpy.sum(new_vels * new_vels, axis=-1)
+  too_fast = speeds_squared > max_speed * max_speed
+  new_vels[too_fast] *= (max_speed
+    / numpy.sqrt(speeds_squared[too_fast]))[:, None]
+  new_pts = cell_pts + new_vels
+  
+  # Clamp the positions and velocities to the grid boxes.
+  low_bounds, high_bounds = _box_bounds(num_boxes_h, pts_per_box, num_dims,
+    dtype)
+  too_low = new_pts < low_bounds
+  too_high = ~too_low & (new_pts > high_bounds)
+  new_pts[too_low] = low_bounds[too_low]
+  new_pts[too_high] = high_bounds[too_high]
+  new_vels[too_low | too_high] = 0
+  
+  cell_pts[...] = new_pts
+  cell_vels[...] = new_vels
+
+def anim_key(frame_idx, frames_per_key):
+  """Splits a frame index into the keyIdx and keyFrac arguments of
+  hashedGradient3D.
+  frames_per_key - Number of frames from one animation key to the next.
+  returns: A (key index, fraction) tuple."""
+  return frame_idx // frames_per_key, \
+    (frame_idx % frames_per_key) / frames_per_key
+
+def hashed_gradients(seed, indices, key_idx, key_frac, dtype):
+  """Generates the gradients of grid boxes like hashedGradient3D.
+  indices - Array of grid box indices.
+  key_idx - Index of the animation key at or before the frame.
+  key_frac - Position of the frame between key key_idx and the next key.
+  returns: Array of shape (len(indices), 3)."""
+  dtype = numpy.dtype(dtype)
+  ones = numpy.ones(len(indices), dtype=dtype)
+  gradients = RandStates(init_rand_state(seed, indices, key_idx),
+    dtype).rand_vec_with_magnitude(ones, 3)
+  if key_frac > 0:
+    next_gradients = RandStates(init_rand_state(seed, indices, key_idx + 1),
+      dtype).rand_vec_with_magnitude(ones, 3)
+    mixed = gradients + (next_gradients - gradients) * dtype.type(key_frac)
+    lengths = numpy.sqrt(numpy.sum(mixed * mixed, axis=-1))
+    nonzero = lengths > 0
+    gradients[nonzero] = mixed[nonzero] / lengths[nonzero, None]
+  return gradients
+
+def perlin_noise_gradients(seed, key_idx, num_gradients, dtype, key_frac=0):
+  """Generates the gradients of a frame like perlinNoise3DAnimUpdate.
+  key_idx - Index of the animation key at or before the frame. Equal to the
+    frame index if every frame is a key.
+  key_frac - Position of the frame between key key_idx and the next key.
+  returns: Array of shape (num_gradients, 3)."""
+  return hashed_gradients(seed, numpy.arange(num_gradients), key_idx,
+    key_frac, dtype)
+
+def _grid_pts(grid, dtype):
+  """Generates the points of an ImplicitGridPts in the specified dtype, like
+  ImplicitGridPts.to_array, but rounded like implicitGridCoord in
+  implicitGrid.clh."""
+  pixel_dims_ranges = [numpy.arange(start, stop).astype(dtype)
+    for start, stop in grid.tile_bounds]
+  pts = numpy.stack(numpy.meshgrid(*pixel_dims_ranges), axis=-1)
+  return (pts + dtype.type(0.5)) * grid.scale.astype(dtype) \
+    + grid.offset.astype(dtype)
+
+def _iter_chunks(eval_pts, chunk_pts, dtype):
+  """Splits evaluation points into chunks.
+  eval_pts - Array or ImplicitGridPts of evaluation points.
+  chunk_pts - Maximum number of points per chunk. Implicit grids are split
+    into whole rows, so their chunks contain at least one row.
+  returns: An iterator over (start, stop, points) tuples, where start and stop
+    are the range of flattened point indices in the chunk and points is an
+    array of shape (stop - start, number of space dimensions)."""
+  num_dims = eval_pts.shape[-1]
+  num_pts = int(numpy.prod(eval_pts.shape[:-1]))
+  if isinstance(eval_pts, ImplicitGridPts):
+    # Generate the points of a chunk of rows at a time, so that the whole grid
+    # is never in memory.
+    num_rows = eval_pts.shape[0]
+    row_size = num_pts // num_rows if num_rows else 0
+    rows_per_chunk = max(1, chunk_pts // max(1, row_size))
+    for start_row in range(0, num_rows, rows_per_chunk):
+      stop_row = min(num_rows, start_row + rows_per_chunk)
+      pts = _grid_pts(eval_pts.row_slice(start_row, stop_row), dtype)
+      yield start_row * row_size, stop_row * row_size, \
+        pts.reshape(-1, num_dims)
+  else:
+    flat_pts = numpy.asarray(eval_pts).reshape(-1, num_dims)
+    for start in range(0, num_pts, chunk_pts):
+      stop = min(num_pts, start + chunk_pts)
+      yield start, stop, flat_pts[start:stop].astype(dtype)
+
+def _evaluate_chunked(eval_pts, dtype, elems_per_pt, chunk_elems,
+  evaluate_chunk, num_channels=1):
+  """Evaluates a noise function in chunks.
+  elems_per_pt - Number of elements per evaluation point in the largest
+    temporary array used by evaluate_chunk.
+  evaluate_chunk - Function mapping an array of points of shape (N, number of
+    space dimensions) to an array of N values, or of shape (N, num_channels).
+  returns: Array of results with shape
+    eval_pts.shape[:-1] + (num_channels,)."""
+  result = numpy.empty(tuple(eval_pts.shape[:-1]) + (num_channels,),
+    dtype=dtype)
+  flat_result = result.reshape(-1, num_channels)
+  chunk_pts = max(1, chunk_elems // elems_per_pt)
+  for start, stop, pts in _iter_chunks(eval_pts, chunk_pts, dtype):
+    flat_result[start:stop] = evaluate_chunk(pts).reshape(stop - start,
+      num_channels)
+  return result
+
+def normalize_tex_pts(pts):
+  """Normalizes texture points into the unit (hyper-)cube like
+  normalizeTexCoord in texCoordTransforms.clh."""
+  one = pts.dtype.type(1)
+  pts = numpy.where(pts < 0, pts - (numpy.trunc(pts) - one), pts)
+  return numpy.fmod(pts, one)
+
+def _find_boxes(box_size, pts):
+  """Finds the grid boxes containing normalized points like findBoxForPt2D and
+  findBoxForPt3D."""
+  return numpy.trunc(pts / box_size).astype(numpy.int64)
+
+def _normalize_box_coords(num_boxes_h, coords):
+  """Wraps grid box coordinates into the base box like normalizeBoxCoord."""
+  coords = numpy.where(coords < 0, coords + num_boxes_h, coords)
+  return numpy.where(coords >= num_boxes_h, coords - num_boxes_h, coords)
+
+def _box_indices(num_boxes_h, coords):
+  """Computes the index of each grid box from its normalized coordinates,
+  with the first coordinate varying fastest."""
+  indices = numpy.zeros(coords.shape[:-1], dtype=numpy.int64)
+  for dim in reversed(range(coords.shape[-1])):
+    indices = indices * num_boxes_h + coords[..., dim]
+  return indices
+
+def _dist(metric, deltas, minkowski_p):
+  """Computes a distance metric from coordinate deltas like
+  computeDist2DDelta and computeDist3DDelta.
+  deltas - Array of absolute deltas, with the coordinates along the last
+    axis.
+  minkowski_p - Exponent of METRIC_MINKOWSKI."""
+  if metric == proc_tex.dist_metrics.METRIC_L1_NORM:
+    return deltas.sum(axis=-1)
+  if metric == proc_tex.dist_metrics.METRIC_LINF_NORM:
+    return deltas.max(axis=-1)
+  if metric == proc_tex.dist_metrics.METRIC_MINKOWSKI:
+    p = deltas.dtype.type(minkowski_p)
+    return (deltas ** p).sum(axis=-1) ** (deltas.dtype.type(1) / p)
+  squared = deltas[..., 0] * deltas[..., 0]
+  for dim in range(1, deltas.shape[-1]):
+    squared = squared + deltas[..., dim] * deltas[..., dim]
+  if metric == proc_tex.dist_metrics.METRIC_L2_NORM_SQUARED:
+    return squared
+  return numpy.sqrt(squared)
+
+def cell_noise(num_boxes_h, pts_per_box, metric, cell_pts, eval_pts,
+  chunk_elems=DEFAULT_CHUNK_ELEMS,
+  minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+  """Computes 2D or 3D cellular noise like cellNoise2DAt and cellNoise3DAt.
+  num_boxes_h - Number of grid box spaces lying along each axis.
+  pts_per_box - Number of cell points in each grid box.
+  metric - One of the METRIC_* constants from proc_tex.dist_metrics.
+  cell_pts - Array of cell points of shape (number of cell points, number of
+    space dimensions), grouped by grid box. Its dtype is used for computation
+    and results.
+  eval_pts - Array or ImplicitGridPts of evaluation points.
+  chunk_elems - Maximum number of elements in the temporary arrays of a
+    chunk.
+  minkowski_p - Exponent of METRIC_MINKOWSKI.
+  returns: Array of results with shape eval_pts.shape[:-1] + (1,)."""
+  num_dims = cell_pts.shape[-1]
+  box_pts = cell_pts.reshape(-1, pts_per_box, num_dims)
+  return _cell_noise(num_boxes_h, pts_per_box, metric,
+    lambda box_indices: box_pts[box_indices], num_dims, cell_pts.dtype,
+    eval_pts, chunk_elems, minkowski_p)
+
+def cell_noise_procedural(num_boxes_h, pts_per_box, metric, seed, num_dims,
+  eval_pts, dtype, chunk_elems=DEFAULT_CHUNK_ELEMS,
+  minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+  """Computes 2D or 3D cellular noise with procedural cell points like
+  cellNoise2DProceduralAt and cellNoise3DProceduralAt, generating only the
+  cell points of the grid boxes around each chunk of evaluation points.
+  num_dims - Number of space dimensions, 2 or 3.
+  See procedural_cell_pts and cell_noise for the other arguments."""
+  dtype = numpy.dtype(dtype)
+  return _cell_noise(num_boxes_h, pts_per_box, metric,
+    lambda box_indices: procedural_cell_pts(seed, num_boxes_h, pts_per_box,
+    num_dims, dtype, box_indices), num_dims, dtype, eval_pts, chunk_elems,
+    minkowski_p)
+
+def _cell_noise(num_boxes_h, pts_per_box, metric, get_box_pts, num_dims,
+  dtype, eval_pts, chunk_elems, minkowski_p):
+  """Computes 2D or 3D cellular noise like cellNoise2DAt and cellNoise3DAt.
+  get_box_pts - Function mapping an array of grid box indices to an array of
+    the cell points of those boxes, of shape (number of indices, pts_per_box,
+    num_dims)."""
+  box_size = dtype.type(1) / dtype.type(num_boxes_h)
+  one = dtype.type(1)
+  
+  def evaluate_chunk(pts):
+    pts = normalize_tex_pts(pts)
+    box_coords = _find_boxes(box_size, pts)
+    min_dists = numpy.full(len(pts), numpy.inf, dtype=dtype)
+    # Check the cell points of the neighboring boxes one box offset at a time.
+    for offset in itertools.product((-1, 0, 1), repeat=num_dims):
+      neighbor_coords = _normalize_box_coords(num_boxes_h,
+        box_coords + numpy.array(offset))
+      neighbor_pts = get_box_pts(_box_indices(num_boxes_h, neighbor_coords))
+      deltas = numpy.abs(neighbor_pts - pts[:, None, :])
+      deltas = numpy.minimum(deltas, one - deltas)
+      numpy.minimum(min_dists, _dist(metric, deltas, minkowski_p).min(axis=-1),
+        out=min_dists)
+    return min_dists
+  
+  return _evaluate_chunked(eval_pts, dtype, pts_per_box * num_dims,
+    chunk_elems, evaluate_chunk)
+
+def cell_noise_features(num_boxes_h, pts_per_box, metric, cell_pts, features,
+  eval_pts, chunk_elems=DEFAULT_CHUNK_ELEMS,
+  minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+  """Computes features of 2D or 3D cellular noise like cellNoise2DFeatures and
+  cellNoise3DFeatures.
+  features - Sequence of FEATURE_* constants from proc_tex.cell_features, one
+    per output channel.
+  See cell_noise for the other parameters.
+  returns: Array of results with shape eval_pts.shape[:-1] + (len(features),).
+  """
+  num_dims = cell_pts.shape[-1]
+  box_pts = cell_pts.reshape(-1, pts_per_box, num_dims)
+  return _cell_noise_features(num_boxes_h, pts_per_box, metric,
+    lambda box_indices: box_pts[box_indices], num_dims, cell_pts.dtype,
+    features, eval_pts, chunk_elems, minkowski_p)
+
+def cell_noise_features_procedural(num_boxes_h, pts_per_box, metric, seed,
+  num_dims, features, eval_pts, dtype, chunk_elems=DEFAULT_CHUNK_ELEMS,
+  minkowski_p=proc_tex.dist_metrics.MINKOWSKI_P_DEFAULT):
+  """Computes features of 2D or 3D cellular noise with procedural cell
+  points, like cell_noise_procedural.
+  See cell_noise_procedural and cell_noise_features for the arguments."""
+  dtype = numpy.dtype(dtype)
+  return _cell_noise_features(num_boxes_h, pts_per_box, metric,
+    lambda box_indices: procedural_cell_pts(seed, num_boxes_h, pts_per_box,
+    num_dims, dtype, box_indices), num_dims, dtype, features, eval_pts,
+    chunk_elems, minkowski_p)
+
+def _cell_noise_features(num_boxes_h, pts_per_box, metric, get_box_pts,
+  num_dims, dtype, features, eval_pts, chunk_elems, minkowski_p):
+  """Computes features of 2D or 3D cellular noise like cellNoise2DFeatures
+  and cellNoise3DFeatures.
+  get_box_pts - See _cell_noise."""
+  num_cell_pts = num_boxes_h ** num_dims * pts_per_box
+  box_size = dtype.type(1) / dtype.type(num_boxes_h)
+  one = dtype.type(1)
+  offsets = list(itertools.product((-1, 0, 1), repeat=num_dims))
+  
+  def evaluate_chunk(pts):
+    pts = normalize_tex_pts(pts)
+    box_coords = _find_boxes(box_size, pts)
+    # Collect the distances to the cell points of all the neighboring boxes,
+    # in the order cellNoise2DFeaturesAt and cellNoise3DFeaturesAt visit them.
+    dists = []
+    pt_indices = []
+    for offset in offsets:
+      neighbor_coords = _normalize_box_coords(num_boxes_h,
+        box_coords + numpy.array(offset))
+      box_indices = _box_indices(num_boxes_h, neighbor_coords)
+      deltas = numpy.abs(get_box_pts(box_indices) - pts[:, None, :])
+      deltas = numpy.minimum(deltas, one - deltas)
+      dists.append(_dist(metric, deltas, minkowski_p))
+      pt_indices.append(box_indices[:, None] * pts_per_box
+        + numpy.arange(pts_per_box))
+    dists = numpy.concatenate(dists, axis=-1)
+    pt_indices = numpy.concatenate(pt_indices, axis=-1)
+    
+    # The first closest point wins ties, like cellFeaturesAddPt. Repeated
+    # appearances of the closest point are ignored when looking for the
+    # second closest.
+    nearest = dists.argmin(axis=-1)
+    rows = numpy.arange(len(pts))
+    f1 = dists[rows, nearest]
+    nearest_indices = pt_indices[rows, nearest]
+    f2 = numpy.where(pt_indices == nearest_indices[:, None],
+      dtype.type(numpy.inf), dists).min(axis=-1)
+    values = {proc_tex.cell_features.FEATURE_F1: f1,
+      proc_tex.cell_features.FEATURE_F2: f2,
+      proc_tex.cell_features.FEATURE_F2_MINUS_F1: f2 - f1,
+      proc_tex.cell_features.FEATURE_CELL_ID:
+        nearest_indices.astype(dtype) / dtype.type(num_cell_pts)}
+    return numpy.stack([values[feature] for feature in features], axis=-1)
+  
+  # The distances, point indices and F2 mask are the largest temporaries.
+  return _evaluate_chunked(eval_pts, dtype, 3 * len(offsets) * pts_per_box,
+    chunk_elems, evaluate_chunk, len(features))
+
+def _smoothstep(values):
+  """Computes OpenCL's smoothstep(0, 1, values)."""
+  zero = values.dtype.type(0)
+  one = values.dtype.type(1)
+  values = numpy.clip(values, zero, one)
+  return values * values * (values.dtype.type(3) - values.dtype.type(2)
+    * values)
+
+def perlin_noise(num_boxes_h, gradients, eval_pts,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Computes 3D Perlin noise like perlinNoise3DAt.
+  gradients - Array of gradients of shape (number of grid boxes, 3). Its dtype
+    is used for computation and results.
+  See cell_noise for the other arguments."""
+  return _perlin_noise(num_boxes_h, lambda indices: gradients[indices],
+    gradients.dtype, eval_pts, chunk_elems)
+
+def perlin_noise_hashed(num_boxes_h, seed, key_idx, key_frac, eval_pts, dtype,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Computes 3D Perlin noise like perlinNoise3DHashedAt, generating only the
+  gradients of the grid boxes around each chunk of evaluation points.
+  See hashed_gradients and cell_noise for the arguments."""
+  dtype = numpy.dtype(dtype)
+  return _perlin_noise(num_boxes_h,
+    lambda indices: hashed_gradients(seed, indices, key_idx, key_frac, dtype),
+    dtype, eval_pts, chunk_elems)
+
+def _perlin_noise(num_boxes_h, get_gradients, dtype, eval_pts, chunk_elems):
+  """Computes 3D Perlin noise like perlinNoise3DGradientsAt.
+  get_gradients - Function mapping an array of grid box indices to an array
+    of their gradients."""
+  box_size = dtype.type(1) / dtype.type(num_boxes_h)
+  one = dtype.type(1)
+  half = dtype.type(0.5)
+  
+  def evaluate_chunk(pts):
+    pts = normalize_tex_pts(pts)
+    box_coords = _find_boxes(box_size, pts)
+    scaled_pts = pts / box_size
+    lerp_facs = one - _smoothstep(scaled_pts - numpy.floor(scaled_pts))
+    
+    result = numpy.zeros(len(pts), dtype=dtype)
+    for offset in itertools.product((0, 1), repeat=3):
+      coords = _normalize_box_coords(num_boxes_h,
+        box_coords + numpy.array(offset))
+      gradient = get_gradients(_box_indices(num_boxes_h, coords))
+      
+      # Find the smallest displacements, taking spatial looping into account.
+      displacements = pts - coords.astype(dtype) * box_size
+      displacements = numpy.where(displacements > half, displacements - one,
+        displacements)
+      dot_prods = displacements[:,0] * gradient[:,0] \
+        + displacements[:,1] * gradient[:,1] \
+        + displacements[:,2] * gradient[:,2]
+      
+      facs = [lerp_facs[:,dim] if offset[dim] == 0 else one - lerp_facs[:,dim]
+        for dim in range(3)]
+      result += facs[0] * facs[1] * facs[2] * dot_prods
+    return result
+  
+  # Each of the 8 corners uses a few temporary arrays of 3 coordinates.
+  return _evaluate_chunked(eval_pts, dtype, 16, chunk_elems, evaluate_chunk)
+
+def grid_noise(seed, frame_idx, num_boxes_h, eval_pts, dtype,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Computes 3D grid noise like gridNoise3DAt.
+  seed - Random seed of the texture.
+  frame_idx - Index of the animation frame.
+  dtype - Floating point dtype for computation and results.
+  See cell_noise for the other arguments."""
+  dtype = numpy.dtype(dtype)
+  box_size = dtype.type(1) / dtype.type(num_boxes_h)
+  
+  def evaluate_chunk(pts):
+    box_coords = _find_boxes(box_size, normalize_tex_pts(pts)).astype(
+      numpy.uint32)
+    # Like the kernel, use the box coordinates without wrapping them, with
+    # 32-bit unsigned arithmetic.
+    with numpy.errstate(over='ignore'):
+      box_indices = (box_coords[:,2] * numpy.uint32(num_boxes_h)
+        + box_coords[:,1]) * numpy.uint32(num_boxes_h) + box_coords[:,0]
+    return RandStates(init_rand_state(seed, box_indices, frame_idx),
+      dtype).rand_double()
+  
+  return _evaluate_chunked(eval_pts, dtype, 8, chunk_elems, evaluate_chunk)
+
+def sphere_map_to_3d(center, eval_pts, dtype,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Converts sphere-mapped 2D points to 3D points like sphereMapTo3DAt.
+  center - Center of the sphere.
+  eval_pts - Array or ImplicitGridPts of 2D points.
+  dtype - Floating point dtype for computation and results.
+  returns: Array of 3D points with shape eval_pts.shape[:-1] + (3,)."""
+  dtype = numpy.dtype(dtype)
+  center = numpy.asarray(center, dtype=dtype)
+  # Like sphereMapTo3DAt, which maps onto the sphere of radius 0.5.
+  radius = dtype.type(0.5)
+  pi = dtype.type(numpy.pi)
+  
+  result = numpy.empty(tuple(eval_pts.shape[:-1]) + (3,), dtype=dtype)
+  flat_result = result.reshape(-1, 3)
+  chunk_pts = max(1, chunk_elems // 8)
+  for start, stop, pts in _iter_chunks(eval_pts, chunk_pts, dtype):
+    pts = normalize_tex_pts(pts)
+    yaw = (pts[:,0] - dtype.type(0.5)) * dtype.type(2) * pi
+    pitch = pts[:,1] * pi
+    sin_pitch = numpy.sin(pitch)
+    cartesian = numpy.stack((numpy.cos(yaw) * sin_pitch,
+      numpy.sin(yaw) * sin_pitch, numpy.cos(pitch)), axis=-1) * radius
+    flat_result[start:stop] = cartesian + dtype.type(0.5) + center
+  return result
+
+def _dirs_to_3d(center, eval_pts, dtype, chunk_elems, get_dirs):
+  """Converts 2D points to 3D points on the sphere like sphereDirTo3D.
+  get_dirs - Function that takes a chunk of normalized 2D points and returns
+    the directions of the corresponding 3D points, which need not have unit
+    length."""
+  dtype = numpy.dtype(dtype)
+  center = numpy.asarray(center, dtype=dtype)
+  half = dtype.type(0.5)
+  
+  result = numpy.empty(tuple(eval_pts.shape[:-1]) + (3,), dtype=dtype)
+  flat_result = result.reshape(-1, 3)
+  chunk_pts = max(1, chunk_elems // 8)
+  for start, stop, pts in _iter_chunks(eval_pts, chunk_pts, dtype):
+    dirs = get_dirs(normalize_tex_pts(pts))
+    dirs /= numpy.sqrt((dirs * dirs).sum(axis=-1))[:, None]
+    flat_result[start:stop] = dirs * half + half + center
+  return result
+
+# Matrices that map (1, a, b) to the direction of a point on each face of a
+# cube map, where (a, b) is the position on the face in [-1, 1]. See
+# cubeMapTo3DAt.
+_CUBE_FACE_DIRS = numpy.array([
+  ((1, 0, 0), (0, 0, -1), (0, -1, 0)),
+  ((-1, 0, 0), (0, 0, -1), (0, 1, 0)),
+  ((0, 1, 0), (1, 0, 0), (0, 0, 1)),
+  ((0, 1, 0), (-1, 0, 0), (0, 0, -1)),
+  ((0, 1, 0), (0, 0, -1), (1, 0, 0)),
+  ((0, -1, 0), (0, 0, -1), (-1, 0, 0))])
+
+def cube_map_to_3d(center, equi_angular, eval_pts, dtype,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Converts cube-mapped 2D points to 3D points like cubeMapTo3DAt.
+  equi_angular - Whether the points of each face are spaced at equal angles.
+  See sphere_map_to_3d for the other parameters."""
+  face_dirs = _CUBE_FACE_DIRS.astype(dtype)
+  one = numpy.dtype(dtype).type(1)
+  two = numpy.dtype(dtype).type(2)
+  quarter_pi = numpy.dtype(dtype).type(numpy.pi / 4)
+  
+  def get_dirs(pts):
+    face = numpy.minimum((pts[:,0] * 6).astype(numpy.int64), 5)
+    face_pts = numpy.stack((numpy.ones_like(pts[:,0]),
+      (pts[:,0] * 6 - face) * two - one, pts[:,1] * two - one), axis=-1)
+    if equi_angular:
+      face_pts[:,1:] = numpy.tan(face_pts[:,1:] * quarter_pi)
+    return numpy.einsum('nij,nj->ni', face_dirs[face], face_pts)
+  
+  return _dirs_to_3d(center, eval_pts, dtype, chunk_elems, get_dirs)
+
+def octahedral_map_to_3d(center, eval_pts, dtype,
+  chunk_elems=DEFAULT_CHUNK_ELEMS):
+  """Converts octahedral-mapped 2D points to 3D points like
+  octahedralMapTo3DAt. See sphere_map_to_3d for the parameters."""
+  one = numpy.dtype(dtype).type(1)
+  two = numpy.dtype(dtype).type(2)
+  
+  def get_dirs(pts):
+    pts = pts * two - one
+    z = one - numpy.abs(pts[:,0]) - numpy.abs(pts[:,1])
+    folded = (one - numpy.abs(pts[:,::-1])) * numpy.sign(pts)
+    xy = numpy.where((z < 0)[:, None], folded, pts)
+    return numpy.concatenate((xy, z[:, None]), axis=-1)
+  
+  return _dirs_to_3d(center, eval_pts, dtype, chunk_elems, get_dirs)
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import re
+import tempfile
+
+import pyopencl
+
+_INCLUDE_PATTERN = re.compile(r'^[ \t]*#[ \t]*include[ \t]*"([^"]+)"',
+  re.MULTILINE)
+
+def default_cache_dir():
+  """Gets the default directory for storing built OpenCL program binaries.
+  This is the PROC_TEX_CL_CACHE_DIR environment variable if it is set, or
+  ~/.cache/proc_tex/opencl otherwise."""
+  cache_dir = os.environ.get('PROC_TEX_CL_CACHE_DIR')
+  if cache_dir is None:
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'proc_tex',
+      'opencl')
+  return cache_dir
+
+def _include_dirs_from_options(options):
+  """Extracts the include directories from a list of OpenCL build options."""
+  include_dirs = []
+  options = list(options)
+  for idx, option in enumerate(options):
+    if option == '-I' and idx + 1 < len(options):
+      include_dirs.append(options[idx + 1])
+    elif option.startswith('-I') and option != '-I':
+      include_dirs.append(option[2:])
+  return include_dirs
+
+class ProgramCache:
+  """Cache of built OpenCL programs for a single PyOpenCL context.
+  Programs are keyed by a hash of their source code, the contents of all files
+  they include, their build options, and the devices in the context. Built
+  programs are kept in memory for the lifetime of the cache, and their device
+  binaries are also stored on disk so that later processes can skip
+  compilation."""
+  def __init__(self, cl_context, cache_dir=None):
+    """Initializer.
+    cl_context - The PyOpenCL context in which to build programs.
+    cache_dir - Directory in which to store program binaries. If None,
+      default_cache_dir() is used. If False, binaries are only cached in
+      memory."""
+    self.cl_context = cl_context
+    self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+    self._programs = {}
+    self._device_key = self._compute_device_key()
+  
+  def get_program(self, filename, options=()):
+    """Gets a built program from an OpenCL source file.
+    filename - Path to the OpenCL source file.
+    options - List of build options to pass to the OpenCL compiler."""
+    with open(filename, 'r', encoding='utf-8') as program_file:
+      source = program_file.read()
+    return self.build_source(source, options,
+      os.path.dirname(filename) or '.')
+  
+  def build_source(self, source, options=(), source_dir='.'):
+    """Gets a built program from OpenCL source code.
+    source - The OpenCL source code.
+    options - List of build options to pass to the OpenCL compiler.
+    source_dir - Directory relative to which quoted includes are resolved
+      before the include directories in options are searched."""
+    options = list(options)
+    key = self._compute_key(source, options, source_dir)
+    program = self._programs.get(key)
+    if program is None:
+      program = self._load_binaries(key, options)
+      if program is None:
+        program = pyopencl.Program(self.cl_context, source).build(
+          options=options)
+        self._store_binaries(key, program)
+      self._programs[key] = program
+    return program
+  
+  def _compute_device_key(self):
+    """Describes the context's devices, since binaries are device-specific."""
+    parts = []
+    for device in self.cl_context.devices:
+      parts += [device.platform.name, device.platform.version, device.name,
+        device.vendor, device.version, device.driver_version]
+    return '\0'.join(parts)
+  
+  def _compute_key(self, source, options, source_dir):
+    """Computes the content hash used to identify a program."""
+    hasher = hashlib.sha256()
+    hasher.update(self._device_key.encode('utf-8'))
+    hasher.update('\0'.join(options).encode('utf-8'))
+    hasher.update(b'\0')
+    hasher.update(source.encode('utf-8'))
+    self._hash_includes(hasher, source, source_dir,
+      _include_dirs_from_options(options), set())
+    return hasher.hexdigest()
+  
+  def _hash_includes(self, hasher, source, source_dir, include_dirs, visited):
+    """Adds the contents of all files included by source to the hash,
+    recursively."""
+    for include_name in _INCLUDE_PATTERN.findall(source):
+      for search_dir in [source_dir] + include_dirs:
+        include_path = os.path.normpath(os.path.join(search_dir, include_name))
+        if os.path.isfile(include_path):
+          break
+      else:
+        # Leave unresolved includes to the compiler; only their name can be
+        # hashed.
+        hasher.update(include_name.encode('utf-8'))
+        continue
+      
+      if include_path in visited:
+        continue
+      visited.add(include_path)
+      with open(include_path, 'r', encoding='utf-8') as include_file:
+        include_source = include_file.read()
+      hasher.update(include_path.encode('utf-8'))
+      hasher.update(b'\0')
+      hasher.update(include_source.encode('utf-8'))
+      self._hash_includes(hasher, include_source,
+        os.path.dirname(include_path), include_dirs, visited)
+  
+  def _binary_paths(self, key):
+    return [os.path.join(self.cache_dir, '{}-{}.bin'.format(key, idx))
+      for idx in range(len(self.cl_context.devices))]
+  
+  def _load_binaries(self, key, options):
+    """Builds a program from binaries stored on disk, if possible."""
+    if not self.cache_dir:
+      return None
+    try:
+      binaries = []
+      for path in self._binary_paths(key):
+        with open(path, 'rb') as binary_file:
+          binaries.append(binary_file.read())
+      return pyopencl.Program(self.cl_context, self.cl_context.devices,
+        binaries).build(options=options)
+    except (OSError, pyopencl.Error):
+      # Missing or unusable binaries just mean we have to compile.
+      return None
+  
+  def _store_binaries(self, key, program):
+    """Stores a built program's binaries on disk. Failures are ignored, since
+    the disk cache is only an optimization."""
+    if not self.cache_dir:
+      return
+    try:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      binaries = program.get_info(pyopencl.program_info.BINARIES)
+      for path, binary in zip(self._binary_paths(key), binaries):
+        # Write to a temporary file first so that concurrent processes never
+        # see a partially written binary.
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) \
+          as temp_file:
+          temp_file.write(binary)
+        os.replace(temp_file.name, path)
+    except (OSError, pyopencl.Error):
+      pass
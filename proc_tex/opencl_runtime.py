@@ -0,0 +1,432 @@
+import collections
+import contextlib
+import threading
+
+import numpy
+import pyopencl
+
+from proc_tex.opencl_programs import ProgramCache
+from proc_tex.texture_base import ImplicitGridPts
+
+# Buffers are allocated in size buckets so that requests of similar sizes can
+# share buffers. Each power of two is split into this many buckets, which
+# limits wasted space to 1 / _BUCKETS_PER_POWER_OF_TWO of the requested size.
+_BUCKETS_PER_POWER_OF_TWO = 8
+_MIN_BUCKET_SIZE_BYTES = 4096
+
+# Limits for the work groups used by min_max_reduce. The work group size must be
+# a power of two.
+_MAX_REDUCTION_GROUP_SIZE = 256
+_MAX_REDUCTION_GROUPS = 256
+
+_IMPLICIT_GRID_MAX_DIMS = 3
+
+def precision_options(dtype):
+  """Gets the OpenCL build options that select the floating point type used by
+  the kernels (see real.clh).
+  dtype - numpy.float32 or numpy.float64."""
+  dtype = numpy.dtype(dtype)
+  if dtype == numpy.float64:
+    return []
+  elif dtype == numpy.float32:
+    return ['-D', 'PROC_TEX_FLOAT32', '-cl-single-precision-constant']
+  else:
+    raise ValueError('Unsupported precision: {}'.format(dtype))
+
+def implicit_grid_struct(grid, dtype=numpy.float64):
+  """Converts an ImplicitGridPts to an implicitGrid struct (see
+  implicitGrid.clh) that can be passed to an OpenCL kernel by value.
+  grid - The ImplicitGridPts to convert. May have at most 3 dimensions.
+  dtype - Floating point dtype the kernel was built for. See
+    precision_options."""
+  if grid.num_space_dims > _IMPLICIT_GRID_MAX_DIMS:
+    raise ValueError('Implicit grids can have at most {} dimensions.'.format(
+      _IMPLICIT_GRID_MAX_DIMS))
+  # Matches the layout of the implicitGrid struct.
+  struct_dtype = numpy.dtype([('scale', dtype, 3), ('offset', dtype, 3),
+    ('counts', numpy.uint32, 3), ('start', numpy.uint32, 3)])
+  struct = numpy.zeros((), dtype=struct_dtype)
+  num_dims = grid.num_space_dims
+  struct['scale'][:num_dims] = grid.scale
+  struct['offset'][:num_dims] = grid.offset
+  struct['counts'][:num_dims] = grid.counts
+  struct['start'][:num_dims] = grid.tile_bounds[:,0]
+  return struct[()]
+
+def _bucket_size(size_bytes):
+  """Rounds a requested buffer size up to the size of its bucket."""
+  if size_bytes <= _MIN_BUCKET_SIZE_BYTES:
+    return _MIN_BUCKET_SIZE_BYTES
+  step = (1 << (int(size_bytes - 1).bit_length() - 1)) \
+    // _BUCKETS_PER_POWER_OF_TWO
+  return -(-size_bytes // step) * step
+
+class BufferPool:
+  """Pool of reusable OpenCL buffers for a single context.
+  Released buffers are kept for reuse by later requests in the same size
+  bucket. When the total size of the unused buffers exceeds a limit, the least
+  recently released buffers are freed."""
+  def __init__(self, cl_context, max_free_bytes):
+    """Initializer.
+    cl_context - The PyOpenCL context in which to allocate buffers.
+    max_free_bytes - Maximum total size of the unused buffers kept in the
+      pool."""
+    self.cl_context = cl_context
+    self.max_free_bytes = max_free_bytes
+    self.free_bytes = 0
+    # Total size of the buffers owned by the pool, in use or not, and the
+    # largest total size so far (see reset_peak).
+    self.total_bytes = 0
+    self.peak_bytes = 0
+    # Maps bucket size to a list of unused buffers of that size.
+    self._free_buffers = collections.defaultdict(list)
+    # Unused buffers in release order, for least recently used eviction.
+    self._release_order = collections.OrderedDict()
+  
+  def alloc(self, size_bytes):
+    """Gets a READ_WRITE buffer of at least the specified size.
+    The buffer should be given back with release when it is no longer needed.
+    size_bytes - Minimum size of the buffer, in bytes."""
+    bucket_size = _bucket_size(size_bytes)
+    free_buffers = self._free_buffers[bucket_size]
+    if free_buffers:
+      buffer = free_buffers.pop()
+      del self._release_order[id(buffer)]
+      self.free_bytes -= bucket_size
+      return buffer
+    self.total_bytes += bucket_size
+    self.peak_bytes = max(self.peak_bytes, self.total_bytes)
+    return pyopencl.Buffer(self.cl_context, pyopencl.mem_flags.READ_WRITE,
+      bucket_size)
+  
+  def release(self, buffer):
+    """Returns a buffer obtained from alloc to the pool.
+    The buffer must not be used after this call, except by commands already
+    enqueued on an in-order queue that will also be used by later users of
+    the buffer."""
+    self._free_buffers[buffer.size].append(buffer)
+    self._release_order[id(buffer)] = buffer
+    self.free_bytes += buffer.size
+    
+    # Evict the least recently released buffers if the pool is too large.
+    while self.free_bytes > self.max_free_bytes:
+      _, old_buffer = self._release_order.popitem(last=False)
+      self._free_buffers[old_buffer.size].remove(old_buffer)
+      self.free_bytes -= old_buffer.size
+      self.total_bytes -= old_buffer.size
+      old_buffer.release()
+  
+  def clear(self):
+    """Frees all unused buffers in the pool."""
+    for buffer in self._release_order.values():
+      buffer.release()
+    self._free_buffers.clear()
+    self._release_order.clear()
+    self.total_bytes -= self.free_bytes
+    self.free_bytes = 0
+  
+  def reset_peak(self):
+    """Restarts tracking of peak_bytes from the current total size."""
+    self.peak_bytes = self.total_bytes
+
+class OpenCLRuntime:
+  """Shared OpenCL state for all textures that compute in the same context.
+  Owns a reusable in-order command queue and a pool of scratch buffers for each
+  device in the context, and a cache of built programs, so that repeated
+  evaluations and texture constructions do not have to recreate them. All
+  OpenCL textures in proc_tex take one of these instead of a bare PyOpenCL
+  context.
+  Each thread uses the queue and buffer pool of the device selected with
+  use_device, which is the first device by default. Buffers created directly in
+  the context (such as the cell points of cell noise) are shared by all the
+  devices; see proc_tex.multi_device for evaluating on several devices at
+  once."""
+  def __init__(self, cl_context, max_pool_bytes=2 ** 30, cache_dir=None,
+    include_dir='opencl/include/', dtype=numpy.float64, profiling=False):
+    """Initializer.
+    cl_context - The PyOpenCL context to use for computation.
+    max_pool_bytes - Maximum total size of unused scratch buffers to keep around
+      for reuse, per device.
+    cache_dir - Directory in which to store built program binaries. See
+      ProgramCache.
+    include_dir - Directory containing the OpenCL header files.
+    dtype - Default floating point dtype for textures using the runtime,
+      numpy.float32 or numpy.float64. Textures can override it. float32
+      halves memory traffic and works on devices without good fp64 support,
+      and is precise enough for 8 and 16 bit images.
+    profiling - If true, the queues are created with profiling enabled, so that
+      the device time of commands can be measured with record_events."""
+    self.cl_context = cl_context
+    self.devices = list(cl_context.devices)
+    self.profiling = profiling
+    queue_properties = pyopencl.command_queue_properties.PROFILING_ENABLE \
+      if profiling else 0
+    self.cl_queues = [pyopencl.CommandQueue(cl_context, device,
+      properties=queue_properties) for device in self.devices]
+    self.buffer_pools = [BufferPool(cl_context, max_pool_bytes)
+      for _ in self.devices]
+    self.program_cache = ProgramCache(cl_context, cache_dir)
+    self.build_options = ['-I', include_dir]
+    self.dtype = numpy.dtype(dtype)
+    precision_options(self.dtype)
+    self._thread_state = threading.local()
+    self._build_lock = threading.Lock()
+    # Functions called for each recorded command; see add_event_listener.
+    # The list is replaced instead of modified, so that it can be iterated
+    # without locking.
+    self._event_listeners = []
+  
+  @property
+  def device_idx(self):
+    """Index in devices of the device used by the current thread."""
+    return getattr(self._thread_state, 'device_idx', 0)
+  
+  @property
+  def cl_queue(self):
+    """The command queue of the current thread's device."""
+    return self.cl_queues[self.device_idx]
+  
+  @property
+  def buffer_pool(self):
+    """The scratch buffer pool of the current thread's device."""
+    return self.buffer_pools[self.device_idx]
+  
+  @contextlib.contextmanager
+  def use_device(self, device_idx):
+    """Context manager that makes the current thread use another device.
+    device_idx - Index of the device in devices."""
+    prev_device_idx = self.device_idx
+    self._thread_state.device_idx = device_idx
+    try:
+      yield
+    finally:
+      self._thread_state.device_idx = prev_device_idx
+  
+  def get_program(self, filename, extra_options=(), dtype=None):
+    """Gets a built OpenCL program, compiling it only if no program with the
+    same source, includes, options and devices has been built before.
+    filename - Path to the OpenCL source file.
+    extra_options - Build options to use in addition to the runtime's
+      standard options.
+    dtype - Floating point dtype to build the program for. If None, the
+      runtime's dtype is used."""
+    with self._build_lock:
+      return self.program_cache.get_program(filename,
+        self._options(extra_options, dtype))
+  
+  def build_source(self, source, extra_options=(), dtype=None):
+    """Like get_program, but takes the OpenCL source code directly.
+    source - The OpenCL source code.
+    extra_options - See get_program.
+    dtype - See get_program."""
+    with self._build_lock:
+      return self.program_cache.build_source(source,
+        self._options(extra_options, dtype))
+  
+  def get_kernel(self, program, kernel_name):
+    """Gets a kernel of a built program, creating the PyOpenCL kernel object
+    only the first time it is requested by the current thread. Kernel objects
+    hold their arguments between calls, so each thread gets its own, and
+    threads evaluating on different devices can run the same kernel at once.
+    program - A program from get_program or build_source.
+    kernel_name - Name of the kernel function."""
+    kernels = getattr(self._thread_state, 'kernels', None)
+    if kernels is None:
+      kernels = self._thread_state.kernels = {}
+    key = (id(program), kernel_name)
+    if key not in kernels:
+      # The program is kept with its kernel, so that its ID is not reused.
+      kernels[key] = (program, pyopencl.Kernel(program, kernel_name))
+    return kernels[key][1]
+  
+  def _options(self, extra_options, dtype):
+    return self.build_options \
+      + precision_options(self.dtype if dtype is None else dtype) \
+      + list(extra_options)
+  
+  def run_kernel(self, kernel, global_size, local_size, *args):
+    """Enqueues a kernel on the current thread's queue. All kernels of
+    proc_tex are enqueued through this method, so that they can be recorded
+    (see add_event_listener).
+    kernel - The PyOpenCL kernel to run.
+    global_size - Global work size.
+    local_size - Local work size, or None to let the implementation choose.
+    args - The kernel arguments.
+    returns: The pyopencl.Event of the kernel."""
+    event = kernel(self.cl_queue, global_size, local_size, *args)
+    if self._event_listeners:
+      self._record_event('kernel', kernel.function_name, event)
+    return event
+  
+  def add_event_listener(self, listener):
+    """Registers a function to call whenever a command is enqueued by
+    run_kernel or one of the transfer methods, or a new scratch buffer is
+    allocated, from any thread. Commands are not recorded at all while no
+    listener is registered.
+    listener - Function taking (kind, name, event, num_bytes), where kind is
+      'kernel', 'upload', 'download' or 'alloc', name is the kernel name (or
+      kind for other commands), event is the pyopencl.Event of the command
+      (None for allocations), and num_bytes is the number of bytes
+      transferred or allocated."""
+    self._event_listeners = self._event_listeners + [listener]
+  
+  def remove_event_listener(self, listener):
+    """Unregisters a function registered with add_event_listener."""
+    self._event_listeners = [curr_listener
+      for curr_listener in self._event_listeners
+      if curr_listener is not listener]
+  
+  @contextlib.contextmanager
+  def record_events(self):
+    """Context manager that records the commands enqueued by run_kernel and
+    the transfer methods of the runtime, from all threads. Requires a runtime
+    created with profiling enabled.
+    Yields: A list to which a (kind, event) tuple is added for each command,
+      where kind is 'kernel', 'upload' or 'download'. See event_seconds."""
+    if not self.profiling:
+      raise ValueError('Recording events requires profiling to be enabled.')
+    events = []
+    def listener(kind, name, event, num_bytes):
+      if event is not None:
+        events.append((kind, event))
+    self.add_event_listener(listener)
+    try:
+      yield events
+    finally:
+      self.remove_event_listener(listener)
+  
+  def _record_event(self, kind, name, event, num_bytes=0):
+    for listener in self._event_listeners:
+      listener(kind, name, event, num_bytes)
+  
+  def alloc_buffer(self, size_bytes):
+    """Gets a scratch buffer of at least the specified size from the pool.
+    See BufferPool.alloc."""
+    buffer_pool = self.buffer_pool
+    prev_total_bytes = buffer_pool.total_bytes
+    buffer = buffer_pool.alloc(size_bytes)
+    if self._event_listeners and buffer_pool.total_bytes > prev_total_bytes:
+      self._record_event('alloc', 'alloc', None,
+        buffer_pool.total_bytes - prev_total_bytes)
+    return buffer
+  
+  def release_buffer(self, buffer):
+    """Returns a scratch buffer to the pool. See BufferPool.release."""
+    self.buffer_pool.release(buffer)
+  
+  @contextlib.contextmanager
+  def scratch_buffer(self, size_bytes):
+    """Context manager that borrows a scratch buffer from the pool.
+    size_bytes - Minimum size of the buffer, in bytes."""
+    buffer = self.alloc_buffer(size_bytes)
+    try:
+      yield buffer
+    finally:
+      self.release_buffer(buffer)
+  
+  @contextlib.contextmanager
+  def upload(self, array):
+    """Context manager that copies a Numpy array into a scratch buffer.
+    array - The array to copy. Will be made contiguous if necessary."""
+    array = numpy.ascontiguousarray(array)
+    with self.scratch_buffer(array.nbytes) as buffer:
+      self._record_event('upload', 'upload',
+        pyopencl.enqueue_copy(self.cl_queue, buffer, array), array.nbytes)
+      yield buffer
+  
+  @contextlib.contextmanager
+  def eval_pts_arg(self, eval_pts, dtype=None):
+    """Context manager that prepares evaluation points to be passed to an
+    OpenCL kernel. ImplicitGridPts with at most 3 dimensions are passed as an
+    implicitGrid struct, and need no buffer. Other points are copied into a
+    scratch buffer.
+    eval_pts - The evaluation points.
+    dtype - Floating point dtype the kernel was built for. If None, the
+      runtime's dtype is used.
+    Yields: An (is_grid, arg) tuple. is_grid indicates whether arg is an
+      implicitGrid struct or a buffer, so that the caller can choose between
+      kernels."""
+    dtype = self.dtype if dtype is None else numpy.dtype(dtype)
+    if isinstance(eval_pts, ImplicitGridPts) \
+      and eval_pts.num_space_dims <= _IMPLICIT_GRID_MAX_DIMS:
+      yield True, implicit_grid_struct(eval_pts, dtype)
+    else:
+      with self.upload(numpy.asarray(eval_pts, dtype=dtype)) as buffer:
+        yield False, buffer
+  
+  def download(self, result_array, buffer):
+    """Copies the start of a buffer into a Numpy array, waiting until the copy
+    is done.
+    result_array - Contiguous Numpy array into which to copy.
+    buffer - The buffer to copy from. Must be at least as large as
+      result_array."""
+    self._record_event('download', 'download',
+      pyopencl.enqueue_copy(self.cl_queue, result_array, buffer),
+      result_array.nbytes)
+    return result_array
+  
+  def upload_to(self, buffer, array):
+    """Copies a Numpy array into the start of an existing buffer, waiting until
+    the copy is done.
+    buffer - The buffer to copy into. Must be at least as large as array.
+    array - The array to copy. Will be made contiguous if necessary."""
+    array = numpy.ascontiguousarray(array)
+    self._record_event('upload', 'upload',
+      pyopencl.enqueue_copy(self.cl_queue, buffer, array), array.nbytes)
+  
+  def min_max_reduce(self, src_buffer, num_values, range_buffer, dtype=None):
+    """Enqueues a two-pass parallel reduction that finds the minimum and maximum
+    of the values in a buffer. The result stays on the device, so kernels
+    enqueued later can use it without a round trip through host memory.
+    src_buffer - Buffer containing the values.
+    num_values - Number of values at the start of src_buffer to reduce.
+    range_buffer - Buffer with room for two values, in which the minimum and
+      maximum (in that order) will be stored.
+    dtype - Floating point dtype of the values. If None, the runtime's dtype
+      is used."""
+    dtype = self.dtype if dtype is None else numpy.dtype(dtype)
+    program = self.get_program('opencl/minMaxReduce.cl', dtype=dtype)
+    
+    # Use the largest power of two work group size the device supports.
+    group_size = min(_MAX_REDUCTION_GROUP_SIZE,
+      self.cl_queue.device.max_work_group_size)
+    group_size = 1 << (group_size.bit_length() - 1)
+    num_groups = max(1, min(_MAX_REDUCTION_GROUPS,
+      -(-num_values // group_size)))
+    pair_size_bytes = 2 * dtype.itemsize
+    
+    with self.scratch_buffer(num_groups * pair_size_bytes) as partials_buffer:
+      self.run_kernel(self.get_kernel(program, 'minMaxReducePartial'),
+        (num_groups * group_size,), (group_size,), numpy.uint64(num_values),
+        src_buffer, partials_buffer,
+        pyopencl.LocalMemory(group_size * pair_size_bytes))
+      self.run_kernel(self.get_kernel(program, 'minMaxReduceFinal'),
+        (group_size,), (group_size,), numpy.uint32(num_groups),
+        partials_buffer, range_buffer,
+        pyopencl.LocalMemory(group_size * pair_size_bytes))
+  
+  def pool_peak_bytes(self):
+    """Gets the sum over the devices of the peak total size of the scratch
+    buffer pools. See BufferPool.peak_bytes."""
+    return sum(pool.peak_bytes for pool in self.buffer_pools)
+  
+  def reset_pool_peaks(self):
+    """Restarts peak tracking in the scratch buffer pools of all devices."""
+    for pool in self.buffer_pools:
+      pool.reset_peak()
+  
+  def finish(self):
+    """Waits for all commands enqueued on the runtime's queues to finish."""
+    for cl_queue in self.cl_queues:
+      cl_queue.finish()
+
+def event_seconds(events):
+  """Sums the device time of recorded commands by kind, waiting for them to
+  complete.
+  events - List of (kind, event) tuples from OpenCLRuntime.record_events.
+  returns: Dictionary mapping each kind to the total time in seconds."""
+  seconds = collections.defaultdict(float)
+  for kind, event in events:
+    event.wait()
+    seconds[kind] += (event.profile.end - event.profile.start) * 1e-9
+  return dict(seconds)
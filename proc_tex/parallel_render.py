@@ -0,0 +1,175 @@
+import collections
+import multiprocessing
+import random
+import uuid
+
+import numpy
+
+from proc_tex.anim_checkpoints import AnimCheckpoints
+from proc_tex.texture_base import write_video
+
+# Maximum number of textures a worker process keeps between tasks. Each one
+# may hold an OpenCL context and device buffers.
+_MAX_WORKER_TEXTURES = 2
+
+# Textures built in the current worker process, keyed by job ID. Each value is
+# an (AnimCheckpoints, eval_pts) tuple.
+_worker_textures = collections.OrderedDict()
+
+def _build_texture(texture_factory, seed):
+  """Builds a texture with the global random number generators in a known
+  state, so that every process builds (and animates) the same texture."""
+  random.seed(seed)
+  numpy.random.seed(seed)
+  return texture_factory()
+
+def _worker_texture(job_id, texture_factory, seed, frame_idx, pixel_dims,
+  space_bounds, checkpoint_interval, checkpoint_dir):
+  """Gets the texture for a job in the current worker process, moved to the
+  requested frame."""
+  entry = _worker_textures.pop(job_id, None)
+  if entry is None:
+    texture = _build_texture(texture_factory, seed)
+    checkpoints = AnimCheckpoints(texture, checkpoint_interval,
+      checkpoint_dir)
+    eval_pts = texture.gen_eval_pts(pixel_dims, space_bounds, implicit=True)
+    entry = (checkpoints, eval_pts)
+  _worker_textures[job_id] = entry
+  while len(_worker_textures) > _MAX_WORKER_TEXTURES:
+    _worker_textures.popitem(last=False)
+  
+  checkpoints, eval_pts = entry
+  checkpoints.seek(frame_idx)
+  return checkpoints.texture, eval_pts
+
+def _render_frames_task(job_id, texture_factory, seed, first_frame, num_frames,
+  pixel_dims, space_bounds, checkpoint_interval, checkpoint_dir):
+  texture, eval_pts = _worker_texture(job_id, texture_factory, seed,
+    first_frame, pixel_dims, space_bounds, checkpoint_interval, checkpoint_dir)
+  frames = []
+  for frame_idx in range(first_frame, first_frame + num_frames):
+    texture.set_frame(frame_idx)
+    frames.append(texture.to_image(pixel_dims, space_bounds,
+      eval_pts=eval_pts))
+  return frames
+
+def _render_image_task(texture_factory, seed, frame_idx, pixel_dims,
+  space_bounds):
+  texture = _build_texture(texture_factory, seed)
+  texture.set_frame(frame_idx)
+  return texture.to_image(pixel_dims, space_bounds)
+
+class ParallelRenderer:
+  """Renders frames of animated textures, or batches of independent textures,
+  across a pool of worker processes.
+  Textures hold OpenCL objects, which cannot be sent between processes, so
+  each worker builds its own copy of the texture by calling a texture factory:
+  a picklable callable with no parameters (e.g. a module-level function or a
+  functools.partial of one) that creates an OpenCLRuntime and returns a new
+  texture. Before calling the factory, the worker seeds the random and
+  numpy.random modules, and then moves the texture forward to the frame it
+  needs. Since the textures draw all their randomness from those modules, this
+  reproduces the same animation in every worker as a single process rendering
+  the frames in order would. Workers move their textures between frames with
+  AnimCheckpoints, which can share checkpoints between workers and renders
+  through a directory.
+  Worker processes are started with the 'spawn' method by default, since
+  OpenCL implementations generally do not survive a fork. Scripts using this
+  class must therefore guard their top-level code with
+  if __name__ == '__main__'."""
+  def __init__(self, num_workers=None, mp_context='spawn'):
+    """Initializer.
+    num_workers - Number of worker processes. If None, the number of CPUs is
+      used.
+    mp_context - Name of the multiprocessing start method to use."""
+    if num_workers is None:
+      num_workers = multiprocessing.cpu_count()
+    
+    self.num_workers = num_workers
+    self.pool = multiprocessing.get_context(mp_context).Pool(num_workers)
+  
+  def close(self):
+    """Stops the worker processes."""
+    self.pool.close()
+    self.pool.join()
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.pool.terminate()
+      self.pool.join()
+  
+  def iter_frames(self, texture_factory, pixel_dims, space_bounds, num_frames,
+    start_frame=0, seed=0, frames_per_task=8, max_pending_tasks=None,
+    checkpoint_interval=32, checkpoint_dir=None):
+    """Renders consecutive frames of an animated texture in parallel.
+    The frames are split into tasks of consecutive frames, which are handed to
+    the workers in order. A worker keeps its texture between tasks, so it only
+    has to step forward over the frames rendered by other workers, or from the
+    nearest checkpoint.
+    texture_factory - See ParallelRenderer.
+    pixel_dims - See Texture.to_image.
+    space_bounds - See Texture.to_image.
+    num_frames - Number of frames to render.
+    start_frame - Index of the first frame to render.
+    seed - Seed for the random number generators, an integer in [0, 2 ** 32).
+    frames_per_task - Number of consecutive frames in each task.
+    max_pending_tasks - Maximum number of tasks submitted but not yet yielded,
+      which bounds the number of frames held in memory. If None, twice the
+      number of workers is used.
+    checkpoint_interval - Number of frames between animation checkpoints. See
+      AnimCheckpoints.
+    checkpoint_dir - Directory in which to share animation checkpoints between
+      workers and later renders, or None to keep them in each worker's memory.
+      Must only be used for textures from the same factory and seed.
+    Yields: Numpy arrays of texture values for the frames, in order."""
+    if max_pending_tasks is None:
+      max_pending_tasks = 2 * self.num_workers
+    
+    job_id = uuid.uuid4().hex
+    task_starts = range(start_frame, start_frame + num_frames, frames_per_task)
+    pending = collections.deque()
+    for task_start in task_starts:
+      if len(pending) >= max_pending_tasks:
+        yield from pending.popleft().get()
+      task_frames = min(frames_per_task, start_frame + num_frames - task_start)
+      pending.append(self.pool.apply_async(_render_frames_task,
+        (job_id, texture_factory, seed, task_start, task_frames, pixel_dims,
+        space_bounds, checkpoint_interval, checkpoint_dir)))
+    
+    while pending:
+      yield from pending.popleft().get()
+  
+  def to_video(self, texture_factory, pixel_dims, space_bounds, num_frames,
+    frames_per_second, filename, pix_fmt, codec='libvpx-vp9', codec_params=[],
+    start_frame=0, seed=0, frames_per_task=8, checkpoint_interval=32,
+    checkpoint_dir=None, pipeline_depth=2):
+    """Generates a video of an animated texture, rendering the frames in
+    parallel.
+    See Texture.to_video and iter_frames for the parameters. The texture must
+    have 2 spatial dimensions."""
+    frames = self.iter_frames(texture_factory, pixel_dims, space_bounds,
+      num_frames, start_frame, seed, frames_per_task,
+      checkpoint_interval=checkpoint_interval, checkpoint_dir=checkpoint_dir)
+    write_video(frames, pixel_dims, num_frames, frames_per_second, filename,
+      pix_fmt, codec, codec_params, pipeline_depth)
+  
+  def render_images(self, texture_factories, pixel_dims, space_bounds,
+    frame_idx=0, seed=0):
+    """Renders a batch of independent textures in parallel, one per task.
+    texture_factories - Iterable of texture factories. See ParallelRenderer.
+    pixel_dims - See Texture.to_image.
+    space_bounds - See Texture.to_image.
+    frame_idx - Frame of each texture to render.
+    seed - Seed for the random number generators used by every factory, an
+      integer in [0, 2 ** 32).
+    returns: List of Numpy arrays of texture values, in the same order as
+      texture_factories."""
+    results = [self.pool.apply_async(_render_image_task,
+      (texture_factory, seed, frame_idx, pixel_dims, space_bounds))
+      for texture_factory in texture_factories]
+    return [result.get() for result in results]
@@ -1,4 +1,7 @@
+import collections
+import queue
 import subprocess
+import threading
 
 import numpy
 
@@ -19,6 +22,7 @@ class Texture:
     self.anim_synch_textures = anim_synch_textures
     self.curr_frame = max(
       [0] + [texture.curr_frame for texture in anim_synch_textures])
+    self.cached_value_range = None
   
   def evaluate(self, eval_pts):
     """Gets the pixel values at the specified locations. Subclasses should
@@ -33,7 +37,8 @@ class Texture:
   
   def set_frame(self, frame_idx):
     """Moves internal state to the specified frame.
-    Does not support going back before the current frame.
+    Does not support going back before the current frame. See
+    proc_tex.anim_checkpoints.AnimCheckpoints for seeking to any frame.
     frame_idx - Index of the frame to go to."""
     while self.curr_frame < frame_idx:
       self.step_frame()
@@ -50,6 +55,60 @@ class Texture:
     typically override this. Default implementation does nothing."""
     pass
   
+  def get_anim_state(self):
+    """Gets the animation state of this texture that is not determined by
+    curr_frame alone, e.g. positions that are updated in place by step_frame.
+    The state of anim_synch_textures is not included; see
+    proc_tex.anim_checkpoints for snapshots of whole texture graphs.
+    Subclasses with such state should override this along with
+    set_anim_state. Default implementation returns None.
+    returns: A picklable object holding the state."""
+    return None
+  
+  def set_anim_state(self, state):
+    """Restores animation state returned by get_anim_state. Does not change
+    curr_frame. Default implementation does nothing.
+    state - The state to restore."""
+    pass
+  
+  def value_range(self):
+    """Gets bounds on the values the texture can output, if they are known.
+    Used by tex_scale_to_region's 'known' range mode, which normalizes values
+    without looking at the whole frame first. Returns the range stored by
+    set_value_range or measure_value_range if there is one, and
+    analytic_value_range otherwise.
+    returns: A (min, max) tuple that bounds the values on all channels, or None
+      if no bounds are known."""
+    if self.cached_value_range is not None:
+      return self.cached_value_range
+    return self.analytic_value_range()
+  
+  def analytic_value_range(self):
+    """Gets bounds on the values the texture can output, derived from how the
+    texture is computed. Subclasses with known bounds should override this.
+    Default implementation returns None.
+    returns: See value_range."""
+    return None
+  
+  def set_value_range(self, value_range):
+    """Sets the range returned by value_range, overriding
+    analytic_value_range.
+    value_range - A (min, max) tuple, or None to go back to the analytic
+      range."""
+    self.cached_value_range = None if value_range is None \
+      else (value_range[0], value_range[1])
+  
+  def measure_value_range(self, eval_pts):
+    """Evaluates the texture and stores the range of the results for
+    value_range. Useful for textures with loose or unknown analytic bounds.
+    Note that other frames or evaluation points may produce values outside the
+    measured range.
+    eval_pts - Evaluation points at which to sample the texture.
+    returns: The measured (min, max) tuple."""
+    src_vals = self.evaluate(eval_pts)
+    self.set_value_range((src_vals.min(), src_vals.max()))
+    return self.cached_value_range
+  
   def to_image(self, pixel_dims, space_bounds, eval_pts=None):
     """Generates a Numpy array representing an image of the current frame.
     Assuming the texture's number of channels, channel dtype, and number of
@@ -68,12 +127,15 @@ class Texture:
       making a video."""
     # Generate evaluation points.
     if eval_pts is None:
-      eval_pts = self.gen_eval_pts(pixel_dims, space_bounds)
+      eval_pts = self.gen_eval_pts(pixel_dims, space_bounds, implicit=True)
     
-    return self.evaluate(eval_pts)
+    # Textures used by several others in the graph are only evaluated once.
+    with EvalCache(self):
+      return self.evaluate(eval_pts)
   
   def to_video(self, pixel_dims, space_bounds, num_frames, frames_per_second,
-    filename, pix_fmt, codec='libvpx-vp9', codec_params=[], eval_pts=None):
+    filename, pix_fmt, codec='libvpx-vp9', codec_params=[], eval_pts=None,
+    pipeline_depth=2):
     """Generates a video starting at the current frame.
     This method has the side effect of moving the current frame forward by
     num_frames. Since FFmpeg requires the number of spatial dimensions to be 2,
@@ -86,7 +148,11 @@ class Texture:
     pix_fmt - Input pixel format string to pass to FFmpeg.
     codec - Video codec string to pass to FFmpeg.
     codec_params - Extra codec parameters to pass to FFmpeg.
-    eval_pts - See to_image."""
+    eval_pts - See to_image.
+    pipeline_depth - Maximum number of computed frames waiting to be written
+      to FFmpeg. If positive, frames are written from a separate thread, so
+      that the next frame is computed while FFmpeg encodes the previous ones.
+      If 0, frames are computed and written one after the other."""
     if self.num_space_dims != 2:
       raise ValueError(
         'Cannot make videos with number of dimensions other than 2.')
@@ -94,84 +160,60 @@ class Texture:
     # Precompute the evaluation points so we don't have to recompute them every
     # frame.
     if eval_pts is None:
-      eval_pts = self.gen_eval_pts(pixel_dims, space_bounds)
+      eval_pts = self.gen_eval_pts(pixel_dims, space_bounds, implicit=True)
     
-    # Start the FFmpeg process.
-    video_size_arg = '{}x{}'.format(eval_pts.shape[0], eval_pts.shape[1])
-    global_args = ['-y']
-    input_args = ['-f', 'rawvideo', '-pixel_format', pix_fmt,
-      '-video_size', video_size_arg, '-framerate', str(frames_per_second),
-      '-i', '-',]
-    output_args = ['-r', str(frames_per_second),
-      '-codec:v', codec] + codec_params + ['-frames:v', str(num_frames),
-      '-s', video_size_arg, filename]
-    ffmpeg_process = None
-    try:
-      ffmpeg_process = subprocess.Popen(
-        ['ffmpeg'] + global_args + input_args + output_args,
-        stdin=subprocess.PIPE)
-      
-      # Generate frames.
+    def frames():
       start_frame = self.curr_frame
       for frame_idx in range(num_frames):
         self.set_frame(start_frame + frame_idx)
-        
-        frame = self.to_image(pixel_dims, space_bounds, eval_pts=eval_pts)
-        
-        ffmpeg_process.stdin.write(frame.tobytes())
+        yield self.to_image(pixel_dims, space_bounds, eval_pts=eval_pts)
     
-    finally:
-      if ffmpeg_process is not None:
-        ffmpeg_process.stdin.close()
-        ffmpeg_process.wait()
+    write_video(frames(), (eval_pts.shape[0], eval_pts.shape[1]), num_frames,
+      frames_per_second, filename, pix_fmt, codec, codec_params,
+      pipeline_depth)
   
-  def gen_eval_pts(self, pixel_dims, space_bounds):
+  def gen_eval_pts(self, pixel_dims, space_bounds, tile_bounds=None,
+    implicit=False):
     """Generates a Numpy array of evaluation points.
     The resulting array is suitable for passing to to_image as the optional
     eval_pts parameter.
     pixel_dims - See to_image.
-    space_bounds - See to_image."""
-    # convert arguments to Numpy arrays so we can use the arithmetic operations.
-    pixel_dims = numpy.array(pixel_dims)
-    space_bounds = numpy.array(space_bounds)
-    
-    space_widths = numpy.array(
-      [space_bounds[dim,1] - space_bounds[dim,0] for dim in range(self.num_space_dims)])
-    
-    pixel_dims_ranges = [numpy.arange(dim) for dim in pixel_dims]
-    
-    # Initialize each evaluation point to match its pixel coordinates.
-    eval_pts = numpy.asarray(numpy.meshgrid(*pixel_dims_ranges)).astype(
-      numpy.float64)
-    eval_pts = numpy.rollaxis(eval_pts, 0, len(eval_pts.shape))
-    
-    # Convert from pixel coordinates to texture space coordinates.
-    eval_pts += 0.5
-    scale = space_widths / pixel_dims
-    offset = space_bounds[:,0]
-    eval_pts = eval_pts * scale + offset
-    
-    return eval_pts
+    space_bounds - See to_image.
+    tile_bounds - Optional indexable object of shape (self.num_space_dims, 2)
+      giving a range of pixel indices [start, stop) in each dimension, in the
+      same order as pixel_dims. If provided, only the evaluation points for
+      that tile of the image are generated. They are identical to the
+      corresponding part of the full array.
+    implicit - If true, returns an ImplicitGridPts describing the points
+      instead of an array. OpenCL textures can compute the points from the
+      description on the device, so the array never has to be stored or
+      transferred."""
+    grid = ImplicitGridPts(pixel_dims, space_bounds, tile_bounds)
+    return grid if implicit else grid.to_array()
   
   def __add__(self, other):
     """Texture addition.
     See BinaryCombinedTexture for restrictions on what can be added."""
-    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x + y)
+    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x + y,
+      'add')
   
   def __radd__(self, other):
     """Right-hand side texture addition.
     See BinaryCombinedTexture for restrictions on what can be added."""
-    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x + y)
+    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x + y,
+      'add')
   
   def __sub__(self, other):
     """Texture subtraction.
     See BinaryCombinedTexture for restrictions on what can be subtracted."""
-    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x - y)
+    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x - y,
+      'sub')
   
   def __rsub__(self, other):
     """Right-hand side texture subtraction.
     See BinaryCombinedTexture for restrictions on what can be subtracted."""
-    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x - y)
+    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x - y,
+      'sub')
   
   def __neg__(self):
     return 0 - self
@@ -179,12 +221,110 @@ class Texture:
   def __mul__(self, other):
     """Texture multiplication.
     See BinaryCombinedTexture for restrictions on what can be multiplied."""
-    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x * y)
+    return _SimpleBinaryCombinedTexture(self, other, lambda x,y: x * y,
+      'mul')
   
   def __rmul__(self, other):
     """Right-hand side texture multiplication.
     See BinaryCombinedTexture for restrictions on what can be multiplied."""
-    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x * y)
+    return _SimpleBinaryCombinedTexture(other, self, lambda x,y: x * y,
+      'mul')
+
+class ImplicitGridPts:
+  """Describes a regular grid of evaluation points, as generated by
+  Texture.gen_eval_pts, without storing the points.
+  OpenCL textures compute the points from the description on the device (see
+  implicitGrid.clh). Everywhere else, it behaves like the equivalent read-only
+  array: it has the same shape, and Numpy functions and operators convert it
+  to an array automatically."""
+  
+  dtype = numpy.dtype(numpy.float64)
+  
+  def __init__(self, pixel_dims, space_bounds, tile_bounds=None):
+    """Initializer.
+    pixel_dims - See Texture.to_image.
+    space_bounds - See Texture.to_image.
+    tile_bounds - See Texture.gen_eval_pts."""
+    # convert arguments to Numpy arrays so we can use the arithmetic operations.
+    self.pixel_dims = numpy.array(pixel_dims)
+    self.space_bounds = numpy.array(space_bounds)
+    if tile_bounds is None:
+      tile_bounds = [(0, dim) for dim in self.pixel_dims]
+    self.tile_bounds = numpy.array(tile_bounds)
+    
+    space_widths = self.space_bounds[:,1] - self.space_bounds[:,0]
+    self.scale = space_widths / self.pixel_dims
+    self.offset = self.space_bounds[:,0]
+  
+  @property
+  def num_space_dims(self):
+    return len(self.pixel_dims)
+  
+  @property
+  def counts(self):
+    """Number of grid points along each dimension, in the same order as
+    pixel_dims."""
+    return tuple(int(stop - start) for start, stop in self.tile_bounds)
+  
+  @property
+  def shape(self):
+    # Matches numpy.meshgrid's default 'xy' indexing, which swaps the first two
+    # dimensions.
+    counts = list(self.counts)
+    if len(counts) >= 2:
+      counts[0], counts[1] = counts[1], counts[0]
+    return tuple(counts) + (self.num_space_dims,)
+  
+  @property
+  def ndim(self):
+    return len(self.shape)
+  
+  @property
+  def size(self):
+    return int(numpy.prod(self.shape))
+  
+  def row_slice(self, start, stop):
+    """Gets the grid of points in a range of rows, i.e. along the first
+    dimension of shape. Like slicing the equivalent array, but without
+    generating the points.
+    start - Index of the first row to include.
+    stop - Index after the last row to include."""
+    row_dim = 1 if self.num_space_dims >= 2 else 0
+    tile_bounds = self.tile_bounds.copy()
+    tile_bounds[row_dim] = (tile_bounds[row_dim][0] + start,
+      tile_bounds[row_dim][0] + stop)
+    return ImplicitGridPts(self.pixel_dims, self.space_bounds, tile_bounds)
+  
+  def to_array(self):
+    """Generates the Numpy array of evaluation points."""
+    pixel_dims_ranges = [numpy.arange(start, stop)
+      for start, stop in self.tile_bounds]
+    
+    # Initialize each evaluation point to match its pixel coordinates.
+    eval_pts = numpy.asarray(numpy.meshgrid(*pixel_dims_ranges)).astype(
+      numpy.float64)
+    eval_pts = numpy.rollaxis(eval_pts, 0, len(eval_pts.shape))
+    
+    # Convert from pixel coordinates to texture space coordinates.
+    eval_pts += 0.5
+    eval_pts = eval_pts * self.scale + self.offset
+    
+    return eval_pts
+  
+  def __array__(self, dtype=None, copy=None):
+    eval_pts = self.to_array()
+    return eval_pts if dtype is None else eval_pts.astype(dtype)
+  
+  def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+    inputs = [numpy.asarray(value) if isinstance(value, ImplicitGridPts)
+      else value for value in inputs]
+    return getattr(ufunc, method)(*inputs, **kwargs)
+  
+  def __getitem__(self, index):
+    return self.to_array()[index]
+  
+  def __len__(self):
+    return self.shape[0]
 
 class ScalarConstantTexture(Texture):
   """Texture that outputs a constant scalar value on each channel."""
@@ -196,13 +336,19 @@ class ScalarConstantTexture(Texture):
     self.value = value
   
   def evaluate(self, eval_pts):
-    return numpy.full(eval_pts.shape[:-1] + (self.num_channels,), self.value)
+    # A read-only broadcast view, so that no full-size array is allocated.
+    return numpy.broadcast_to(numpy.asarray(self.value),
+      eval_pts.shape[:-1] + (self.num_channels,))
+  
+  def analytic_value_range(self):
+    return (self.value, self.value)
 
 class TransformedTexture(Texture):
   """Class for applying transformation functions to source texture(s)."""
   
   def __init__(self, num_channels, num_space_dims, src_textures,
-    space_transform, tex_transform, anim_synch_textures=[]):
+    space_transform, tex_transform, anim_synch_textures=[], op_name=None,
+    op_params=None, range_transform=None):
     """Initializer.
     src_textures - Iterable of source textures to which transformations will be
       applied.
@@ -219,22 +365,45 @@ class TransformedTexture(Texture):
       output. The returned array must have the appropriate number of channels
       for the texture.
     anim_synch_textures - See superclass. src_textures get added
-      automatically."""
+      automatically.
+    op_name - Optional name identifying which standard transformation this
+      texture implements (e.g. 'add' or 'scale_to_region'). Graph rewriters
+      such as proc_tex.texture_fusion use this to recognize transformations
+      they know how to handle. None for arbitrary transformations.
+    op_params - Optional dictionary of parameters for the transformation named
+      by op_name.
+    range_transform - Optional function that computes bounds on the output
+      values from bounds on the source values (see Texture.value_range). Takes
+      a list with a (min, max) tuple for each source texture, and returns a
+      (min, max) tuple. If None, the texture's value range is unknown."""
     super(TransformedTexture, self).__init__(num_channels, num_space_dims,
       anim_synch_textures + src_textures)
     self.src_textures = src_textures
     self.space_transform = space_transform
     self.tex_transform = tex_transform
+    self.op_name = op_name
+    self.op_params = {} if op_params is None else op_params
+    self.range_transform = range_transform
   
   def evaluate(self, eval_pts):
     transformed_eval_pts = self.space_transform(eval_pts)
-    src_outputs = [src_texture.evaluate(pts) for src_texture, pts in zip(self.src_textures, transformed_eval_pts)]
+    src_outputs = [evaluate_source(src_texture, pts)
+      for src_texture, pts in zip(self.src_textures, transformed_eval_pts)]
     return self.tex_transform(src_outputs)
+  
+  def analytic_value_range(self):
+    if self.range_transform is None:
+      return None
+    src_ranges = [src_texture.value_range()
+      for src_texture in self.src_textures]
+    if None in src_ranges:
+      return None
+    return self.range_transform(src_ranges)
 
 class _SimpleBinaryCombinedTexture(TransformedTexture):
   """Simple texture transformation for implementing overloaded operators."""
   
-  def __init__(self, src0, src1, combination):
+  def __init__(self, src0, src1, combination, op_name=None):
     """Combines two textures according to the specified combination function.
     src0 and src1 should have the same number of space dimensions and channels
     if both are textures. At least one of the two must be a texture object, but
@@ -243,6 +412,8 @@ class _SimpleBinaryCombinedTexture(TransformedTexture):
     src1 - Second texture to combine, or a scalar to combine with src0.
     combination - A combining function that takes two Numpy arrays of evaluated
       texture points and combines them into one.
+    op_name - Name of the elementwise operation implemented by combination
+      ('add', 'sub' or 'mul'), or None. See TransformedTexture.
     """
     if not (isinstance(src0, Texture) or isinstance(src1, Texture)):
       raise ValueError('Expected at least one source texture.')
@@ -256,7 +427,286 @@ class _SimpleBinaryCombinedTexture(TransformedTexture):
     def space_transform(eval_pts):
       return [eval_pts, eval_pts]
     def tex_transform(src_vals):
+      # Combine with constants as scalars, so that they do not change the dtype
+      # of the other operand (e.g. float32).
+      if isinstance(src0, ScalarConstantTexture) \
+        and not isinstance(src1, ScalarConstantTexture):
+        return combination(src0.value, src_vals[1])
+      if isinstance(src1, ScalarConstantTexture) \
+        and not isinstance(src0, ScalarConstantTexture):
+        return combination(src_vals[0], src1.value)
       return combination(src_vals[0], src_vals[1])
+    def range_transform(src_ranges):
+      # Addition, subtraction and multiplication take their extreme values at
+      # the corners of the input ranges.
+      corner_vals = [combination(val0, val1) for val0 in src_ranges[0]
+        for val1 in src_ranges[1]]
+      return (min(corner_vals), max(corner_vals))
     
     super(_SimpleBinaryCombinedTexture, self).__init__(src0.num_channels,
-      src0.num_space_dims, [src0, src1], space_transform, tex_transform)
+      src0.num_space_dims, [src0, src1], space_transform, tex_transform,
+      op_name=op_name, range_transform=range_transform)
+
+class WeightedSumTexture(TransformedTexture):
+  """Weighted sum of any number of textures plus a constant. Evaluates into a
+  single result array instead of allocating an intermediate array for every
+  term, as a chain of + and * operators would. See
+  proc_tex.texture_optimize.optimize_texture, which creates these from such
+  chains."""
+  
+  def __init__(self, src_textures, weights, constant=0):
+    """Initializer.
+    src_textures - Non-empty list of textures to sum. All must have the same
+      number of channels and space dimensions.
+    weights - Scalar weight for each texture in src_textures.
+    constant - Scalar to add to the sum."""
+    if not src_textures:
+      raise ValueError('Expected at least one source texture.')
+    if len(weights) != len(src_textures):
+      raise ValueError('Expected one weight per source texture.')
+    weights = tuple(weights)
+    
+    def space_transform(eval_pts):
+      return [eval_pts] * len(src_textures)
+    def tex_transform(src_vals):
+      # Use the dtype the equivalent chain of operators would produce.
+      dtype = numpy.result_type(*src_vals, *weights, constant)
+      result = numpy.multiply(src_vals[0], weights[0], dtype=dtype)
+      scratch = None
+      for vals, weight in zip(src_vals[1:], weights[1:]):
+        if weight == 1:
+          numpy.add(result, vals, out=result)
+        else:
+          if scratch is None:
+            scratch = numpy.empty_like(result)
+          numpy.multiply(vals, weight, out=scratch)
+          numpy.add(result, scratch, out=result)
+      if constant != 0:
+        numpy.add(result, constant, out=result)
+      return result
+    def range_transform(src_ranges):
+      result_range = (constant, constant)
+      for (src_min, src_max), weight in zip(src_ranges, weights):
+        term_vals = (src_min * weight, src_max * weight)
+        result_range = (result_range[0] + min(term_vals),
+          result_range[1] + max(term_vals))
+      return result_range
+    
+    super(WeightedSumTexture, self).__init__(src_textures[0].num_channels,
+      src_textures[0].num_space_dims, list(src_textures), space_transform,
+      tex_transform, op_name='weighted_sum',
+      op_params={'weights': weights, 'constant': constant},
+      range_transform=range_transform)
+
+def write_video(frames, video_size, num_frames, frames_per_second, filename,
+  pix_fmt, codec='libvpx-vp9', codec_params=[], pipeline_depth=2):
+  """Encodes a sequence of frames into a video using FFmpeg.
+  frames - Iterable of Numpy arrays holding the frames, in order. Frames are
+    only computed as they are taken from the iterable.
+  video_size - (width, height) of the video, in pixels.
+  num_frames - Number of frames to include in the video.
+  See Texture.to_video for the other parameters."""
+  # Start the FFmpeg process.
+  video_size_arg = '{}x{}'.format(*video_size)
+  global_args = ['-y']
+  input_args = ['-f', 'rawvideo', '-pixel_format', pix_fmt,
+    '-video_size', video_size_arg, '-framerate', str(frames_per_second),
+    '-i', '-',]
+  output_args = ['-r', str(frames_per_second),
+    '-codec:v', codec] + codec_params + ['-frames:v', str(num_frames),
+    '-s', video_size_arg, filename]
+  ffmpeg_process = None
+  try:
+    ffmpeg_process = subprocess.Popen(
+      ['ffmpeg'] + global_args + input_args + output_args,
+      stdin=subprocess.PIPE)
+    
+    # Write frames. Frames are written straight from their own memory, without
+    # copying them into bytes objects first.
+    if pipeline_depth > 0:
+      writer = _FrameWriter(ffmpeg_process.stdin, pipeline_depth)
+      try:
+        for frame in frames:
+          writer.put(frame)
+      
+      finally:
+        writer.close()
+    
+    else:
+      for frame in frames:
+        ffmpeg_process.stdin.write(numpy.ascontiguousarray(frame))
+  
+  finally:
+    if ffmpeg_process is not None:
+      ffmpeg_process.stdin.close()
+      ffmpeg_process.wait()
+
+# The EvalCache in use by each thread, if any.
+_active_eval_cache = threading.local()
+
+def evaluate_source(texture, eval_pts):
+  """Evaluates a texture for another texture that depends on it. Textures
+  that evaluate other textures should use this instead of calling evaluate
+  directly, so that the results can be shared through the active EvalCache.
+  texture - The texture to evaluate.
+  eval_pts - See Texture.evaluate.
+  returns: The texture values. Must not be modified, since they may be shared
+    with other textures."""
+  cache = getattr(_active_eval_cache, 'cache', None)
+  if cache is None:
+    return texture.evaluate(eval_pts)
+  return cache.evaluate(texture, eval_pts)
+
+class EvalCache:
+  """Render-scoped cache of texture values, for texture graphs in which a
+  texture is used by several other textures (e.g. a noise texture that feeds
+  several channels).
+  While an EvalCache is active (as a context manager), evaluate_source
+  evaluates each such shared texture only once per set of evaluation points
+  and frame. Evaluation points are matched by identity, which catches the
+  common case of transformations passing the same points on to several
+  sources. Entries for a texture are freed as soon as all the textures that
+  use it have been evaluated, so intermediate values do not outlive their
+  last use. Texture.to_image uses an EvalCache automatically; use one
+  directly to evaluate a graph several times or to get statistics."""
+  def __init__(self, texture):
+    """Initializer.
+    texture - Root of the texture graph that will be evaluated."""
+    self.texture = texture
+    self.hits = 0
+    self.misses = 0
+    self.peak_entries = 0
+    self._num_entries = 0
+    self._prev_cache = None
+    self.reset()
+  
+  def reset(self):
+    """Drops all entries, and prepares for another evaluation of the whole
+    graph. Statistics are kept."""
+    # Maps texture ID to the number of uses of the texture in the graph, for
+    # textures with more than one use.
+    self._num_uses = collections.Counter()
+    visited = set()
+    
+    def visit(curr_texture):
+      if id(curr_texture) not in visited:
+        visited.add(id(curr_texture))
+        for child in curr_texture.anim_synch_textures:
+          self._num_uses[id(child)] += 1
+          visit(child)
+    
+    visit(self.texture)
+    self._num_uses = collections.Counter({texture_id: num_uses
+      for texture_id, num_uses in self._num_uses.items() if num_uses > 1})
+    self._remaining_uses = collections.Counter(self._num_uses)
+    # Maps texture ID to a dictionary mapping (evaluation points ID, frame) to
+    # (evaluation points, values). The evaluation points are kept alive so
+    # that their IDs are not reused.
+    self._entries = collections.defaultdict(dict)
+    self._num_entries = 0
+  
+  def evaluate(self, texture, eval_pts):
+    """Evaluates a texture, reusing an earlier result for the same evaluation
+    points and frame if possible. See evaluate_source."""
+    texture_id = id(texture)
+    if texture_id not in self._num_uses:
+      return texture.evaluate(eval_pts)
+    
+    key = (id(eval_pts), texture.curr_frame)
+    entries = self._entries[texture_id]
+    if key in entries:
+      self.hits += 1
+      values = entries[key][1]
+    else:
+      self.misses += 1
+      values = texture.evaluate(eval_pts)
+      entries[key] = (eval_pts, values)
+      self._num_entries += 1
+      self.peak_entries = max(self.peak_entries, self._num_entries)
+    
+    # Free the texture's entries after its last use. Textures that are used
+    # more often than the graph structure suggests (e.g. because they are
+    # evaluated at several sets of points) start counting again.
+    self._remaining_uses[texture_id] -= 1
+    if self._remaining_uses[texture_id] <= 0:
+      self._num_entries -= len(entries)
+      del self._entries[texture_id]
+      self._remaining_uses[texture_id] = self._num_uses[texture_id]
+    return values
+  
+  def stats(self):
+    """Gets statistics on the use of the cache.
+    returns: A dictionary with the number of cache hits and misses and the
+      peak number of entries held at once."""
+    return {'hits': self.hits, 'misses': self.misses,
+      'peak_entries': self.peak_entries}
+  
+  def __enter__(self):
+    self._prev_cache = getattr(_active_eval_cache, 'cache', None)
+    _active_eval_cache.cache = self
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    _active_eval_cache.cache = self._prev_cache
+    self._prev_cache = None
+    self.reset()
+
+class _FrameWriter:
+  """Writes frames to a stream from a background thread.
+  Frames wait in a bounded queue, so that at most a fixed number of computed
+  frames are held in memory at once. Errors raised while writing are raised
+  again in the thread that uses the writer."""
+  
+  # Interval at which a blocked put checks whether the writer thread failed.
+  _POLL_INTERVAL = 0.1
+  
+  def __init__(self, stream, max_queued_frames):
+    """Initializer.
+    stream - Binary stream to write to, such as a pipe to FFmpeg's stdin.
+    max_queued_frames - Maximum number of frames waiting to be written."""
+    self.stream = stream
+    self._queue = queue.Queue(max_queued_frames)
+    self._error = None
+    self._thread = threading.Thread(target=self._write_frames, daemon=True)
+    self._thread.start()
+  
+  def put(self, frame):
+    """Queues a frame to be written, waiting if the queue is full.
+    frame - Numpy array containing the frame. Must not be modified
+      afterwards."""
+    frame = numpy.ascontiguousarray(frame)
+    while True:
+      self._raise_error()
+      try:
+        self._queue.put(frame, timeout=self._POLL_INTERVAL)
+        return
+      except queue.Full:
+        pass
+  
+  def close(self):
+    """Waits until all queued frames are written, and stops the thread."""
+    while self._thread.is_alive():
+      try:
+        self._queue.put(None, timeout=self._POLL_INTERVAL)
+        break
+      except queue.Full:
+        pass
+    self._thread.join()
+    self._raise_error()
+  
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+  
+  def _write_frames(self):
+    try:
+      while True:
+        frame = self._queue.get()
+        if frame is None:
+          return
+        # Numpy arrays support the buffer protocol, so they can be written
+        # without copying.
+        self.stream.write(frame)
+    except Exception as error:
+      self._error = error
@@ -0,0 +1,493 @@
+import contextlib
+import copy
+import math
+
+import numpy
+
+from proc_tex.texture_base import ImplicitGridPts, ScalarConstantTexture, \
+  Texture, TransformedTexture
+from proc_tex.texture_transforms import RANGE_MODE_KNOWN, \
+  record_src_range, scale_offset_for_range
+import proc_tex.numpy_noise
+
+# TransformedTexture operations (see TransformedTexture.op_name) that can be
+# computed inside a fused kernel.
+_FUSIBLE_OPS = {'add', 'sub', 'mul', 'weighted_sum', 'concat_channels',
+  'to_num_channels', 'space_offset', 'sphere_map', 'cube_map',
+  'octahedral_map', 'scale_to_region'}
+# Operations that map 2D points onto a sphere in a 3D source texture (see
+# sphereMap.clh).
+_SPHERE_OPS = {'sphere_map', 'cube_map', 'octahedral_map'}
+_BINARY_OPERATORS = {'add': '+', 'sub': '-', 'mul': '*'}
+_VECTOR_COMPONENTS = ['x', 'y', 'z']
+
+def fuse_texture(texture, cl_runtime):
+  """Compiles the fusible parts of a texture graph into fused OpenCL kernels.
+  A texture is fusible if it is an OpenCL texture that supports fusion (see
+  OpenCLCellNoise3D.cl_fusion_expr) and computes with cl_runtime in the
+  runtime's dtype without being restricted to the Numpy backend (see
+  proc_tex.numpy_noise), a ScalarConstantTexture, or a TransformedTexture
+  made by one of the standard operators or transformation functions that
+  fuse_texture understands (see _FUSIBLE_OPS). Each maximal subgraph of
+  fusible textures is replaced by a FusedOpenCLTexture, which evaluates the
+  whole subgraph in one kernel launch and keeps intermediate values in
+  registers instead of host memory.
+  tex_scale_to_region needs the range of its source over the whole frame, so
+  its source is computed in a separate kernel launch first, followed by a
+  parallel min/max reduction on the device. The fused kernel computes the
+  scale and offset from the reduction result, so the source values never
+  travel through host memory. (Textures using RANGE_MODE_KNOWN need neither
+  pass.) Non-fusible textures inside a fusible subgraph are evaluated the
+  normal way, and their results are passed to the fused kernel in a buffer.
+  The original graph is not modified, and still owns the animation state.
+  set_frame on the returned texture moves the original graph along with it.
+  Fused kernels compute in cl_runtime.dtype.
+  texture - Root of the texture graph to fuse.
+  cl_runtime - The OpenCLRuntime to use for fused kernels.
+  Returns: A texture that computes the same values as texture."""
+  return _rewrite(texture, cl_runtime, {})
+
+def _is_fusible(texture, cl_runtime):
+  if isinstance(texture, ScalarConstantTexture):
+    return True
+  if isinstance(texture, TransformedTexture):
+    return texture.op_name in _FUSIBLE_OPS
+  # cl_fusion_expr gives a single value, so only single channel leaf textures
+  # can be fused. Leaf textures can also opt out with a false cl_fusible
+  # attribute, e.g. if they need build options that fused programs lack.
+  return hasattr(texture, 'cl_fusion_expr') \
+    and getattr(texture, 'cl_fusible', True) \
+    and texture.num_channels == 1 \
+    and getattr(texture, 'cl_runtime', None) is cl_runtime \
+    and texture.dtype == cl_runtime.dtype \
+    and texture.backend != proc_tex.numpy_noise.BACKEND_NUMPY
+
+def _rewrite(texture, cl_runtime, rewritten):
+  """Rewrites a texture graph for fuse_texture.
+  rewritten - Dictionary mapping the IDs of already rewritten textures to
+    their replacements, so that textures shared between several consumers
+    are only rewritten once."""
+  if id(texture) not in rewritten:
+    if isinstance(texture, TransformedTexture) \
+      and _is_fusible(texture, cl_runtime):
+      result = FusedOpenCLTexture(texture, cl_runtime, rewritten)
+    elif isinstance(texture, TransformedTexture):
+      result = copy.copy(texture)
+      result.src_textures = [_rewrite(src, cl_runtime, rewritten)
+        for src in texture.src_textures]
+    else:
+      # Leaf textures gain nothing from fusion on their own.
+      result = texture
+    rewritten[id(texture)] = result
+  return rewritten[id(texture)]
+
+def _literal(value):
+  """Converts a scalar to an OpenCL floating point literal."""
+  value = float(value)
+  if math.isnan(value):
+    return 'NAN'
+  if math.isinf(value):
+    return 'INFINITY' if value > 0 else '(-INFINITY)'
+  return '({!r})'.format(value)
+
+class _Point:
+  """Evaluation point inside a fused kernel. Described by the chain of space
+  transformations applied to the kernel's input point, so that the same point
+  can be recomputed in several kernels."""
+  def __init__(self, num_dims, parent=None, transform=None):
+    """Initializer.
+    num_dims - Number of spatial dimensions of the point.
+    parent - The point to which transform is applied, or None for a kernel's
+      input point.
+    transform - The TransformedTexture whose space transformation produces
+      this point from parent."""
+    self.num_dims = num_dims
+    self.parent = parent
+    self.transform = transform
+    self.key = () if parent is None else parent.key + (id(transform),)
+
+class _KernelBuilder:
+  """Generates the source code for a single fused kernel."""
+  def __init__(self, fused, num_root_dims):
+    """Initializer.
+    fused - The FusedOpenCLTexture the kernel belongs to.
+    num_root_dims - Number of spatial dimensions of the input points."""
+    self.fused = fused
+    self.num_root_dims = num_root_dims
+    self.headers = []
+    # List of (declaration, name, getter) for the kernel's extra arguments.
+    # getter takes an _EvalState and returns the argument value.
+    self.params = []
+    self.lines = []
+    self._num_vars = 0
+    self._point_vars = {(): 'pt0'}
+    self._values = {}
+  
+  def new_var(self, c_type, expr):
+    name = 'v{}'.format(self._num_vars)
+    self._num_vars += 1
+    self.lines.append('{} {} = {};'.format(c_type, name, expr))
+    return name
+  
+  def add_param(self, decl, getter):
+    name = 'arg{}'.format(len(self.params))
+    self.params.append((decl, name, getter))
+    return name
+  
+  def add_header(self, header):
+    if header not in self.headers:
+      self.headers.append(header)
+  
+  def read_buffer(self, buffer_name, num_channels):
+    """Gets expressions that read the current pixel's channels from a
+    buffer."""
+    if num_channels == 1:
+      return ['{}[pixelIdx]'.format(buffer_name)]
+    return ['{}[pixelIdx * {} + {}]'.format(buffer_name, num_channels, channel)
+      for channel in range(num_channels)]
+  
+  def point_var(self, point):
+    """Gets the name of the variable holding a point, generating the code that
+    computes it if necessary."""
+    if point.key not in self._point_vars:
+      parent_var = self.point_var(point.parent)
+      transform = point.transform
+      vector_type = 'real{}'.format(point.num_dims)
+      if transform.op_name == 'space_offset':
+        offsets = self.values(transform.op_params['offset_texture'],
+          point.parent)
+        expr = '{} + ({}) ({})'.format(parent_var, vector_type,
+          ', '.join(offsets))
+      elif transform.op_name == 'sphere_map':
+        self.add_header('sphereMap.clh')
+        center = transform.op_params['center']
+        expr = 'sphereMapTo3DAt({}, (real3) ({}), {})'.format(
+          _literal(transform.op_params['radius']),
+          ', '.join(_literal(coord) for coord in center), parent_var)
+      elif transform.op_name == 'cube_map':
+        self.add_header('sphereMap.clh')
+        center = transform.op_params['center']
+        expr = 'cubeMapTo3DAt((real3) ({}), {}, {})'.format(
+          ', '.join(_literal(coord) for coord in center),
+          int(transform.op_params['equi_angular']), parent_var)
+      elif transform.op_name == 'octahedral_map':
+        self.add_header('sphereMap.clh')
+        center = transform.op_params['center']
+        expr = 'octahedralMapTo3DAt((real3) ({}), {})'.format(
+          ', '.join(_literal(coord) for coord in center), parent_var)
+      else:
+        raise ValueError(
+          'Unsupported space transformation: {}'.format(transform.op_name))
+      self._point_vars[point.key] = self.new_var(vector_type, expr)
+    return self._point_vars[point.key]
+  
+  def point_components(self, point):
+    """Gets expressions for the components of a point."""
+    point_var = self.point_var(point)
+    return ['{}.{}'.format(point_var, component)
+      for component in _VECTOR_COMPONENTS[:point.num_dims]]
+  
+  def values(self, texture, point):
+    """Gets expressions for the channels of a texture evaluated at a point,
+    generating the code that computes them if necessary."""
+    key = (id(texture), point.key)
+    if key not in self._values:
+      self._values[key] = self._gen_values(texture, point)
+    return self._values[key]
+  
+  def _gen_values(self, texture, point):
+    if isinstance(texture, ScalarConstantTexture):
+      return [_literal(texture.value)] * texture.num_channels
+    
+    if not _is_fusible(texture, self.fused.cl_runtime):
+      return self._gen_host_values(texture, point)
+    
+    if not isinstance(texture, TransformedTexture):
+      # OpenCL leaf texture.
+      for header in texture.cl_fusion_headers():
+        self.add_header(header)
+      arg_names = []
+      for arg_idx, (decl, _) in enumerate(texture.cl_fusion_args()):
+        arg_names.append(self.add_param(decl,
+          lambda state, texture=texture, arg_idx=arg_idx:
+            state.leaf_args(texture)[arg_idx]))
+      return [self.new_var('real',
+        texture.cl_fusion_expr(self.point_var(point), arg_names))]
+    
+    op_name = texture.op_name
+    srcs = texture.src_textures
+    if op_name in _BINARY_OPERATORS:
+      src0_values = self.values(srcs[0], point)
+      src1_values = self.values(srcs[1], point)
+      return [self.new_var('real', '{} {} {}'.format(value0,
+        _BINARY_OPERATORS[op_name], value1))
+        for value0, value1 in zip(src0_values, src1_values)]
+    elif op_name == 'weighted_sum':
+      src_values = [self.values(src, point) for src in srcs]
+      weights = [_literal(weight) for weight in texture.op_params['weights']]
+      constant = _literal(texture.op_params['constant'])
+      return [self.new_var('real', ' + '.join(
+        ['{} * {}'.format(weight, values[channel])
+          for weight, values in zip(weights, src_values)] + [constant]))
+        for channel in range(texture.num_channels)]
+    elif op_name == 'concat_channels':
+      return [value for src in srcs for value in self.values(src, point)]
+    elif op_name == 'to_num_channels':
+      # Matches the round robin order used by tex_to_num_channels.
+      src_values = self.values(srcs[0], point)
+      return [src_values[channel % len(src_values)]
+        for channel in range(texture.op_params['num_channels'])]
+    elif op_name == 'space_offset':
+      return self.values(srcs[0], _Point(point.num_dims, point, texture))
+    elif op_name in _SPHERE_OPS:
+      return self.values(srcs[0], _Point(3, point, texture))
+    elif op_name == 'scale_to_region':
+      min_value = _literal(texture.op_params['min_value'])
+      max_value = _literal(texture.op_params['max_value'])
+      if texture.op_params['range_mode'] == RANGE_MODE_KNOWN:
+        # The scale and offset do not depend on the source values, so they can
+        # be computed on the host.
+        def get_scale_offset(state):
+          return numpy.array(scale_offset_for_range(
+            texture.op_params['get_src_range'](),
+            texture.op_params['min_value'], texture.op_params['max_value']),
+            dtype=state.dtype)
+        src_values = self.values(srcs[0], point)
+        scale = self.add_param('const real',
+          lambda state: get_scale_offset(state)[0])
+        offset = self.add_param('const real',
+          lambda state: get_scale_offset(state)[1])
+      else:
+        self.add_header('minMax.clh')
+        scale_pass = self.fused.get_pass(_ScalePass, texture, point)
+        src_buffer = self.add_param('__global const real *',
+          scale_pass.get_buffer)
+        range_buffer = self.add_param('__global const real *',
+          scale_pass.get_range_buffer)
+        src_values = self.read_buffer(src_buffer, srcs[0].num_channels)
+        scale_offset = self.new_var('real2',
+          'scaleOffsetForRange(vload2(0, {}), {}, {})'.format(range_buffer,
+            min_value, max_value))
+        scale = scale_offset + '.x'
+        offset = scale_offset + '.y'
+      return [self.new_var('real', '{} * {} + {}'.format(value, scale,
+        offset)) for value in src_values]
+    raise ValueError('Unsupported operation: {}'.format(op_name))
+  
+  def _gen_host_values(self, texture, point):
+    """Generates code that reads the values of a non-fusible texture, which are
+    computed outside the kernel."""
+    host_pass = self.fused.get_pass(_HostPass, texture, point)
+    buffer_name = self.add_param('__global const real *',
+      host_pass.get_buffer)
+    return self.read_buffer(buffer_name, texture.num_channels)
+  
+  def build(self, outputs, is_grid):
+    """Builds the kernel.
+    outputs - Expressions for the channels to store for each pixel.
+    is_grid - Whether the kernel takes its evaluation points as an
+      implicitGrid struct (see implicitGrid.clh) instead of a buffer.
+    Returns: The built PyOpenCL program. Its kernel is named fusedTexture."""
+    num_outputs = len(outputs)
+    root_type = 'real{}'.format(self.num_root_dims)
+    headers = list(self.headers)
+    if is_grid:
+      headers.append('implicitGrid.clh')
+      eval_pts_param = 'const implicitGrid grid'
+      root_expr = 'implicitGridPt{}D(grid, pixelIdx)'.format(
+        self.num_root_dims)
+    else:
+      eval_pts_param = '__global const real *evalPts'
+      root_expr = 'vload{}(pixelIdx, evalPts)'.format(self.num_root_dims)
+    params = [eval_pts_param] \
+      + ['{} {}'.format(decl, name) for decl, name, _ in self.params] \
+      + ['__global real *result']
+    source_lines = ['#include "real.clh"', '']
+    source_lines += ['#include "{}"'.format(header) for header in headers]
+    source_lines += ['',
+      '__kernel void fusedTexture({})'.format(', '.join(params)),
+      '{',
+      '  size_t pixelIdx = get_global_id(0);',
+      '  {} pt0 = {};'.format(root_type, root_expr)]
+    source_lines += ['  ' + line for line in self.lines]
+    source_lines += ['  result[pixelIdx * {} + {}] = {};'.format(num_outputs,
+      channel, output) for channel, output in enumerate(outputs)]
+    source_lines += ['}', '']
+    return self.fused.cl_runtime.build_source('\n'.join(source_lines))
+
+class _FusedKernel:
+  """A fused kernel along with the information needed to run it. The kernel is
+  built separately for implicit grids and for buffers of evaluation points,
+  the first time each is needed."""
+  def __init__(self, builder, outputs):
+    self.builder = builder
+    self.outputs = outputs
+    self.getters = [getter for _, _, getter in builder.params]
+    self.num_outputs = len(outputs)
+    self._programs = {}
+  
+  def run(self, state, result_buffer):
+    if state.is_grid not in self._programs:
+      self._programs[state.is_grid] = self.builder.build(self.outputs,
+        state.is_grid)
+    args = [state.eval_pts_arg] + [getter(state) for getter in self.getters] \
+      + [result_buffer]
+    kernel = state.cl_runtime.get_kernel(self._programs[state.is_grid],
+      'fusedTexture')
+    state.cl_runtime.run_kernel(kernel, (state.num_pts,), None, *args)
+
+class _ScalePass:
+  """Pass that computes the source of a tex_scale_to_region texture and the
+  range of the source values, leaving both on the device."""
+  def __init__(self, fused, texture, point):
+    self.texture = texture
+    self.src = texture.src_textures[0]
+    builder = _KernelBuilder(fused, fused.num_space_dims)
+    self.kernel = _FusedKernel(builder, builder.values(self.src, point))
+  
+  def run(self, state, exit_stack):
+    num_values = state.num_pts * self.kernel.num_outputs
+    buffer = exit_stack.enter_context(state.cl_runtime.scratch_buffer(
+      num_values * state.dtype.itemsize))
+    self.kernel.run(state, buffer)
+    state.buffers[self] = buffer
+    
+    # The scale and offset depend on the range of the source values over the
+    # whole frame. If the range has been pinned (see tex_scale_to_region), the
+    # values being evaluated might only be part of the frame.
+    op_params = self.texture.op_params
+    if op_params['pinned_src_range'] is not None:
+      range_buffer = exit_stack.enter_context(state.cl_runtime.upload(
+        numpy.array(op_params['pinned_src_range'], dtype=state.dtype)))
+    else:
+      range_buffer = exit_stack.enter_context(state.cl_runtime.scratch_buffer(
+        2 * state.dtype.itemsize))
+      state.cl_runtime.min_max_reduce(buffer, num_values, range_buffer,
+        state.dtype)
+      if op_params['recorded_src_range'] is not None:
+        src_range = state.cl_runtime.download(
+          numpy.empty(2, dtype=state.dtype), range_buffer)
+        record_src_range(op_params, src_range)
+    state.range_buffers[self] = range_buffer
+  
+  def get_buffer(self, state):
+    return state.buffers[self]
+  
+  def get_range_buffer(self, state):
+    return state.range_buffers[self]
+
+class _HostPass:
+  """Pass that evaluates a non-fusible texture outside of the fused kernels
+  and uploads the results."""
+  def __init__(self, fused, texture, point):
+    self.texture = fused.rewrite(texture)
+    self.point = point
+    self.kernel = None
+    if point.parent is not None:
+      # A kernel is needed to compute the texture's evaluation points.
+      builder = _KernelBuilder(fused, fused.num_space_dims)
+      self.kernel = _FusedKernel(builder, builder.point_components(point))
+  
+  def run(self, state, exit_stack):
+    if self.kernel is None:
+      eval_pts = state.eval_pts
+    else:
+      with state.cl_runtime.scratch_buffer(state.num_pts * self.point.num_dims
+        * state.dtype.itemsize) as pts_buffer:
+        self.kernel.run(state, pts_buffer)
+        eval_pts = numpy.empty(state.eval_pts.shape[:-1]
+          + (self.point.num_dims,), dtype=state.dtype)
+        state.cl_runtime.download(eval_pts, pts_buffer)
+    src_vals = numpy.asarray(self.texture.evaluate(eval_pts),
+      dtype=state.dtype)
+    state.buffers[self] = exit_stack.enter_context(
+      state.cl_runtime.upload(src_vals))
+  
+  def get_buffer(self, state):
+    return state.buffers[self]
+
+class _EvalState:
+  """Per-evaluation state shared by the passes of a FusedOpenCLTexture."""
+  def __init__(self, cl_runtime, eval_pts, is_grid, eval_pts_arg):
+    self.cl_runtime = cl_runtime
+    self.eval_pts = eval_pts
+    self.is_grid = is_grid
+    self.eval_pts_arg = eval_pts_arg
+    self.dtype = cl_runtime.dtype
+    self.num_pts = eval_pts.size // eval_pts.shape[-1]
+    # Pass outputs, keyed by pass.
+    self.buffers = {}
+    self.range_buffers = {}
+    self._leaf_args = {}
+  
+  def leaf_args(self, texture):
+    """Gets the current kernel argument values for an OpenCL leaf texture."""
+    if id(texture) not in self._leaf_args:
+      self._leaf_args[id(texture)] = [value
+        for _, value in texture.cl_fusion_args()]
+    return self._leaf_args[id(texture)]
+
+class FusedOpenCLTexture(Texture):
+  """Texture that evaluates a graph of fusible textures with fused OpenCL
+  kernels. See fuse_texture."""
+  def __init__(self, src, cl_runtime, rewritten=None):
+    """Initializer.
+    src - Root of the fusible texture graph.
+    cl_runtime - The OpenCLRuntime to use for the fused kernels.
+    rewritten - See _rewrite. Used to rewrite non-fusible textures found in
+      the graph."""
+    super(FusedOpenCLTexture, self).__init__(src.num_channels,
+      src.num_space_dims, [src])
+    self.src = src
+    self.cl_runtime = cl_runtime
+    self.dtype = cl_runtime.dtype
+    self._rewritten = {} if rewritten is None else rewritten
+    # Passes that must run before the main kernel, in dependency order.
+    self._passes = []
+    self._passes_by_key = {}
+    
+    builder = _KernelBuilder(self, src.num_space_dims)
+    self._main_kernel = _FusedKernel(builder,
+      builder.values(src, _Point(src.num_space_dims)))
+  
+  def rewrite(self, texture):
+    """Rewrites a non-fusible texture found in the graph. See fuse_texture."""
+    return _rewrite(texture, self.cl_runtime, self._rewritten)
+  
+  def inner_textures(self):
+    """Gets the textures rewritten while fusing the graph, which include the
+    non-fusible textures that the fused kernels evaluate the normal way."""
+    return list(self._rewritten.values())
+  
+  def get_pass(self, pass_type, texture, point):
+    """Gets the pass of the specified type for a texture at a point, creating
+    it if necessary."""
+    key = (pass_type, id(texture), point.key)
+    if key not in self._passes_by_key:
+      # Creating the pass registers the passes it depends on first.
+      new_pass = pass_type(self, texture, point)
+      self._passes_by_key[key] = new_pass
+      self._passes.append(new_pass)
+    return self._passes_by_key[key]
+  
+  def evaluate(self, eval_pts):
+    if not isinstance(eval_pts, ImplicitGridPts):
+      eval_pts = numpy.ascontiguousarray(eval_pts, dtype=self.dtype)
+    result_shape = eval_pts.shape[:-1] + (self.num_channels,)
+    result_array = numpy.empty(result_shape, dtype=self.dtype)
+    
+    with contextlib.ExitStack() as exit_stack:
+      # Implicit grids of evaluation points are computed on the device instead
+      # of being uploaded.
+      is_grid, eval_pts_arg = exit_stack.enter_context(
+        self.cl_runtime.eval_pts_arg(eval_pts))
+      state = _EvalState(self.cl_runtime, eval_pts, is_grid, eval_pts_arg)
+      for fusion_pass in self._passes:
+        fusion_pass.run(state, exit_stack)
+      
+      result_buffer = exit_stack.enter_context(
+        self.cl_runtime.scratch_buffer(result_array.nbytes))
+      self._main_kernel.run(state, result_buffer)
+      self.cl_runtime.download(result_array, result_buffer)
+    
+    return result_array
@@ -0,0 +1,119 @@
+import copy
+
+from proc_tex.texture_base import ScalarConstantTexture, TransformedTexture, \
+  WeightedSumTexture
+
+_LINEAR_OPS = {'add', 'sub', 'mul', 'weighted_sum'}
+
+def optimize_texture(texture):
+  """Simplifies the arithmetic in a texture graph.
+  Operations on constants are folded into single constants, and chains of +, -
+  and multiplication by constants are flattened into a WeightedSumTexture per
+  chain, with terms of weight 0 and additions of 0 removed and repeated terms
+  merged. Expressions built up term by term, e.g. starting from a zero
+  ScalarConstantTexture and adding weighted textures to it, are then
+  evaluated without intermediate arrays. Since terms of weight 0 are removed,
+  NaN or infinite values in those terms no longer affect the result.
+  The original graph is not modified. Leaf textures, and all textures that
+  are not part of a simplified expression, are shared with the original
+  graph, so set_frame on the returned texture animates the same leaves. The
+  result can be passed on to proc_tex.texture_fusion.fuse_texture.
+  texture - Root of the texture graph to optimize.
+  Returns: A texture that computes the same values as texture."""
+  return _optimize(texture, {})
+
+def _optimize(texture, optimized):
+  """Optimizes a texture graph for optimize_texture.
+  optimized - Dictionary mapping the IDs of already optimized textures to
+    their replacements, so that textures shared between several consumers are
+    only optimized once."""
+  if id(texture) not in optimized:
+    if not isinstance(texture, TransformedTexture):
+      result = texture
+    elif texture.op_name in _LINEAR_OPS:
+      result = _optimize_linear(texture, optimized)
+    else:
+      result = _copy_with_srcs(texture, [_optimize(src, optimized)
+        for src in texture.src_textures])
+    optimized[id(texture)] = result
+  return optimized[id(texture)]
+
+def _copy_with_srcs(texture, src_textures):
+  """Copies a TransformedTexture, replacing its source textures."""
+  if all(new_src is src
+    for new_src, src in zip(src_textures, texture.src_textures)):
+    return texture
+  result = copy.copy(texture)
+  result.src_textures = src_textures
+  # Keep animating any extra textures, e.g. the offset texture of
+  # tex_space_offset_by_texture.
+  result.anim_synch_textures = [anim_texture
+    for anim_texture in texture.anim_synch_textures
+    if not any(anim_texture is src for src in texture.src_textures)] \
+    + src_textures
+  return result
+
+def _linear_form(texture):
+  """Expresses an optimized texture as a weighted sum.
+  Returns: A (terms, constant) tuple, where terms is a list of
+    (weight, texture) tuples."""
+  if isinstance(texture, ScalarConstantTexture):
+    return [], texture.value
+  if getattr(texture, 'op_name', None) == 'weighted_sum':
+    return list(zip(texture.op_params['weights'], texture.src_textures)), \
+      texture.op_params['constant']
+  return [(1, texture)], 0
+
+def _optimize_linear(texture, optimized):
+  srcs = [_optimize(src, optimized) for src in texture.src_textures]
+  forms = [_linear_form(src) for src in srcs]
+  op_name = texture.op_name
+  if op_name == 'weighted_sum':
+    terms = []
+    constant = texture.op_params['constant']
+    for weight, (src_terms, src_constant) in zip(
+      texture.op_params['weights'], forms):
+      terms += [(weight * src_weight, src) for src_weight, src in src_terms]
+      constant = constant + weight * src_constant
+  elif op_name == 'add':
+    terms = forms[0][0] + forms[1][0]
+    constant = forms[0][1] + forms[1][1]
+  elif op_name == 'sub':
+    terms = forms[0][0] + [(-weight, src) for weight, src in forms[1][0]]
+    constant = forms[0][1] - forms[1][1]
+  else:
+    # Multiplication is only linear if one of the operands is constant.
+    if forms[0][0] and forms[1][0]:
+      return _copy_with_srcs(texture, srcs)
+    scale, (terms, constant) = (forms[0][1], forms[1]) if not forms[0][0] \
+      else (forms[1][1], forms[0])
+    terms = [(scale * weight, src) for weight, src in terms]
+    constant = scale * constant
+  
+  return _from_linear_form(texture, terms, constant)
+
+def _from_linear_form(texture, terms, constant):
+  """Builds the simplest texture for a weighted sum.
+  texture - The texture being replaced, which determines the number of
+    channels and space dimensions.
+  terms - List of (weight, texture) tuples.
+  constant - Scalar to add to the sum."""
+  # Merge repeated terms, keeping the order in which they first appear.
+  merged_weights = {}
+  merged_srcs = []
+  for weight, src in terms:
+    if id(src) in merged_weights:
+      merged_weights[id(src)] += weight
+    else:
+      merged_weights[id(src)] = weight
+      merged_srcs.append(src)
+  terms = [(merged_weights[id(src)], src) for src in merged_srcs
+    if merged_weights[id(src)] != 0]
+  
+  if not terms:
+    return ScalarConstantTexture(texture.num_channels, texture.num_space_dims,
+      constant)
+  if len(terms) == 1 and terms[0][0] == 1 and constant == 0:
+    return terms[0][1]
+  return WeightedSumTexture([src for _, src in terms],
+    [weight for weight, _ in terms], constant)
@@ -0,0 +1,327 @@
+import collections
+import json
+import threading
+import time
+
+from proc_tex.texture_base import TransformedTexture
+
+# Label of the pseudo-node for commands enqueued outside of any texture
+# evaluation, e.g. by animation updates.
+UNATTRIBUTED_LABEL = '<unattributed>'
+
+# Process IDs of the host and device timelines in Chrome traces.
+_HOST_PID = 0
+_DEVICE_PID = 1
+
+_STAT_COLUMNS = [('calls', 'calls', 1, '{:d}'),
+  ('wall_s', 'wall ms', 1e3, '{:.2f}'), ('self_s', 'self ms', 1e3, '{:.2f}'),
+  ('kernel_s', 'kernel ms', 1e3, '{:.2f}'),
+  ('upload_bytes', 'up KiB', 1 / 1024, '{:.0f}'),
+  ('download_bytes', 'down KiB', 1 / 1024, '{:.0f}'),
+  ('alloc_bytes', 'alloc KiB', 1 / 1024, '{:.0f}')]
+
+def _graph_nodes(texture):
+  """Lists all textures in a graph: sources, textures animated along with
+  others, and the textures evaluated inside fused kernels (see
+  FusedOpenCLTexture.inner_textures), in a deterministic order without
+  duplicates."""
+  nodes = []
+  visited = set()
+  
+  def visit(node):
+    if id(node) in visited:
+      return
+    visited.add(id(node))
+    nodes.append(node)
+    children = list(getattr(node, 'src_textures', [])) \
+      + list(node.anim_synch_textures)
+    if hasattr(node, 'inner_textures'):
+      children += node.inner_textures()
+    for child in children:
+      visit(child)
+  
+  visit(texture)
+  return nodes
+
+def _node_label(idx, node):
+  if isinstance(node, TransformedTexture):
+    return '{}:{}'.format(idx, node.op_name)
+  return '{}:{}'.format(idx, type(node).__name__)
+
+class _Call:
+  """A single evaluation of a texture."""
+  def __init__(self, label, parent_label, frame_idx):
+    self.label = label
+    self.parent_label = parent_label
+    self.frame_idx = frame_idx
+    self.thread_id = threading.get_ident()
+    self.start_ns = time.perf_counter_ns()
+    self.end_ns = None
+    # Wall time spent in nested evaluations of other textures.
+    self.child_ns = 0
+
+class _Command:
+  """An OpenCL command or scratch buffer allocation."""
+  def __init__(self, kind, name, event, num_bytes, call, device_idx):
+    self.kind = kind
+    self.name = name
+    self.event = event
+    self.num_bytes = num_bytes
+    self.call = call
+    self.device_idx = device_idx
+    self.host_ns = time.perf_counter_ns()
+
+class TextureProfiler:
+  """Records, for each texture in a graph, the wall time spent evaluating it,
+  the device time of the OpenCL kernels and transfers it enqueues, and the
+  bytes it uploads, downloads and allocates in scratch buffers, per frame.
+  Use as a context manager around the evaluations to profile, e.g. a call to
+  to_image or to_video. While active, the evaluate method of every texture in
+  the graph is wrapped and the profiler listens to the OpenCLRuntime's
+  commands (see OpenCLRuntime.add_event_listener). Nothing is wrapped or
+  recorded while no profiler is active.
+  The device times of commands come from OpenCL event profiling, so they need
+  an OpenCLRuntime created with profiling enabled; otherwise they are None.
+  Wall times include nested evaluations, and self times exclude evaluations
+  of other textures in the graph. Results from cache hits (see EvalCache) do
+  not count as evaluations.
+  The results can be printed as a tree with summary, or exported as a Chrome
+  trace (see write_chrome_trace) to be viewed in chrome://tracing or
+  Perfetto."""
+  def __init__(self, texture, cl_runtime=None):
+    """Initializer.
+    texture - Root of the texture graph to profile.
+    cl_runtime - The OpenCLRuntime whose commands to record, or None to only
+      record wall times."""
+    self.texture = texture
+    self.cl_runtime = cl_runtime
+    self._nodes = _graph_nodes(texture)
+    self._labels = {id(node): _node_label(idx, node)
+      for idx, node in enumerate(self._nodes)}
+    self._calls = []
+    self._commands = []
+    self._thread_state = threading.local()
+    # Instance attributes named evaluate that the wrappers replace, if any.
+    self._prev_evaluates = None
+  
+  def __enter__(self):
+    if self._prev_evaluates is not None:
+      raise ValueError('The profiler is already active.')
+    self._prev_evaluates = {}
+    for node in self._nodes:
+      self._prev_evaluates[id(node)] = vars(node).get('evaluate')
+      node.evaluate = self._wrap(node, node.evaluate)
+    if self.cl_runtime is not None:
+      self.cl_runtime.add_event_listener(self._on_command)
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.cl_runtime is not None:
+      self.cl_runtime.remove_event_listener(self._on_command)
+    for node in self._nodes:
+      prev_evaluate = self._prev_evaluates[id(node)]
+      if prev_evaluate is None:
+        del node.evaluate
+      else:
+        node.evaluate = prev_evaluate
+    self._prev_evaluates = None
+  
+  def clear(self):
+    """Discards everything recorded so far."""
+    self._calls = []
+    self._commands = []
+  
+  def frames(self):
+    """Gets the indices of the frames in which evaluations were recorded.
+    returns: A sorted list of frame indices."""
+    return sorted({call.frame_idx for call in self._calls})
+  
+  def node_stats(self, frame_idx=None):
+    """Aggregates the recorded statistics per texture.
+    frame_idx - Frame to aggregate, or None to aggregate all frames.
+    returns: An OrderedDict mapping texture labels (index in the graph and
+      class or operation name) to dictionaries with keys calls, wall_s,
+      self_s, kernel_s, upload_s, download_s, upload_bytes, download_bytes and
+      alloc_bytes. Device times are None without event profiling. Commands
+      enqueued outside of evaluations are under UNATTRIBUTED_LABEL."""
+    has_device_times = self.cl_runtime is not None \
+      and self.cl_runtime.profiling
+    device_time = 0.0 if has_device_times else None
+    labels = [self._labels[id(node)] for node in self._nodes] \
+      + [UNATTRIBUTED_LABEL]
+    stats = collections.OrderedDict((label, {'calls': 0, 'wall_s': 0.0,
+      'self_s': 0.0, 'kernel_s': device_time, 'upload_s': device_time,
+      'download_s': device_time, 'upload_bytes': 0, 'download_bytes': 0,
+      'alloc_bytes': 0}) for label in labels)
+    
+    for call in self._calls:
+      if frame_idx is None or call.frame_idx == frame_idx:
+        node_stats = stats[call.label]
+        node_stats['calls'] += 1
+        node_stats['wall_s'] += (call.end_ns - call.start_ns) * 1e-9
+        node_stats['self_s'] += (call.end_ns - call.start_ns
+          - call.child_ns) * 1e-9
+    
+    for command in self._commands:
+      if command.call is None:
+        if frame_idx is not None:
+          continue
+        node_stats = stats[UNATTRIBUTED_LABEL]
+      elif frame_idx is None or command.call.frame_idx == frame_idx:
+        node_stats = stats[command.call.label]
+      else:
+        continue
+      if command.kind == 'alloc':
+        node_stats['alloc_bytes'] += command.num_bytes
+        continue
+      if command.kind != 'kernel':
+        node_stats[command.kind + '_bytes'] += command.num_bytes
+      if has_device_times:
+        start_ns, end_ns = self._device_span(command)
+        node_stats[command.kind + '_s'] += (end_ns - start_ns) * 1e-9
+    
+    return stats
+  
+  def frame_stats(self):
+    """Aggregates the recorded statistics per frame and texture.
+    returns: A dictionary mapping frame indices to the results of node_stats
+      for the frame."""
+    return {frame_idx: self.node_stats(frame_idx)
+      for frame_idx in self.frames()}
+  
+  def summary(self, frame_idx=None):
+    """Formats the statistics of node_stats as a tree following the observed
+    evaluation order, with a row per texture. A texture evaluated by several
+    others appears in full under the first one only.
+    frame_idx - See node_stats.
+    returns: The summary as a string."""
+    stats = self.node_stats(frame_idx)
+    children = collections.OrderedDict()
+    roots = []
+    for call in self._calls:
+      parent_children = roots if call.parent_label is None \
+        else children.setdefault(call.parent_label, [])
+      if call.label not in parent_children:
+        parent_children.append(call.label)
+    unattributed_stats = stats[UNATTRIBUTED_LABEL]
+    if any(unattributed_stats[key] for key in ('kernel_s', 'upload_bytes',
+      'download_bytes', 'alloc_bytes')):
+      roots.append(UNATTRIBUTED_LABEL)
+    
+    name_width = 40
+    lines = ['{:<{}}'.format('texture', name_width) + ''.join(
+      '{:>11}'.format(heading) for _, heading, _, _ in _STAT_COLUMNS)]
+    printed = set()
+    
+    def add_lines(label, depth):
+      name = '  ' * depth + label
+      if label in printed:
+        lines.append('{} (see above)'.format(name))
+        return
+      printed.add(label)
+      row = '{:<{}}'.format(name, name_width)
+      for key, _, scale, value_format in _STAT_COLUMNS:
+        value = stats[label][key]
+        row += '{:>11}'.format('-' if value is None
+          else value_format.format(value * scale if scale != 1 else value))
+      lines.append(row)
+      for child_label in children.get(label, []):
+        add_lines(child_label, depth + 1)
+    
+    for label in roots:
+      add_lines(label, 0)
+    return '\n'.join(lines)
+  
+  def chrome_trace(self):
+    """Builds a Chrome trace of the recorded evaluations and commands, with a
+    host timeline per thread and, with event profiling, a device timeline per
+    device. Device timestamps are aligned to host time using the time each
+    command was enqueued.
+    returns: The trace as a JSON-compatible dictionary."""
+    has_device_times = self.cl_runtime is not None \
+      and self.cl_runtime.profiling
+    base_ns = min([call.start_ns for call in self._calls]
+      + [command.host_ns for command in self._commands] or [0])
+    trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': _HOST_PID,
+      'args': {'name': 'host'}}]
+    
+    for call in self._calls:
+      trace_events.append({'name': call.label, 'cat': 'evaluate', 'ph': 'X',
+        'ts': (call.start_ns - base_ns) * 1e-3,
+        'dur': (call.end_ns - call.start_ns) * 1e-3, 'pid': _HOST_PID,
+        'tid': call.thread_id, 'args': {'frame': call.frame_idx}})
+    
+    if has_device_times:
+      trace_events.append({'name': 'process_name', 'ph': 'M',
+        'pid': _DEVICE_PID, 'args': {'name': 'OpenCL devices'}})
+      for device_idx, device in enumerate(self.cl_runtime.devices):
+        trace_events.append({'name': 'thread_name', 'ph': 'M',
+          'pid': _DEVICE_PID, 'tid': device_idx,
+          'args': {'name': device.name}})
+      
+      # The device clock has its own origin. Commands are enqueued just
+      # before they are recorded, so the smallest difference between the
+      # recording time and the queued time estimates the clock offset.
+      device_commands = [command for command in self._commands
+        if command.event is not None]
+      offsets = {}
+      for command in device_commands:
+        command.event.wait()
+        offset = command.host_ns - command.event.profile.queued
+        offsets[command.device_idx] = min(offset,
+          offsets.get(command.device_idx, offset))
+      for command in device_commands:
+        start_ns, end_ns = self._device_span(command)
+        trace_events.append({'name': command.name, 'cat': command.kind,
+          'ph': 'X',
+          'ts': (start_ns + offsets[command.device_idx] - base_ns) * 1e-3,
+          'dur': (end_ns - start_ns) * 1e-3, 'pid': _DEVICE_PID,
+          'tid': command.device_idx,
+          'args': {'texture': UNATTRIBUTED_LABEL if command.call is None
+            else command.call.label, 'bytes': command.num_bytes}})
+    
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+  
+  def write_chrome_trace(self, filename):
+    """Writes the trace from chrome_trace to a JSON file."""
+    with open(filename, 'w') as trace_file:
+      json.dump(self.chrome_trace(), trace_file)
+  
+  def _wrap(self, node, evaluate):
+    label = self._labels[id(node)]
+    
+    def profiled_evaluate(eval_pts):
+      stack = self._call_stack()
+      call = _Call(label, stack[-1].label if stack else None,
+        self.texture.curr_frame)
+      stack.append(call)
+      try:
+        return evaluate(eval_pts)
+      finally:
+        call.end_ns = time.perf_counter_ns()
+        stack.pop()
+        if stack:
+          stack[-1].child_ns += call.end_ns - call.start_ns
+        self._calls.append(call)
+    
+    return profiled_evaluate
+  
+  def _call_stack(self):
+    """Gets the current thread's stack of evaluations in progress."""
+    stack = getattr(self._thread_state, 'stack', None)
+    if stack is None:
+      stack = []
+      self._thread_state.stack = stack
+    return stack
+  
+  def _on_command(self, kind, name, event, num_bytes):
+    stack = self._call_stack()
+    self._commands.append(_Command(kind, name, event, num_bytes,
+      stack[-1] if stack else None, self.cl_runtime.device_idx))
+  
+  @staticmethod
+  def _device_span(command):
+    """Gets the device start and end times of a command, in nanoseconds,
+    waiting for it to complete."""
+    command.event.wait()
+    return command.event.profile.start, command.event.profile.end
@@ -1,37 +1,114 @@
+import threading
+
 import numpy
 
-from proc_tex.texture_base import TransformedTexture
+from proc_tex.texture_base import TransformedTexture, evaluate_source
+
+RANGE_MODE_FRAME = 'frame'
+RANGE_MODE_KNOWN = 'known'
+
+# Guards the recorded source ranges of tex_scale_to_region textures, which
+# several threads widen at once when a frame is evaluated on several devices
+# (see proc_tex.multi_device).
+_record_lock = threading.Lock()
 
-def tex_scale_to_region(src, min_value=0, max_value=1):
+def scale_offset_for_range(src_range, min_value, max_value):
+  """Computes the scale and offset that tex_scale_to_region applies to values
+  in a given range.
+  src_range - (min, max) tuple giving the range of the source values.
+  min_value - The desired minimum texture value.
+  max_value - The desired maximum texture value.
+  Returns: A (scale, offset) tuple. Scaled values are src_vals * scale +
+    offset."""
+  src_delta = src_range[1] - src_range[0]
+  delta = max_value - min_value
+  
+  if src_delta == 0:
+    return 0, min_value + delta / 2
+  else:
+    scale = delta / src_delta
+    return scale, min_value - (src_range[0] * scale)
+
+def merge_value_ranges(range0, range1):
+  """Gets the smallest (min, max) tuple that covers two (min, max) tuples."""
+  return (min(range0[0], range1[0]), max(range0[1], range1[1]))
+
+def record_src_range(op_params, src_range):
+  """Widens the recorded source range of a tex_scale_to_region texture, if it
+  is recording one. See tex_scale_to_region.
+  op_params - The texture's op_params.
+  src_range - (min, max) tuple with the range of the source values that were
+    evaluated."""
+  with _record_lock:
+    if op_params['recorded_src_range'] is not None:
+      op_params['recorded_src_range'] = merge_value_ranges(
+        op_params['recorded_src_range'], src_range)
+
+def tex_scale_to_region(src, min_value=0, max_value=1,
+  range_mode=RANGE_MODE_FRAME, src_range=None):
   """Scales and offsets a floating point texture's values to the given range.
-  Each frame will be scaled and offset so that its minimum texture value is
-  min_value and its maximum is max_value. (All channels receive the same scale
-  and offset in each frame.) If this is not possible because the texture values
-  are all the same, all the values will be moved to halfway between min_value
-  and max_value. Note that each frame in a video is handled separately, so the
-  transform may not be uniform across video frames.
+  In RANGE_MODE_FRAME, each frame will be scaled and offset so that its minimum
+  texture value is min_value and its maximum is max_value. (All channels
+  receive the same scale and offset in each frame.) If this is not possible
+  because the texture values are all the same, all the values will be moved to
+  halfway between min_value and max_value. Note that each frame in a video is
+  handled separately, so the transform may not be uniform across video frames.
+  In RANGE_MODE_KNOWN, the source range is not measured. Instead, src_range or
+  src.value_range() (analytic or cached bounds, see Texture.value_range) is
+  mapped to [min_value, max_value]. This gives the same scale and offset for
+  every frame and every part of an image, so tiles of an image can be
+  normalized consistently without first evaluating the whole image. Values
+  outside the source range are not clamped.
+  Renderers that evaluate a frame in pieces (see proc_tex.tiled_render) can
+  still use RANGE_MODE_FRAME: they measure the range over the whole frame by
+  setting the texture's op_params['recorded_src_range'] to an empty range
+  ((inf, -inf)), which every evaluation then widens to cover its source
+  values, and afterwards store the result in op_params['pinned_src_range'],
+  which is used instead of the range of the values being evaluated until it
+  is set back to None.
   src - The source texture to transform.
   min_value - The desired minimum texture value.
   max_value - The desired maximum texture value.
+  range_mode - RANGE_MODE_FRAME or RANGE_MODE_KNOWN.
+  src_range - Optional (min, max) tuple to use as the source range in
+    RANGE_MODE_KNOWN. If None, src.value_range() is used when the texture is
+    evaluated.
   Returns: The transformed texture."""
+  if range_mode not in (RANGE_MODE_FRAME, RANGE_MODE_KNOWN):
+    raise ValueError('Unknown range mode: {}'.format(range_mode))
+  
   def space_transform(eval_pts):
     return [eval_pts]
   def tex_transform(src_vals):
     src_vals = src_vals[0]
-    src_min_value = src_vals.min()
-    src_max_value = src_vals.max()
-    src_delta = src_max_value - src_min_value
-    delta = max_value - min_value
+    if range_mode == RANGE_MODE_KNOWN:
+      curr_src_range = get_src_range()
+    elif op_params['pinned_src_range'] is not None:
+      curr_src_range = op_params['pinned_src_range']
+    else:
+      curr_src_range = (src_vals.min(), src_vals.max())
+      record_src_range(op_params, curr_src_range)
+    scale, offset = scale_offset_for_range(curr_src_range, min_value,
+      max_value)
     
-    if src_delta == 0:
-      return numpy.full_like(src_vals, min_value + delta / 2)
+    if scale == 0:
+      return numpy.full_like(src_vals, offset)
     else:
-      scale = delta / src_delta
-      offset = min_value - (src_min_value * scale)
       return src_vals * scale + offset
+  def range_transform(src_ranges):
+    return (min_value, max_value)
+  def get_src_range():
+    curr_src_range = src.value_range() if src_range is None else src_range
+    if curr_src_range is None:
+      raise ValueError('Source texture has no known value range.')
+    return curr_src_range
   
+  op_params = {'min_value': min_value, 'max_value': max_value,
+    'range_mode': range_mode, 'get_src_range': get_src_range,
+    'pinned_src_range': None, 'recorded_src_range': None}
   return TransformedTexture(src.num_channels, src.num_space_dims, [src],
-    space_transform, tex_transform)
+    space_transform, tex_transform, op_name='scale_to_region',
+    op_params=op_params, range_transform=range_transform)
 
 def tex_to_dtype(src, dtype, scale=1):
   """Converts a texture to the given dtype for each channel.
@@ -47,7 +124,8 @@ def tex_to_dtype(src, dtype, scale=1):
     return (src_vals[0] * scale).astype(dtype)
   
   return TransformedTexture(src.num_channels, src.num_space_dims, [src],
-    space_transform, tex_transform)
+    space_transform, tex_transform, op_name='to_dtype',
+    op_params={'dtype': dtype, 'scale': scale})
 
 def tex_to_num_channels(src, num_channels):
   """Converts a texture to have the specified number of channels.
@@ -77,9 +155,12 @@ def tex_to_num_channels(src, num_channels):
     # Do nothing if we already have the desired number of channels.
     else:
       return src_vals
+  def range_transform(src_ranges):
+    return src_ranges[0]
   
   return TransformedTexture(num_channels, src.num_space_dims, [src],
-    space_transform, tex_transform)
+    space_transform, tex_transform, op_name='to_num_channels',
+    op_params={'num_channels': num_channels}, range_transform=range_transform)
 
 def tex_concat_channels(src_textures):
   """Concatenates the channels of multiple source textures.
@@ -95,11 +176,17 @@ def tex_concat_channels(src_textures):
     return [eval_pts] * len(src_textures)
   def tex_transform(src_vals):
     return numpy.concatenate(src_vals, axis=-1)
+  def range_transform(src_ranges):
+    result = src_ranges[0]
+    for src_range in src_ranges[1:]:
+      result = merge_value_ranges(result, src_range)
+    return result
   
   new_num_channels = sum([src.num_channels for src in src_textures])
   
   return TransformedTexture(new_num_channels, src_textures[0].num_space_dims,
-    src_textures, space_transform, tex_transform)
+    src_textures, space_transform, tex_transform,
+    op_name='concat_channels', range_transform=range_transform)
 
 def tex_space_offset_by_texture(src, offset_texture):
   """Transforms a source texture's space by applying an offset texture.
@@ -115,10 +202,14 @@ def tex_space_offset_by_texture(src, offset_texture):
       'Offset texture must have the same number of channels as spatial dimensions')
   
   def space_transform(eval_pts):
-    return [eval_pts + offset_texture.evaluate(eval_pts)]
+    return [eval_pts + evaluate_source(offset_texture, eval_pts)]
   
   def tex_transform(src_vals):
     return src_vals[0]
+  def range_transform(src_ranges):
+    return src_ranges[0]
   
   return TransformedTexture(src.num_channels, src.num_space_dims, [src],
-    space_transform, tex_transform, [offset_texture])
+    space_transform, tex_transform, [offset_texture], op_name='space_offset',
+    op_params={'offset_texture': offset_texture},
+    range_transform=range_transform)
@@ -1,46 +1,125 @@
 import numpy
-import pyopencl
 
-from proc_tex.texture_base import TransformedTexture
+from proc_tex.texture_base import ImplicitGridPts, TransformedTexture
+import proc_tex.numpy_noise
 
-def tex_3d_to_sphere_map(src, cl_context, radius=numpy.float64(0.25),
-  center=numpy.array((0, 0, 0), dtype=numpy.float64)):
+def tex_3d_to_sphere_map(src, cl_runtime, radius=numpy.float64(0.25),
+  center=numpy.array((0, 0, 0), dtype=numpy.float64), dtype=None,
+  backend=proc_tex.numpy_noise.BACKEND_AUTO):
   """Converts a 3D texture to a 2D sphere-mapped texture.
+  The sphere map is an equirectangular projection, which samples the source
+  much more densely near the poles than near the equator. See
+  tex_3d_to_cube_map and tex_3d_to_octahedral_map for layouts that reach the
+  same resolution at the equator with far fewer source evaluations.
   src - 3D source texture to convert.
-  cl_context - OpenCL context for the computation.
+  cl_runtime - OpenCLRuntime for the computation, or None to compute with
+    Numpy only.
   radius - Radius of the sphere, in the source texture's texture space.
   center - Center of the sphere, in the source texture's texture space.
+  dtype - Floating point dtype for computing the mapped points,
+    numpy.float32 or numpy.float64. If None, cl_runtime.dtype is used, or
+    numpy.float64 without a runtime.
+  backend - One of the BACKEND_* constants from proc_tex.numpy_noise, which
+    selects whether to map the points with the OpenCL kernel or with Numpy.
   Returns: The transformed texture."""
+  dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+  return _tex_3d_to_map(src, cl_runtime, dtype, backend, 'sphereMapTo3D',
+    (dtype.type(radius),),
+    lambda eval_pts: proc_tex.numpy_noise.sphere_map_to_3d(center, eval_pts,
+      dtype),
+    center, 'sphere_map', {'radius': radius, 'center': center})
+
+def tex_3d_to_cube_map(src, cl_runtime,
+  center=numpy.array((0, 0, 0), dtype=numpy.float64), equi_angular=True,
+  dtype=None, backend=proc_tex.numpy_noise.BACKEND_AUTO):
+  """Converts a 3D texture to a 2D cube-mapped texture, with the six faces of
+  the cube laid out in a horizontal strip (see cubeMapTo3DAt in
+  sphereMap.clh). Evaluate the result at a width of six times its height to
+  get square faces. The points lie on the same sphere as with
+  tex_3d_to_sphere_map.
+  With equi_angular, neighboring samples are at most pi / (2 N) radians apart
+  on faces of N by N pixels, the spacing of a sphere map of 4 N by 2 N pixels
+  at the equator. The cube map takes 6 N^2 evaluations of the source instead
+  of 8 N^2, and does not oversample the regions near the poles.
+  equi_angular - If true, the samples of each face are spaced at equal angles
+    (an equi-angular cube map). Otherwise each face is a perspective
+    projection of the sphere, as sampled by GPU cube map hardware.
+  See tex_3d_to_sphere_map for the other parameters."""
+  dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+  return _tex_3d_to_map(src, cl_runtime, dtype, backend, 'cubeMapTo3D',
+    (numpy.int32(equi_angular),),
+    lambda eval_pts: proc_tex.numpy_noise.cube_map_to_3d(center,
+      equi_angular, eval_pts, dtype),
+    center, 'cube_map', {'center': center, 'equi_angular': equi_angular})
+
+def tex_3d_to_octahedral_map(src, cl_runtime,
+  center=numpy.array((0, 0, 0), dtype=numpy.float64), dtype=None,
+  backend=proc_tex.numpy_noise.BACKEND_AUTO):
+  """Converts a 3D texture to a 2D octahedral-mapped texture, which covers the
+  whole sphere with a single square image (see octahedralMapTo3DAt in
+  sphereMap.clh). Like a cube map, it samples the sphere much more evenly than
+  a sphere map. The points lie on the same sphere as with
+  tex_3d_to_sphere_map.
+  See tex_3d_to_sphere_map for the parameters."""
+  dtype = proc_tex.numpy_noise.backend_dtype(cl_runtime, dtype)
+  return _tex_3d_to_map(src, cl_runtime, dtype, backend, 'octahedralMapTo3D',
+    (),
+    lambda eval_pts: proc_tex.numpy_noise.octahedral_map_to_3d(center,
+      eval_pts, dtype),
+    center, 'octahedral_map', {'center': center})
+
+def _tex_3d_to_map(src, cl_runtime, dtype, backend, kernel_name, kernel_args,
+  map_numpy, center, op_name, op_params):
+  """Converts a 3D texture to a 2D texture by mapping the 2D points onto a
+  sphere.
+  kernel_name - Name of the kernel in sphereMap.cl that maps an array of
+    points. The kernel with 'Grid' appended maps an implicit grid.
+  kernel_args - Arguments of the kernel before the center of the sphere.
+  map_numpy - Function that maps an array or ImplicitGridPts of points with
+    Numpy.
+  op_name - See TransformedTexture.
+  op_params - See TransformedTexture."""
+  proc_tex.numpy_noise.check_backend(backend, cl_runtime)
   
-  # Precompile the OpenCl program.
-  with open('opencl/sphereMap.cl', 'r', encoding='utf-8') as program_file:
-    cl_program_map = pyopencl.Program(cl_context, program_file.read()) \
-      .build(options=['-I', 'opencl/include/'])
+  # Get the OpenCL program.
+  if cl_runtime is not None:
+    cl_program_map = cl_runtime.get_program('opencl/sphereMap.cl',
+      dtype=dtype)
+  
+  # OpenCL 3-component vectors take up the space of 4 components.
+  center_arg = numpy.zeros(4, dtype=dtype)
+  center_arg[:3] = center
   
   def space_transform(eval_pts):
-    # Make sure eval_pts has the required memory layout.
-    eval_pts = numpy.ascontiguousarray(eval_pts).astype(numpy.float64)
+    if proc_tex.numpy_noise.use_numpy(backend, cl_runtime,
+      numpy.prod(eval_pts.shape[:-1])):
+      return [map_numpy(eval_pts)]
+    
+    # Make sure eval_pts has the required memory layout. Implicit grids of
+    # evaluation points are computed on the device instead.
+    if not isinstance(eval_pts, ImplicitGridPts):
+      eval_pts = numpy.ascontiguousarray(eval_pts).astype(dtype)
     
-    # Set up OpenCL buffers.
-    eval_pts_buffer = pyopencl.Buffer(cl_context,
-      pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.COPY_HOST_PTR,
-      hostbuf=eval_pts)
     result_shape = eval_pts.shape[:-1] + (3,)
-    result_array = numpy.empty(result_shape, dtype=numpy.float64)
-    result_size_bytes = result_array.nbytes
-    result_buffer = pyopencl.Buffer(cl_context, pyopencl.mem_flags.WRITE_ONLY,
-      result_size_bytes)
+    result_array = numpy.empty(result_shape, dtype=dtype)
     
-    with pyopencl.CommandQueue(cl_context) as cl_queue:
-      cl_program_map.sphereMapTo3D(cl_queue, (result_array.size // 3,),
-        None, radius, center, eval_pts_buffer, result_buffer)
+    # Borrow buffers for the OpenCL kernel from the runtime's pool.
+    with cl_runtime.eval_pts_arg(eval_pts, dtype) as (is_grid, eval_pts_arg), \
+      cl_runtime.scratch_buffer(result_array.nbytes) as result_buffer:
+      kernel = cl_runtime.get_kernel(cl_program_map,
+        kernel_name + 'Grid' if is_grid else kernel_name)
+      cl_runtime.run_kernel(kernel, (result_array.size // 3,), None,
+        *kernel_args, center_arg, eval_pts_arg, result_buffer)
       
-      pyopencl.enqueue_copy(cl_queue, result_array, result_buffer)
+      cl_runtime.download(result_array, result_buffer)
     
     return [result_array]
   
   def tex_transform(src_vals):
     return src_vals[0]
+  def range_transform(src_ranges):
+    return src_ranges[0]
   
   return TransformedTexture(src.num_channels, 2, [src], space_transform,
-    tex_transform)
+    tex_transform, op_name=op_name, op_params=op_params,
+    range_transform=range_transform)
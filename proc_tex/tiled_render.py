@@ -0,0 +1,201 @@
+import contextlib
+
+import numpy
+
+from proc_tex.texture_base import EvalCache
+from proc_tex.texture_transforms import RANGE_MODE_FRAME
+
+_EMPTY_RANGE = (numpy.inf, -numpy.inf)
+
+def _children(texture):
+  """Gets the textures a texture depends on."""
+  return list(getattr(texture, 'src_textures', [])) \
+    + list(texture.anim_synch_textures)
+
+def _is_frame_scale(texture):
+  # Ranges pinned by an enclosing renderer are left alone.
+  return getattr(texture, 'op_name', None) == 'scale_to_region' \
+    and texture.op_params['range_mode'] == RANGE_MODE_FRAME \
+    and texture.op_params['pinned_src_range'] is None
+
+def _find_frame_scale_textures(texture):
+  """Finds the tex_scale_to_region textures in a graph that measure the range
+  of each frame.
+  Returns: A list of lists of textures. The textures in list i only depend on
+    (frame-measuring) tex_scale_to_region textures in lists before i, so their
+    ranges can be measured once those ranges are known. This includes the
+    textures that shift their evaluation points, as the offset texture of
+    tex_space_offset_by_texture does for its source."""
+  # Maps op_params ID to (texture, level), where the level is the 1-based
+  # index of the texture's list. Copies of a texture made by graph rewriters
+  # such as fuse_texture share op_params with the original.
+  scale_textures = {}
+  
+  def visit(curr_texture, base, depths):
+    """Computes the number of nested levels at or below a texture, given
+    that its evaluation points depend on base levels."""
+    key = (id(curr_texture), base)
+    if key not in depths:
+      depths[key] = base
+      if getattr(curr_texture, 'op_name', None) == 'space_offset':
+        # The source is evaluated at points shifted by the offset texture,
+        # so its ranges can only be measured after those of the offset
+        # texture.
+        offset_texture = curr_texture.op_params['offset_texture']
+        offset_depth = visit(offset_texture, base, depths)
+        child_depths = [offset_depth] + [visit(child, offset_depth, depths)
+          for child in _children(curr_texture) if child is not offset_texture]
+      else:
+        child_depths = [visit(child, base, depths)
+          for child in _children(curr_texture)]
+      depth = max([base] + child_depths)
+      if _is_frame_scale(curr_texture):
+        # A texture reached along several paths is measured at the highest
+        # level any of them needs.
+        _, prev_level = scale_textures.get(id(curr_texture.op_params),
+          (None, 0))
+        depth = max(depth + 1, prev_level)
+        scale_textures[id(curr_texture.op_params)] = (curr_texture, depth)
+      depths[key] = depth
+    return depths[key]
+  
+  # Raising the level of a texture raises the levels of the textures that
+  # depend on it, which may have been visited already, so repeat until the
+  # levels stop changing.
+  prev_levels = None
+  levels = {}
+  while levels != prev_levels:
+    prev_levels = levels
+    visit(texture, 0, {})
+    levels = {key: level for key, (_, level) in scale_textures.items()}
+  
+  scale_levels = [[] for _ in range(max([0] + list(levels.values())))]
+  for scale_texture, level in scale_textures.values():
+    scale_levels[level - 1].append(scale_texture)
+  return scale_levels
+
+@contextlib.contextmanager
+def pin_frame_ranges(texture, evaluate_frame):
+  """Context manager for renderers that evaluate a frame in pieces. Measures the
+  whole-frame source range of each tex_scale_to_region texture in
+  RANGE_MODE_FRAME in a texture graph, and pins it for the duration of the
+  context (see tex_scale_to_region). Nested textures need one measuring pass
+  per level of nesting.
+  texture - Root of the texture graph.
+  evaluate_frame - Function with no parameters that evaluates the whole frame
+    (in pieces), discarding the results."""
+  scale_levels = _find_frame_scale_textures(texture)
+  try:
+    for level in scale_levels:
+      for scale_texture in level:
+        scale_texture.op_params['recorded_src_range'] = _EMPTY_RANGE
+      
+      evaluate_frame()
+      
+      for scale_texture in level:
+        src_range = scale_texture.op_params['recorded_src_range']
+        scale_texture.op_params['recorded_src_range'] = None
+        if src_range != _EMPTY_RANGE:
+          scale_texture.op_params['pinned_src_range'] = src_range
+    
+    yield
+  
+  finally:
+    for level in scale_levels:
+      for scale_texture in level:
+        scale_texture.op_params['recorded_src_range'] = None
+        scale_texture.op_params['pinned_src_range'] = None
+
+class TiledRenderer:
+  """Renders images of 2D textures one tile at a time.
+  The evaluation points and texture values are only ever materialized for a
+  single tile, so peak memory depends on the tile size instead of the image
+  size. This makes it possible to render images much larger than memory, e.g.
+  straight into a numpy.memmap.
+  tex_scale_to_region textures in RANGE_MODE_FRAME still normalize by the
+  range over the whole image. Before the tiles are rendered, the range of each
+  such texture is measured in extra passes over the tiles (one pass per level
+  of nesting), which also have bounded memory use. Textures using
+  RANGE_MODE_KNOWN need no extra passes, so prefer that mode for very large
+  images where possible."""
+  def __init__(self, texture, pixel_dims, space_bounds, tile_dims=(1024, 1024)):
+    """Initializer.
+    texture - The texture to render. Must have 2 spatial dimensions.
+    pixel_dims - See Texture.to_image.
+    space_bounds - See Texture.to_image.
+    tile_dims - Maximum width and height of a tile, in pixels."""
+    if texture.num_space_dims != 2:
+      raise ValueError(
+        'Cannot render tiles with number of dimensions other than 2.')
+    
+    self.texture = texture
+    self.pixel_dims = tuple(pixel_dims)
+    self.space_bounds = numpy.array(space_bounds)
+    self.tile_dims = tuple(tile_dims)
+  
+  @property
+  def image_shape(self):
+    """Shape of the rendered image array, matching Texture.to_image."""
+    return (self.pixel_dims[1], self.pixel_dims[0], self.texture.num_channels)
+  
+  def tile_bounds(self):
+    """Gets the pixel bounds of all tiles, in row-major order.
+    returns: List of tile bounds, as accepted by Texture.gen_eval_pts."""
+    width, height = self.pixel_dims
+    tile_width, tile_height = self.tile_dims
+    return [((left, min(left + tile_width, width)),
+      (top, min(top + tile_height, height)))
+      for top in range(0, height, tile_height)
+      for left in range(0, width, tile_width)]
+  
+  def iter_tiles(self):
+    """Renders the current frame one tile at a time.
+    Yields: (tile_bounds, tile) tuples, where tile is the Numpy array of
+      texture values for the pixels in tile_bounds. The tile belongs at
+      image[top:bottom, left:right] in the full image, where tile_bounds is
+      ((left, right), (top, bottom))."""
+    def evaluate_frame():
+      for bounds in self.tile_bounds():
+        self._eval_tile(bounds)
+    
+    with pin_frame_ranges(self.texture, evaluate_frame):
+      for bounds in self.tile_bounds():
+        yield bounds, self._eval_tile(bounds)
+  
+  def render_into(self, out):
+    """Renders the current frame into an existing array.
+    out - Array of shape image_shape, or any other object that supports Numpy
+      slice assignment with that shape, such as a numpy.memmap.
+    returns: out."""
+    for ((left, right), (top, bottom)), tile in self.iter_tiles():
+      out[top:bottom, left:right] = tile
+    return out
+  
+  def render_to_file(self, filename, dtype=None):
+    """Renders the current frame into a memory-mapped file.
+    Files ending in .npy are written in Numpy's .npy format. Other files are
+    written as raw pixel data in row-major order with interleaved channels,
+    which can be read with numpy.memmap or image tools that accept raw input.
+    filename - Location at which to store the image.
+    dtype - The dtype to store. If None, the dtype of the texture values is
+      used.
+    returns: The numpy.memmap holding the image."""
+    out = None
+    for ((left, right), (top, bottom)), tile in self.iter_tiles():
+      if out is None:
+        out_dtype = tile.dtype if dtype is None else dtype
+        if filename.endswith('.npy'):
+          out = numpy.lib.format.open_memmap(filename, mode='w+',
+            dtype=out_dtype, shape=self.image_shape)
+        else:
+          out = numpy.memmap(filename, mode='w+', dtype=out_dtype,
+            shape=self.image_shape)
+      out[top:bottom, left:right] = tile
+    out.flush()
+    return out
+  
+  def _eval_tile(self, bounds):
+    eval_pts = self.texture.gen_eval_pts(self.pixel_dims, self.space_bounds,
+      tile_bounds=bounds, implicit=True)
+    with EvalCache(self.texture):
+      return self.texture.evaluate(eval_pts)